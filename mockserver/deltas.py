@@ -0,0 +1,203 @@
+"""
+Deltas between consecutive states of the mockserver.
+
+update_state.py computes the structural diff of the state it replaces (see
+`diff`) and appends it to a DeltaLog, a file of JSON lines
+
+  {"seq": <sequence number>, "patch": [<operations>]}
+
+The state document then records the sequence number it is at, so that a
+client fetching v3/state can follow the deltas after it. server.py reads
+the log through a DeltaFeed, and streams new deltas to clients (see
+server.py).
+
+Patches are lists of JSON Patch (RFC 6902) operations "add", "replace" and
+"remove", relative to the "data" of the state. Only the last `max_entries`
+deltas are kept: a client behind by more has to fetch the whole state again.
+
+Only the standard library is used, as the mockserver image has no other
+dependency.
+"""
+
+import json
+import os
+import threading
+
+# Number of deltas kept in the log
+MAX_ENTRIES = 1000
+
+
+def _escape(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def diff(old, new, path=''):
+    """Returns the list of JSON Patch operations turning `old` into `new`"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        operations = []
+        for key in sorted(old):
+            if key not in new:
+                operations.append({'op': 'remove',
+                                   'path': path + '/' + _escape(key)})
+        for key in sorted(new):
+            child_path = path + '/' + _escape(key)
+            if key not in old:
+                operations.append({'op': 'add', 'path': child_path,
+                                   'value': new[key]})
+            else:
+                operations.extend(diff(old[key], new[key], child_path))
+        return operations
+    # Lists (e.g. generation histories) are replaced as a whole
+    if old == new and type(old) == type(new):
+        return []
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+
+def apply(document, operations):
+    """
+    Applies JSON Patch operations (as returned by `diff`) to `document`, in
+    place. Returns the patched document.
+    """
+    for operation in operations:
+        tokens = [_unescape(token)
+                  for token in operation['path'].split('/')[1:]]
+        if not tokens:
+            document = operation['value']
+            continue
+        parent = document
+        for token in tokens[:-1]:
+            parent = parent[int(token) if isinstance(parent, list)
+                            else token]
+        key = int(tokens[-1]) if isinstance(parent, list) else tokens[-1]
+        if operation['op'] == 'remove':
+            del parent[key]
+        else:
+            parent[key] = operation['value']
+    return document
+
+
+def _read_entries(path):
+    entries = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Line being appended
+                    break
+    except IOError:
+        pass
+    return entries
+
+
+class DeltaLog(object):
+    """
+    Writer of the deltas log at `path`. The log is read once, on first use:
+    it is expected to have no other writer.
+    """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        # Sequence number of the last delta, and number of deltas in the log
+        self._last_seq = None
+        self._count = None
+
+    def _load(self):
+        if self._last_seq is None:
+            entries = _read_entries(self.path)
+            self._last_seq = entries[-1]['seq'] if entries else 0
+            self._count = len(entries)
+
+    def last_seq(self):
+        """Returns the sequence number of the last delta, 0 if none"""
+        self._load()
+        return self._last_seq
+
+    def append(self, patch):
+        """Appends a delta, returns its sequence number"""
+        self._load()
+        seq = self._last_seq + 1
+        entry = {'seq': seq, 'patch': patch}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if self._count >= 2 * self.max_entries:
+            # Compaction: the log is replaced at once by its last entries
+            entries = _read_entries(self.path)[-self.max_entries + 1:]
+            entries.append(entry)
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(''.join(json.dumps(e) + '\n' for e in entries))
+            os.replace(self.path + '.tmp', self.path)
+            self._count = len(entries)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            self._count += 1
+        self._last_seq = seq
+        return seq
+
+
+class DeltaFeed(object):
+    """
+    Reader of the deltas log at `path`, keeping the deltas in memory and
+    waking up the clients waiting for new ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self._stamp = None
+        self._condition = threading.Condition()
+        self.refresh()
+
+    def last_seq(self):
+        with self._condition:
+            return self.entries[-1]['seq'] if self.entries else 0
+
+    def refresh(self):
+        """Reloads the log if it changed, returns whether it did"""
+        try:
+            stat = os.stat(self.path)
+            stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+        if stamp == self._stamp:
+            return False
+        entries = _read_entries(self.path)
+        with self._condition:
+            self._stamp = stamp
+            self.entries = entries
+            self._condition.notify_all()
+        return True
+
+    def since(self, seq):
+        """
+        Returns the deltas after `seq`, or None if some of them are not
+        kept anymore (or `seq` is ahead of the log, e.g. after it was reset):
+        the client has to fetch the whole state again.
+        """
+        with self._condition:
+            return self._since(seq)
+
+    def _since(self, seq):
+        last = self.entries[-1]['seq'] if self.entries else 0
+        if seq > last:
+            return None
+        if seq == last:
+            return []
+        first = self.entries[0]['seq']
+        if seq < first - 1:
+            return None
+        return self.entries[seq - first + 1:]
+
+    def wait_since(self, seq, timeout):
+        """Like `since`, waiting up to `timeout` seconds for new deltas"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._since(seq) != [], timeout)
+            return self._since(seq)
@@ -0,0 +1,163 @@
+"""
+Append-only history of zone states, written by update_state.py and served
+by server.py under v3/history.
+
+Datapoints are stored one JSON line per datapoint, partitioned by zone and
+by UTC day:
+
+  <root>/<zone key>/<YYYY-MM-DD>.jsonl
+
+Every line is {"t": <unix timestamp>, "d": <datapoint>}. A query for a time
+range of a zone only reads the files of the days it covers. Past days never
+change: parsed files are kept in a small cache, checked against their size
+and modification time.
+
+Only the standard library is used, as the mockserver image has no other
+dependency.
+"""
+
+from collections import OrderedDict
+import datetime
+import json
+import os
+import threading
+
+# Default range and number of points of a query, matching the 24 hours of
+# 15 minutes datapoints the frontend displays
+DEFAULT_RANGE = 24 * 3600
+DEFAULT_POINTS = 96
+# Number of parsed day files kept in memory
+CACHE_SIZE = 256
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def parse_time(value):
+    """
+    Returns the unix timestamp of a query parameter: a number of seconds, or
+    an ISO 8601 UTC datetime such as 2018-01-01T00:00:00Z.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    dt = datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    return (dt - _EPOCH).total_seconds()
+
+
+def day_of(timestamp):
+    """Returns the YYYY-MM-DD UTC day of a unix timestamp"""
+    return (_EPOCH + datetime.timedelta(seconds=timestamp)).strftime(
+        '%Y-%m-%d')
+
+
+def downsample(points, max_points):
+    """
+    Reduces sorted (timestamp, datapoint) pairs to at most `max_points`, by
+    splitting their time range in `max_points` even buckets and keeping the
+    last datapoint of every bucket.
+    """
+    if max_points is None or len(points) <= max_points:
+        return points
+    if max_points <= 0:
+        return []
+    first, last = points[0][0], points[-1][0]
+    width = (last - first) / max_points or 1
+    kept = OrderedDict()
+    for point in points:
+        bucket = min(int((point[0] - first) / width), max_points - 1)
+        kept[bucket] = point
+    return list(kept.values())
+
+
+class HistoryStore(object):
+    """History of zone datapoints under `root`, see module docstring"""
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # path -> (stamp, points)
+
+    def _path(self, zone_key, day):
+        return os.path.join(self.root, zone_key, day + '.jsonl')
+
+    def append(self, zone_key, timestamp, datapoint):
+        """Appends the datapoint of `zone_key` at unix time `timestamp`"""
+        path = self._path(zone_key, day_of(timestamp))
+        line = json.dumps({'t': timestamp, 'd': datapoint}) + '\n'
+        with self._lock:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'a') as f:
+                f.write(line)
+
+    def zones(self):
+        """Returns the sorted keys of zones having a history"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(os.listdir(self.root))
+
+    def days(self, zone_key):
+        """Returns the sorted days of history of `zone_key`"""
+        directory = os.path.join(self.root, zone_key)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(filename[:-len('.jsonl')]
+                      for filename in os.listdir(directory)
+                      if filename.endswith('.jsonl'))
+
+    def _read(self, path):
+        """Returns the (timestamp, datapoint) pairs of a day file"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return []
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached is not None and cached[0] == stamp:
+                self._cache.move_to_end(path)
+                return cached[1]
+        points = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Line being appended
+                    continue
+                points.append((record['t'], record['d']))
+        points.sort(key=lambda point: point[0])
+        with self._lock:
+            self._cache[path] = (stamp, points)
+            while len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return points
+
+    def query(self, zone_key, start=None, end=None,
+              max_points=DEFAULT_POINTS):
+        """
+        Returns the datapoints of `zone_key` between the unix times `start`
+        and `end` (included), oldest first, downsampled to `max_points`.
+        `end` defaults to the time of the latest datapoint and `start` to
+        DEFAULT_RANGE before `end`.
+        """
+        days = self.days(zone_key)
+        if not days:
+            return []
+        if end is None:
+            latest = self._read(self._path(zone_key, days[-1]))
+            if not latest:
+                return []
+            end = latest[-1][0]
+        if start is None:
+            start = end - DEFAULT_RANGE
+        first_day, last_day = day_of(start), day_of(end)
+        points = []
+        for day in days:
+            if first_day <= day <= last_day:
+                points.extend(point
+                              for point in self._read(self._path(zone_key,
+                                                                 day))
+                              if start <= point[0] <= end)
+        return [datapoint for _, datapoint in downsample(points, max_points)]
@@ -1,21 +1,471 @@
 #! /usr/bin/env python
 
-# Usage: python __file__.py <port>
+# Usage: python __file__.py [port]
+#
+# Serves the files of the current directory (i.e. public/) from memory.
+# Every file is loaded once, along with its gzip (and brotli, if the
+# `brotli` package is installed) variant, and reloaded when it changes on
+# disk. Responses carry an ETag, so that clients revalidating with
+# If-None-Match get a 304 while the file is unchanged. Directories are
+# served their index.html, or else a listing of their content.
+#
+# With --history <directory>, v3/history is answered from the history store
+# written by update_state.py (see history.py), queried by zone and time
+# range and downsampled.
+#
+# With --deltas <log>, the changes to the state published by update_state.py
+# (see deltas.py) are pushed to clients of v3/state/stream (Server-Sent
+# Events) and v3/state/deltas (long-poll), by sequence number. A client
+# fetches v3/state once, then follows the deltas after its "sequence", and
+# resumes from its last sequence number when reconnecting.
 
-from http.server import SimpleHTTPRequestHandler, HTTPServer, test
+import argparse
+from collections import OrderedDict
+import gzip
+import hashlib
+import html
+import json
+import logging
+import mimetypes
+import os
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+if __package__:
+    from . import deltas, history
+else:
+    # Run as a script, next to deltas.py and history.py (see Dockerfile)
+    import deltas
+    import history
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Served from the history store, when the zone has a history
+HISTORY_PATH = '/v3/history'
+# Deltas of the state, streamed (Server-Sent Events) or long-polled
+STREAM_PATH = '/v3/state/stream'
+DELTAS_PATH = '/v3/state/deltas'
+# Maximum seconds a long-poll request waits for deltas
+LONG_POLL_TIMEOUT = 30
+# Seconds between two keepalive comments of an idle stream
+KEEPALIVE = 15
+# Seconds between two checks of the files for changes
+RELOAD_INTERVAL = 1.0
+
+CONTENT_TYPES = {
+    '.html': 'text/html',
+    '.js': 'application/javascript',
+    '.json': 'application/json',
+}
+# Files without extension (e.g. v3/state) are JSON API responses
+DEFAULT_CONTENT_TYPE = 'application/json'
+# Files whose extension is neither in CONTENT_TYPES nor known to mimetypes
+UNKNOWN_CONTENT_TYPE = 'application/octet-stream'
+# Files being written, then renamed over the files they replace
+TEMPORARY_SUFFIX = '.tmp'
+# Files served for the URL path of their directory
+INDEX_FILES = ['index.html', 'index.htm']
+
+logger = logging.getLogger(__name__)
+
+
+# Content encodings served, by order of preference
+COMPRESSORS = OrderedDict()
+if brotli is not None:
+    COMPRESSORS['br'] = brotli.compress
+COMPRESSORS['gzip'] = lambda body: gzip.compress(body, 9)
+
+
+class Payload(object):
+    """
+    A response body and its compressed variants, each with its own ETag.
+    Variants are compressed once, when the payload is created if
+    `precompress`, or else on first use.
+    """
+
+    def __init__(self, body, content_type, stamp=None, precompress=True):
+        self.content_type = content_type
+        # (modification time, size) of the file the payload was loaded from
+        self.stamp = stamp
+        self.digest = hashlib.sha1(body).hexdigest()
+        self.variants = {'identity': (body, '"%s"' % self.digest)}
+        if precompress:
+            for encoding in COMPRESSORS:
+                self.variant(encoding)
+
+    def variant(self, encoding):
+        """Returns the (body, etag) of the `encoding` variant"""
+        if encoding not in self.variants:
+            body = COMPRESSORS[encoding](self.variants['identity'][0])
+            self.variants[encoding] = (body,
+                                       '"%s-%s"' % (self.digest, encoding))
+        return self.variants[encoding]
+
+    def negotiate(self, accept_encoding):
+        """Returns the (encoding, body, etag) to send to a client"""
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in COMPRESSORS:
+            if encoding in accepted:
+                return (encoding,) + self.variant(encoding)
+        return ('identity',) + self.variants['identity']
+
+
+def parse_accept_encoding(header):
+    """Returns the set of encodings accepted by an Accept-Encoding header"""
+    accepted = set()
+    for item in (header or '').split(','):
+        parts = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if parts[0] and q > 0:
+            accepted.add(parts[0].lower())
+    return accepted
+
+
+def strip_weak(etag):
+    """Returns an ETag without its weak indicator, W/"x" matching "x" """
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+class PayloadStore(object):
+    """
+    In-memory copy of all files under `root`, keyed by URL path.
+
+    `reload` builds a complete new mapping before swapping it in at once,
+    so that requests see either the previous or the new set of payloads.
+    A JSON file that fails to parse (e.g. caught while it is being written)
+    keeps its previous payload until the next reload.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.payloads = {}
+        self.reload()
+
+    def get(self, path):
+        """
+        Returns the payload of a URL path. Directory paths (ending with a
+        slash) get their index file, or else a listing of their content.
+        """
+        payloads = self.payloads
+        if not path.endswith('/'):
+            return payloads.get(path)
+        for index in INDEX_FILES:
+            if path + index in payloads:
+                return payloads[path + index]
+        names = sorted({url_path[len(path):].split('/')[0] +
+                        ('/' if '/' in url_path[len(path):] else '')
+                        for url_path in payloads if url_path.startswith(path)})
+        if not names:
+            return None
+        return Payload(_listing(path, names), 'text/html', precompress=False)
+
+    def is_directory(self, path):
+        """Returns whether `path`, without its final slash, is a directory"""
+        return any(url_path.startswith(path + '/') for url_path in self.payloads)
+
+    def _stamps(self):
+        stamps = {}
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(TEMPORARY_SUFFIX):
+                    continue
+                file_path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    # Removed (or replaced) since it was listed
+                    continue
+                url_path = '/' + os.path.relpath(file_path, self.root) \
+                    .replace(os.sep, '/')
+                stamps[url_path] = (file_path,
+                                    (stat.st_mtime_ns, stat.st_size))
+        return stamps
+
+    def reload(self):
+        """Reloads changed files, returns the URL paths that were reloaded"""
+        previous = self.payloads
+        payloads, reloaded = {}, []
+        for url_path, (file_path, stamp) in self._stamps().items():
+            if url_path in previous and previous[url_path].stamp == stamp:
+                payloads[url_path] = previous[url_path]
+                continue
+            content_type = guess_content_type(file_path)
+            try:
+                with open(file_path, 'rb') as f:
+                    body = f.read()
+            except OSError:
+                continue
+            if content_type == 'application/json':
+                try:
+                    json.loads(body.decode('utf-8'))
+                except ValueError:
+                    logger.warning('Not reloading invalid JSON %s', url_path)
+                    if url_path in previous:
+                        payloads[url_path] = previous[url_path]
+                    continue
+            payloads[url_path] = Payload(body, content_type, stamp)
+            reloaded.append(url_path)
+            logger.info('Loaded %s', url_path)
+        self.payloads = payloads
+        return reloaded
+
+
+def guess_content_type(file_path):
+    """Returns the Content-Type a file is served with"""
+    extension = os.path.splitext(file_path)[1]
+    if not extension:
+        return DEFAULT_CONTENT_TYPE
+    if extension in CONTENT_TYPES:
+        return CONTENT_TYPES[extension]
+    return mimetypes.guess_type(file_path)[0] or UNKNOWN_CONTENT_TYPE
+
+
+def _listing(path, names):
+    """Returns the HTML listing of the `names` of directory `path`"""
+    title = html.escape('Directory listing for %s' % path)
+    items = ''.join('<li><a href="%s">%s</a></li>\n'
+                    % (html.escape(name, quote=True), html.escape(name))
+                    for name in names)
+    return ('<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8">'
+            '<title>%s</title></head>\n<body>\n<h1>%s</h1>\n<hr>\n<ul>\n'
+            '%s</ul>\n<hr>\n</body>\n</html>\n'
+            % (title, title, items)).encode('utf-8')
+
+
+def watch(reloaders, interval=RELOAD_INTERVAL):
+    """Calls every function of `reloaders` every `interval` seconds"""
+    def run():
+        while True:
+            time.sleep(interval)
+            for reload in reloaders:
+                try:
+                    reload()
+                except OSError:
+                    logger.exception('Error reloading')
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+class CORSRequestHandler(BaseHTTPRequestHandler):
+    # Set by make_server
+    store = None
+    history = None
+    feed = None
+    keepalive = KEEPALIVE
 
-class CORSRequestHandler(SimpleHTTPRequestHandler):
     def do_OPTIONS(self):
         self.send_response(200, 'OK')
         self.end_headers()
 
+    def do_HEAD(self):
+        self.handle_get(include_body=False)
+
+    def do_GET(self):
+        self.handle_get(include_body=True)
+
+    def handle_get(self, include_body):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        payload = None
+        try:
+            if url.path == STREAM_PATH and self.feed is not None:
+                self.send_stream(params, include_body)
+                return
+            if url.path == DELTAS_PATH and self.feed is not None:
+                self.send_deltas(params, include_body)
+                return
+            if url.path == HISTORY_PATH and self.history is not None:
+                payload = self.history_payload(params)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        if payload is None:
+            payload = self.store.get(url.path)
+        if payload is None and self.store.is_directory(url.path):
+            # Relative links of the directory's page resolve inside it
+            self.send_response(301)
+            location = url.path + '/'
+            if url.query:
+                location += '?' + url.query
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if payload is None:
+            self.send_error(404, 'File not found')
+            return
+        self.send_payload(payload, include_body)
+
+    def history_payload(self, params):
+        """
+        Returns the payload of a history query, or None if the zone has no
+        history (the static v3/history file is then served).
+        Parameters: countryCode, and optionally start and end (unix times or
+        ISO 8601 UTC datetimes) and points (maximum number of datapoints).
+        """
+        zone_key = params.get('countryCode', [None])[0]
+        if zone_key not in self.history.zones():
+            return None
+        start, end = [history.parse_time(params[name][0])
+                      if name in params else None
+                      for name in ['start', 'end']]
+        max_points = int(params['points'][0]) if 'points' in params \
+            else history.DEFAULT_POINTS
+        data = self.history.query(zone_key, start, end, max_points)
+        body = json.dumps({'data': data, 'cached': False}).encode('utf-8')
+        # Compressed on demand: history responses are not reused
+        return Payload(body, 'application/json', precompress=False)
+
+    def since(self, params):
+        """Returns the sequence number a client resumes from, or None"""
+        since = self.headers.get('Last-Event-ID') or \
+            params.get('since', [None])[0]
+        return None if since is None else int(since)
+
+    def send_deltas(self, params, include_body):
+        """
+        Long-poll: answers with the deltas after `since` as soon as there
+        are some, or with none after `timeout` seconds. Answers 410 when the
+        client must fetch the whole state again.
+        """
+        since = self.since(params)
+        if since is None:
+            raise ValueError('since is required')
+        timeout = min(float(params.get('timeout', [LONG_POLL_TIMEOUT])[0]),
+                      LONG_POLL_TIMEOUT)
+        if not include_body:
+            # HEAD: the headers of the deltas available now
+            timeout = 0
+        entries = self.feed.wait_since(since, timeout)
+        if entries is None:
+            status, obj = 410, {'reset': True,
+                                'sequence': self.feed.last_seq()}
+        else:
+            status, obj = 200, {
+                'sequence': entries[-1]['seq'] if entries else since,
+                'deltas': entries}
+        payload = Payload(json.dumps(obj).encode('utf-8'),
+                          'application/json', precompress=False)
+        self.send_payload(payload, include_body, status)
+
+    def send_stream(self, params, include_body):
+        """
+        Server-Sent Events: sends every delta after `since` (or the
+        Last-Event-ID of a reconnecting client) as a "patch" event, with its
+        sequence number as id. A "reset" event tells the client to fetch the
+        whole state again.
+        A HEAD request only gets the headers: the stream never ends.
+        """
+        since = self.since(params)
+        if since is None:
+            since = self.feed.last_seq()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        if not include_body:
+            return
+        self.close_connection = True
+        try:
+            while True:
+                entries = self.feed.wait_since(since, self.keepalive)
+                if entries is None:
+                    since = self.feed.last_seq()
+                    message = 'id: %s\nevent: reset\ndata: {}\n\n' % since
+                elif not entries:
+                    message = ': keepalive\n\n'
+                else:
+                    since = entries[-1]['seq']
+                    message = ''.join(
+                        'id: %s\nevent: patch\ndata: %s\n\n' %
+                        (entry['seq'], json.dumps(entry['patch']))
+                        for entry in entries)
+                self.wfile.write(message.encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+    def send_payload(self, payload, include_body, status=200):
+        encoding, body, etag = payload.negotiate(
+            self.headers.get('Accept-Encoding'))
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match and (
+                if_none_match.strip() == '*' or
+                etag in [strip_weak(tag)
+                         for tag in if_none_match.split(',')]):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', payload.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        if include_body:
+            self.wfile.write(body)
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Headers', 'x-request-timestamp, x-signature, electricitymap-token')
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Expires', '0')
-        SimpleHTTPRequestHandler.end_headers(self)
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        # Clients may cache, but must revalidate (with If-None-Match)
+        self.send_header('Cache-Control', 'no-cache')
+        BaseHTTPRequestHandler.end_headers(self)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(root, port, host='', history_root=None, deltas_path=None,
+                keepalive=KEEPALIVE):
+    """
+    Returns a server of the files of `root`, of the history stored in
+    `history_root` and of the deltas of the log at `deltas_path` if given
+    (see history.py and deltas.py)
+    """
+    handler = type('Handler', (CORSRequestHandler,), {
+        'store': PayloadStore(root),
+        'history': history_root and history.HistoryStore(history_root),
+        'feed': deltas_path and deltas.DeltaFeed(deltas_path),
+        'keepalive': keepalive,
+    })
+    return ThreadingHTTPServer((host, port), handler)
+
 
 if __name__ == '__main__':
-    test(CORSRequestHandler, HTTPServer)
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('port', type=int, nargs='?', default=8000)
+    parser.add_argument('--root', default='.')
+    parser.add_argument('--history', default=None,
+                        help='directory of the history written by '
+                             'update_state.py')
+    parser.add_argument('--deltas', default=None,
+                        help='log of state deltas written by update_state.py')
+    args = parser.parse_args()
+    server = make_server(args.root, args.port, history_root=args.history,
+                         deltas_path=args.deltas)
+    handler = server.RequestHandlerClass
+    watch([handler.store.reload] +
+          ([handler.feed.refresh] if handler.feed is not None else []))
+    print('Serving %s on port %s' % (os.path.abspath(args.root), args.port))
+    server.serve_forever()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""Tests for the mockserver: server.py, history.py and deltas.py."""
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from mockserver import deltas, history, server
+
+class MockserverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'public', 'v3'))
+        self.write_state({'data': {'countries': {}}})
+        self.history_root = os.path.join(self.root, 'history')
+        self.delta_log = deltas.DeltaLog(os.path.join(self.root, 'deltas'),
+                                         max_entries=3)
+        self.httpd = server.make_server(os.path.join(self.root, 'public'), 0,
+                                        host='127.0.0.1',
+                                        history_root=self.history_root,
+                                        deltas_path=self.delta_log.path,
+                                        keepalive=0.1)
+        self.feed = self.httpd.RequestHandlerClass.feed
+        self.store = self.httpd.RequestHandlerClass.store
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%s/v3/state' % self.httpd.server_port
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.root)
+
+    def write_state(self, obj, text=None):
+        path = os.path.join(self.root, 'public', 'v3', 'state')
+        with open(path + server.TEMPORARY_SUFFIX, 'w') as f:
+            f.write(json.dumps(obj) if text is None else text)
+        os.replace(path + server.TEMPORARY_SUFFIX, path)
+
+    def get(self, **headers):
+        try:
+            return urlopen(Request(self.url, headers=headers))
+        except HTTPError as e:
+            return e
+
+    def test_gzip_and_etag(self):
+        response = self.get(**{'Accept-Encoding': 'gzip, br;q=0'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.read())
+                                    .decode('utf-8')),
+                         {'data': {'countries': {}}})
+        etag = response.headers['ETag']
+        self.assertEqual(self.get(**{'Accept-Encoding': 'gzip',
+                                     'If-None-Match': etag}).code, 304)
+        # Variants have their own ETag
+        response = self.get(**{'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertIsNone(response.headers['Content-Encoding'])
+
+    def test_reload(self):
+        etag = self.get().headers['ETag']
+        self.write_state({'data': {'countries': {'FR': {}}}})
+        self.assertEqual(self.store.reload(), ['/v3/state'])
+        response = self.get(**{'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertIn(b'FR', response.read())
+        # Invalid JSON keeps the previous payload
+        self.write_state(None, text='{"data": ')
+        self.assertEqual(self.store.reload(), [])
+        self.assertIn(b'FR', self.get().read())
+
+    def test_not_found(self):
+        self.url = self.url.replace('state', 'missing')
+        self.assertEqual(self.get().code, 404)
+
+    def test_directories(self):
+        root = self.url.replace('/v3/state', '')
+        # Listing, and redirection of directories to their trailing slash
+        self.url = root + '/v3'
+        response = self.get()
+        self.assertEqual(response.geturl(), root + '/v3/')
+        self.assertIn(b'<a href="state">state</a>', response.read())
+        self.url = root + '/'
+        self.assertIn(b'<a href="v3/">v3/</a>', self.get().read())
+        # Index file
+        with open(os.path.join(self.root, 'public', 'index.html'), 'w') as f:
+            f.write('<html>map</html>')
+        self.store.reload()
+        response = self.get()
+        self.assertEqual(response.headers['Content-Type'], 'text/html')
+        self.assertEqual(response.read(), b'<html>map</html>')
+
+    def test_content_types(self):
+        for name in ['style.css', 'logo.png', 'data.unknown-extension']:
+            with open(os.path.join(self.root, 'public', name), 'wb') as f:
+                f.write(b'content')
+        self.store.reload()
+        root = self.url.replace('/v3/state', '')
+        content_types = []
+        for name in ['style.css', 'logo.png', 'data.unknown-extension']:
+            self.url = root + '/' + name
+            content_types.append(self.get().headers['Content-Type'])
+        self.assertEqual(content_types, ['text/css', 'image/png',
+                                         'application/octet-stream'])
+
+    def test_history(self):
+        store = history.HistoryStore(self.history_root)
+        for i in range(10):
+            store.append('FR', 1514764800 + i * 3600, {'i': i})
+        self.url = self.url.replace(
+            'state', 'history?countryCode=FR&start=2018-01-01T02:00:00Z'
+            '&points=100')
+        response = json.loads(self.get().read().decode('utf-8'))
+        self.assertEqual([d['i'] for d in response['data']],
+                         list(range(2, 10)))
+        self.url = self.url.replace('points=100', 'points=bad')
+        self.assertEqual(self.get().code, 400)
+        # Zones without history get the static file
+        self.url = self.url.replace('FR', 'DE')
+        self.assertEqual(self.get().code, 404)
+
+    def test_long_poll(self):
+        self.url = self.url.replace('state', 'state/deltas?since=0&timeout=0')
+        self.assertEqual(json.loads(self.get().read().decode('utf-8')),
+                         {'sequence': 0, 'deltas': []})
+        for i in range(3):
+            self.delta_log.append([{'op': 'add', 'path': '/%s' % i,
+                                    'value': i}])
+        self.feed.refresh()
+        response = json.loads(self.get().read().decode('utf-8'))
+        self.assertEqual(response['sequence'], 3)
+        self.assertEqual([d['seq'] for d in response['deltas']], [1, 2, 3])
+        # Resuming
+        response = self.get(**{'Last-Event-ID': '2'})
+        self.assertEqual([d['seq'] for d in json.loads(
+            response.read().decode('utf-8'))['deltas']], [3])
+        # Compacted: the client is too far behind
+        for i in range(4):
+            self.delta_log.append([])
+        self.feed.refresh()
+        self.assertEqual(self.get().code, 410)
+
+    def test_stream(self):
+        self.delta_log.append([{'op': 'add', 'path': '/a', 'value': 1}])
+        self.feed.refresh()
+        self.url = self.url.replace('state', 'state/stream')
+        response = self.get(**{'Last-Event-ID': '0'})
+        self.assertEqual(response.headers['Content-Type'],
+                         'text/event-stream')
+        self.assertEqual(response.readline(), b'id: 1\n')
+        self.assertEqual(response.readline(), b'event: patch\n')
+        self.assertEqual(json.loads(response.readline()[len('data: '):]
+                                    .decode('utf-8')),
+                         [{'op': 'add', 'path': '/a', 'value': 1}])
+        self.assertEqual(response.readline(), b'\n')
+        self.delta_log.append([{'op': 'remove', 'path': '/a'}])
+        self.feed.refresh()
+        lines = [response.readline() for _ in range(4)]
+        while lines[0] == b': keepalive\n':
+            lines = lines[2:] + [response.readline() for _ in range(2)]
+        self.assertEqual(lines[:2], [b'id: 2\n', b'event: patch\n'])
+        response.close()
+
+    def test_head(self):
+        # Answered without waiting for deltas
+        for path in ['state/stream', 'state/deltas?since=0']:
+            self.url = self.url.replace('state', path)
+            response = urlopen(Request(self.url, method='HEAD'), timeout=5)
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.read(), b'')
+            self.url = self.url.replace(path, 'state')
+
+
+class DiffTestCase(unittest.TestCase):
+
+    def test_diff_and_apply(self):
+        old = {'countries': {'FR': {'production': {'coal': 1, 'gas': None},
+                                    'exchange': {'DE': 2}},
+                             'DE': {'a/b': [1, 2]}},
+               'datetime': 'x'}
+        new = {'countries': {'FR': {'production': {'coal': 1, 'gas': 3}},
+                             'DE': {'a/b': [1, 2, 3]}, 'BE': {}},
+               'datetime': 'y'}
+        patch = deltas.diff(old, new)
+        self.assertEqual(patch, [
+            {'op': 'add', 'path': '/countries/BE', 'value': {}},
+            {'op': 'replace', 'path': '/countries/DE/a~1b',
+             'value': [1, 2, 3]},
+            {'op': 'remove', 'path': '/countries/FR/exchange'},
+            {'op': 'replace', 'path': '/countries/FR/production/gas',
+             'value': 3},
+            {'op': 'replace', 'path': '/datetime', 'value': 'y'},
+        ])
+        self.assertEqual(deltas.apply(json.loads(json.dumps(old)), patch),
+                         new)
+        self.assertEqual(deltas.diff(new, new), [])
+
+    def test_log_sequence_and_compaction(self):
+        root = tempfile.mkdtemp()
+        try:
+            log = deltas.DeltaLog(os.path.join(root, 'log'), max_entries=2)
+            feed = deltas.DeltaFeed(log.path)
+            self.assertEqual(feed.since(0), [])
+            self.assertEqual([log.append([]) for _ in range(5)],
+                             [1, 2, 3, 4, 5])
+            self.assertTrue(feed.refresh())
+            self.assertFalse(feed.refresh())
+            self.assertEqual([e['seq'] for e in feed.since(3)], [4, 5])
+            self.assertIsNone(feed.since(1))
+            self.assertIsNone(feed.since(6))
+            self.assertEqual(feed.wait_since(5, 0), [])
+            # Another writer resumes the sequence of the log
+            log = deltas.DeltaLog(log.path, max_entries=2)
+            self.assertEqual(log.last_seq(), 5)
+            self.assertEqual(log.append([]), 6)
+            feed.refresh()
+            self.assertEqual([e['seq'] for e in feed.since(4)], [5, 6])
+        finally:
+            shutil.rmtree(root)
+
+
+class HistoryStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = history.HistoryStore(self.root)
+        # Two days of 15 minutes datapoints
+        self.start = 1514764800  # 2018-01-01T00:00:00Z
+        for i in range(2 * 96):
+            self.store.append('FR', self.start + i * 900, {'i': i})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_partitions(self):
+        self.assertEqual(self.store.zones(), ['FR'])
+        self.assertEqual(self.store.days('FR'), ['2018-01-01', '2018-01-02'])
+
+    def test_query(self):
+        # Defaults to the last 24 hours, both ends included
+        data = self.store.query('FR', max_points=None)
+        self.assertEqual([d['i'] for d in data], list(range(95, 192)))
+        data = self.store.query('FR', self.start + 900,
+                                self.start + 3 * 900)
+        self.assertEqual([d['i'] for d in data], [1, 2, 3])
+        self.assertEqual(self.store.query('DE'), [])
+
+    def test_downsampling(self):
+        data = self.store.query('FR', self.start, self.start + 2 * 86400,
+                                max_points=24)
+        self.assertEqual(len(data), 24)
+        self.assertEqual(data[-1]['i'], 191)
+        # Datapoints appended later are read again
+        self.store.append('FR', self.start + 2 * 96 * 900, {'i': 192})
+        self.assertEqual(self.store.query('FR', max_points=1)[0]['i'], 192)
+
+
+if __name__ == '__main__':
+    unittest.main()
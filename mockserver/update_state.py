@@ -10,151 +10,122 @@ PYTHONPATH=. python3 mockserver/update_state.py <zone_name>
 Args:
 <zone_name> - required zone in ISO 3166-1 format, pass <all> for every zone.
 
-Any errors raised by parsers will be printed to the commandline in full, but
-will not stop the following execution of other parsers.
+Parsers are run concurrently (see utils/fleet.py), so a full refresh takes
+about as long as the slowest source. Parsers exceeding their timeout are
+abandoned. Any errors raised by parsers will be printed to the commandline in
+full, but will not stop the execution of other parsers. The state of each
+independent grid is written as soon as all its parsers have finished, with
+carbon intensities computed by flow tracing (see utils/carbon.py), and
+appended to the history of its zones (see mockserver/history.py). The
+changes to the state are published as a delta (see mockserver/deltas.py).
 """
 
 
 import arrow
-import importlib
+import copy
 import json
-import pprint
-from random import random
+import logging
+import os
 import sys
-import traceback
+import threading
 
+from mockserver import deltas
+from mockserver.history import HistoryStore
+from utils import carbon, fleet
+from utils.config import ZONES_CONFIG, EXCHANGES_CONFIG
 
-pp = pprint.PrettyPrinter(indent=2)
+HISTORY_STORE = HistoryStore('mockserver/history')
+DELTA_LOG = deltas.DeltaLog('mockserver/deltas/state.jsonl')
+# Grids are published from concurrent threads (see fleet.collect), the state,
+# deltas and history are written by one at a time
+PUBLISH_LOCK = threading.Lock()
 
-# Read parser import list from config jsons
-with open('config/zones.json') as zc:
-    zones_config = json.load(zc)
-with open('config/exchanges.json') as ec:
-    exchanges_config = json.load(ec)
+logging.basicConfig(format='%(message)s', level=logging.INFO)
 
 # Read zone_name from commandline
 if not len(sys.argv) > 1:
     raise Exception('Missing argument <zone_name>')
 
 if sys.argv[1] == 'all':
-    zone_names = list(zones_config.keys())
-    zone_config = zones_config
+    zone_names = list(ZONES_CONFIG.keys())
+    exchange_parser_keys = list(EXCHANGES_CONFIG.keys())
 else:
     zone_names = [sys.argv[1]]
-    zone_config = zones_config
-
-exchange_parser_keys = set()
-for k in exchanges_config.keys():
-    if sys.argv[1] == 'all':
-        exchange_parser_keys = list(exchanges_config.keys())
-        break
-    zones = k.split('->')
-    for zone_name in zone_names:
-        if zone_name in zones:
-            exchange_parser_keys.add(k)
-
-# Import / run production parser
-production_datapoints = []
-for k in zone_names:
-    try:
-        production_parser = zone_config[k]['parsers']['production']
-    except KeyError as e:
-        # There is no production parser for this zone.
-        print('No production parser found for {}'.format(k))
-        continue
-
-    mod_name, fun_name = production_parser.split('.')
-
-    print('Finding and executing %s production parser %s..' % (k,
-                                                              production_parser))
-
-    try:
-        mod = importlib.import_module('parsers.%s' % mod_name)
-        production = getattr(mod, fun_name)(k)
-        if type(production) == list:
-            production = production[-1]
-        if production is not None:
-            production_datapoints.append(production)
-        pp.pprint(production)
-    except Exception as e:
-        traceback.print_exc()
-
-# Import / run exchange parser(s)
-exchanges = []
-for k in exchange_parser_keys:
-    try:
-        exchange_parser = exchanges_config[k]['parsers']['exchange']
-    except KeyError as e:
-        # There is no exchange implemented yet.
-        print('No exchange parser found for {}'.format(k))
-        continue
-
-    mod_name, fun_name = exchange_parser.split('.')
-
-    try:
-        mod = importlib.import_module('parsers.%s' % mod_name)
-        sorted_zone_names = sorted(k.split('->'))
-        exchange = getattr(mod, fun_name)(sorted_zone_names[0], sorted_zone_names[1])
-        if type(exchange) == list:
-            exchange = exchange[-1]
-        if not exchange:
-            print('Warning: no exchange data returned by %s' % k)
-        else:
-            exchanges.append(exchange)
-            print('Collected %s' % k)
-            # pp.pprint(exchange)
-    except Exception as e:
-        print('Error collecting %s' % k)
-        traceback.print_exc()
-
-# Load and update state
-print('Updating and writing state..')
-with open('mockserver/public/v3/state', 'r') as f:
-    obj = json.load(f)['data']
+    exchange_parser_keys = fleet.exchange_keys_for_zones(zone_names)
+
+
+def publish(component, collected):
+    """Computes the carbon intensities of a grid and writes it to the state"""
+    production_datapoints = collected['production']
+    exchanges = collected['exchange']
+    intensities = carbon.compute_intensities(production_datapoints,
+                                             exchanges)
+
+    with PUBLISH_LOCK:
+        _write_state(component, production_datapoints, exchanges,
+                     intensities)
+
+
+def _write_state(component, production_datapoints, exchanges, intensities):
+    # Load and update state
+    print('Updating and writing state of grid %s..' % component)
+    with open('mockserver/public/v3/state', 'r') as f:
+        obj = json.load(f)['data']
+        previous = copy.deepcopy(obj)
+        for dp in production_datapoints:
+            production = dict(dp)
+            obj['countries'][dp['zoneKey']] = production
+            # Update production
+            production['datetime'] = arrow.get(production['datetime']).isoformat()
+            # Set flow-traced co2 value
+            production['co2intensity'] = intensities['zones'].get(dp['zoneKey'])
+            # Set aggregates
+            production['maxProduction'] = max([x or 0 for x in production['production'].values()])
+            production['totalProduction'] = sum([x or 0 for x in production['production'].values()])
+
+        # Update exchanges
+        for e in exchanges:
+            exchange_zone_names = e['sortedZoneKeys'].split('->')
+            e['datetime'] = arrow.get(e['datetime']).isoformat()
+            obj['exchanges'][e['sortedZoneKeys']] = e.copy()
+
+            # Intensity of the exchanged power, i.e. of its origin zone in
+            # this same solution, seen by both zones
+            exchange_intensity = intensities['exchanges'].get(e['sortedZoneKeys'])
+            obj['exchanges'][e['sortedZoneKeys']]['co2intensity'] = exchange_intensity
+
+            for z in exchange_zone_names:
+                other_zone = exchange_zone_names[(exchange_zone_names.index(z) + 1) % 2]
+                if z not in obj['countries']:
+                    obj['countries'][z] = {}
+                if 'exchange' not in obj['countries'][z]:
+                    obj['countries'][z]['exchange'] = {}
+                if 'exchangeCo2Intensities' not in obj['countries'][z]:
+                    obj['countries'][z]['exchangeCo2Intensities'] = {}
+                obj['countries'][z]['exchange'][other_zone] = e['netFlow']
+                if z == exchange_zone_names[0]:
+                    obj['countries'][z]['exchange'][other_zone] *= -1
+                obj['countries'][z]['exchangeCo2Intensities'][other_zone] = exchange_intensity
+
+        # Set state datetime
+        obj['datetime'] = arrow.now('Europe/Amsterdam').isoformat()
+
+    # Publish the changes, then the state at their sequence number
+    sequence = DELTA_LOG.append(deltas.diff(previous, obj))
+
+    # Save atomically: the mockserver reloads the state as soon as it changes
+    with open('mockserver/public/v3/state.tmp', 'w') as f:
+        json.dump({'data': obj, 'sequence': sequence}, f)
+    os.replace('mockserver/public/v3/state.tmp', 'mockserver/public/v3/state')
+
+    # Append the new zone states to the history served under v3/history
     for dp in production_datapoints:
-        production = dict(dp)
-        obj['countries'][dp['zoneKey']] = production
-        # Update production
-        production['datetime'] = arrow.get(production['datetime']).isoformat()
-        # Set random co2 value
-        production['co2intensity'] = random() * 800
-        # Set aggregates
-        production['maxProduction'] = max([x or 0 for x in production['production'].values()])
-        production['totalProduction'] = sum([x or 0 for x in production['production'].values()])
-
-    # Update exchanges
-    for e in exchanges:
-        exchange_zone_names = e['sortedZoneKeys'].split('->')
-        e['datetime'] = arrow.get(e['datetime']).isoformat()
-        obj['exchanges'][e['sortedZoneKeys']] = e.copy()
-
-        export_origin_zone_name = exchange_zone_names[0] if e['netFlow'] >= 0 else exchange_zone_names[1]
-        obj['exchanges'][e['sortedZoneKeys']]['co2intensity'] = \
-            obj['countries'].get(export_origin_zone_name, {}).get('co2intensity')
-
-        for z in exchange_zone_names:
-            other_zone = exchange_zone_names[(exchange_zone_names.index(z) + 1) % 2]
-            if z not in obj['countries']:
-                obj['countries'][z] = {}
-            if 'exchange' not in obj['countries'][z]:
-                obj['countries'][z]['exchange'] = {}
-            if 'exchangeCo2Intensities' not in obj['countries'][z]:
-                obj['countries'][z]['exchangeCo2Intensities'] = {}
-            obj['countries'][z]['exchange'][other_zone] = e['netFlow']
-            if z == exchange_zone_names[0]:
-                obj['countries'][z]['exchange'][other_zone] *= -1
-
-            # Use this zone's carbon intensity if it's an export, or if exchange is missing
-            is_import = other_zone == export_origin_zone_name
-            obj['countries'][z]['exchangeCo2Intensities'][other_zone] = \
-                obj['countries'].get(other_zone, {}).get('co2intensity',
-                    obj['countries'][z].get('co2intensity', None)) if is_import \
-                else obj['countries'][z].get('co2intensity', None)
-
-    # Set state datetime
-    obj['datetime'] = arrow.now('Europe/Amsterdam').isoformat()
-
-# Save
-with open('mockserver/public/v3/state', 'w') as f:
-    json.dump({'data': obj}, f)
-print('..done')
+        HISTORY_STORE.append(dp['zoneKey'],
+                             arrow.get(dp['datetime']).float_timestamp,
+                             obj['countries'][dp['zoneKey']])
+    print('..done')
+
+
+# Run all production and exchange parsers concurrently, each grid being
+# published as soon as its parsers are done
+fleet.collect(zone_names, exchange_parser_keys, on_component=publish)
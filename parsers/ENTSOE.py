@@ -14,16 +14,18 @@ Consumption Forecast
 """
 import numpy as np
 from bs4 import BeautifulSoup
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from io import BytesIO
 
 import arrow
-import logging, os, re
+import json, logging, math, os, re, threading, time
 import requests
 
+from lxml import etree
 import pandas as pd
 
-from .lib.validation import validate
-from .lib.utils import sum_production_dicts
+from .lib.validation import compile_rules, filter_valid, validate_batch
 
 ENTSOE_ENDPOINT = 'https://transparency.entsoe.eu/api'
 ENTSOE_PARAMETER_DESC = {
@@ -66,7 +68,8 @@ ENTSOE_PARAMETER_GROUPS = {
         'hydro storage': ['B10']
     }
 }
-ENTSOE_PARAMETER_BY_GROUP = {v: k for k, g in ENTSOE_PARAMETER_GROUPS.items() for v in g}
+ENTSOE_PARAMETER_BY_GROUP = {v: k for g in ENTSOE_PARAMETER_GROUPS.values()
+                             for k, vs in g.items() for v in vs}
 # Define all ENTSOE zone_key <-> domain mapping
 # see https://transparency.entsoe.eu/content/static_content/Static%20content/web%20api/Guide.html
 ENTSOE_DOMAIN_MAPPINGS = {
@@ -268,6 +271,9 @@ ENTSOE_UNITS_TO_ZONE = {
     'Ãbyverket Ãrebro': 'SE',
 }
 
+# Number of psr types queried concurrently by fetch_production_per_units
+PER_UNITS_MAX_WORKERS = 10
+
 VALIDATIONS = {
     # This is a list of criteria to ensure validity of data,
     # used in validate_production()
@@ -386,27 +392,159 @@ def check_response(response, function_name):
             raise QueryError('{0} failed in ENTSOE.py. Reason: {1}'.format(function_name, response.text))
 
 
-def query_ENTSOE(session, params, target_datetime=None, span=(-48, 24)):
+class DocumentCache(object):
+    """
+    Thread-safe cache of ENTSOE responses, keyed by normalized query params.
+
+    Composite parsers (e.g. NL) query the same documents as the standalone
+    zone and exchange parsers run in the same cycle. Successful responses are
+    kept for `ttl` seconds, so those documents are only downloaded (and
+    parsed, see `parsed`) once. Concurrent identical queries wait for the
+    first one instead of hitting the API again.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> [lock, number of callers using it], removed when unused
+        self._key_locks = {}
+        self._responses = {}  # key -> (expires_at, response)
+        self._parsed = {}  # (parse function, kwargs, document) -> (expires_at, result)
+
+    @staticmethod
+    def make_key(params):
+        """Query params, without the API token, as a hashable key."""
+        return tuple(sorted((k, v) for k, v in params.items()
+                            if k != 'securityToken'))
+
+    @staticmethod
+    def _prune(entries, now):
+        """Removes expired entries"""
+        expired = [k for k, (expires_at, _) in entries.items()
+                   if expires_at <= now]
+        for key in expired:
+            del entries[key]
+
+    def get_or_fetch(self, params, fetch):
+        """
+        Returns the cached response to `params`, or calls `fetch()` and caches
+        its response if it is successful.
+        """
+        key = self.make_key(params)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                entry = self._responses.get(key)
+                if entry is not None and entry[0] > time.time():
+                    return entry[1]
+                response = fetch()
+                if response.ok:
+                    # Read the body now so that it can be shared between callers
+                    response.content
+                    with self._lock:
+                        now = time.time()
+                        self._prune(self._responses, now)
+                        self._responses[key] = (now + self.ttl, response)
+                return response
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[key]
+
+    def parsed(self, parse_function, xml_text, **kwargs):
+        """
+        Returns `parse_function(xml_text, **kwargs)`, reusing the result of an
+        identical call made less than `ttl` seconds ago.
+        The result is shared and must not be modified.
+        """
+        if not xml_text:
+            return parse_function(xml_text, **kwargs)
+        key = (parse_function, tuple(sorted(kwargs.items())), xml_text)
+        now = time.time()
+        with self._lock:
+            entry = self._parsed.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        result = parse_function(xml_text, **kwargs)
+        with self._lock:
+            self._prune(self._parsed, now)
+            self._parsed[key] = (now + self.ttl, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._responses = {}
+            self._parsed = {}
+
+
+# Shared by all ENTSOE queries of the process. Documents are fetched again
+# after 3 minutes, to pick up the latest datapoints.
+ENTSOE_CACHE = DocumentCache(ttl=180)
+
+
+class RateLimiter(object):
+    """Spaces out calls so that at most `max_calls` start every `period` seconds."""
+
+    def __init__(self, max_calls, period):
+        self.interval = float(period) / max_calls
+        self._lock = threading.Lock()
+        self._next_call = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+# ENTSOE allows 400 queries per minute and per token
+ENTSOE_RATE_LIMITER = RateLimiter(max_calls=400, period=60)
+
+
+def query_ENTSOE(session, params, target_datetime=None, span=(-48, 24),
+                 period=None, cache=ENTSOE_CACHE):
     """
     Makes a standard query to the ENTSOE API with a modifiable set of parameters.
     Allows an existing session to be passed.
+    The queried period is `span` (in hours) around `target_datetime`, unless
+    an explicit (start, end) `period` is given.
+    Successful responses are cached in `cache` (see DocumentCache).
+    Queries sent upstream are spaced by ENTSOE_RATE_LIMITER.
     Raises an exception if no API token is found.
     Returns a request object.
     """
-    if target_datetime is None:
-        target_datetime = arrow.utcnow()
+    if period is not None:
+        period_start, period_end = [arrow.get(dt).to('UTC') for dt in period]
     else:
-        # make sure we have an arrow object
-        target_datetime = arrow.get(target_datetime)
-    params['periodStart'] = target_datetime.shift(hours=span[0]).format('YYYYMMDDHH00')
-    params['periodEnd'] = target_datetime.shift(hours=span[1]).format('YYYYMMDDHH00')
+        if target_datetime is None:
+            target_datetime = arrow.utcnow()
+        else:
+            # make sure we have an arrow object
+            target_datetime = arrow.get(target_datetime)
+        period_start = target_datetime.shift(hours=span[0])
+        period_end = target_datetime.shift(hours=span[1])
+    params['periodStart'] = period_start.format('YYYYMMDDHH00')
+    params['periodEnd'] = period_end.format('YYYYMMDDHH00')
     if 'ENTSOE_TOKEN' not in os.environ:
         raise Exception('No ENTSOE_TOKEN found! Please add it into secrets.env!')
     params['securityToken'] = os.environ['ENTSOE_TOKEN']
-    return session.get(ENTSOE_ENDPOINT, params=params)
 
+    def fetch():
+        ENTSOE_RATE_LIMITER.wait()
+        return session.get(ENTSOE_ENDPOINT, params=params)
+
+    if cache is None:
+        return fetch()
+    return cache.get_or_fetch(params, fetch)
 
-def query_consumption(domain, session, target_datetime=None):
+
+def query_consumption(domain, session, target_datetime=None, period=None,
+                      cache=ENTSOE_CACHE):
     """Returns a string object if the query succeeds."""
 
     params = {
@@ -414,21 +552,24 @@ def query_consumption(domain, session, target_datetime=None):
         'processType': 'A16',
         'outBiddingZone_Domain': domain,
     }
-    response = query_ENTSOE(session, params, target_datetime=target_datetime)
+    response = query_ENTSOE(session, params, target_datetime=target_datetime,
+                            period=period, cache=cache)
     if response.ok:
         return response.text
     else:
         check_response(response, query_consumption.__name__)
 
 
-def query_production(in_domain, session, target_datetime=None):
+def query_production(in_domain, session, target_datetime=None, period=None,
+                     cache=ENTSOE_CACHE):
     """Returns a string object if the query succeeds."""
     params = {
         'documentType': 'A75',
         'processType': 'A16',  # Realised
         'in_Domain': in_domain,
     }
-    response = query_ENTSOE(session, params, target_datetime=target_datetime, span=(-48, 0))
+    response = query_ENTSOE(session, params, target_datetime=target_datetime, span=(-48, 0),
+                            period=period, cache=cache)
     if response.ok:
         return response.text
     else:
@@ -452,7 +593,8 @@ def query_production_per_units(psr_type, domain, session, target_datetime=None):
         check_response(response, query_production_per_units.__name__)
 
 
-def query_exchange(in_domain, out_domain, session, target_datetime=None):
+def query_exchange(in_domain, out_domain, session, target_datetime=None,
+                   period=None, cache=ENTSOE_CACHE):
     """Returns a string object if the query succeeds."""
 
     params = {
@@ -460,7 +602,8 @@ def query_exchange(in_domain, out_domain, session, target_datetime=None):
         'in_Domain': in_domain,
         'out_Domain': out_domain,
     }
-    response = query_ENTSOE(session, params, target_datetime=target_datetime)
+    response = query_ENTSOE(session, params, target_datetime=target_datetime,
+                            period=period, cache=cache)
     if response.ok:
         return response.text
     else:
@@ -555,113 +698,274 @@ def query_wind_solar_production_forecast(in_domain, session, target_datetime=Non
         check_response(response, query_generation_forecast.__name__)
 
 
-def datetime_from_position(start, position, resolution):
-    """Finds time granularity of data."""
+def resolution_to_timedelta(resolution):
+    """Converts an ENTSOE resolution (e.g. PT15M) into a timedelta."""
 
     m = re.search(r'PT(\d+)([M])', resolution)
     if m:
         digits = int(m.group(1))
         scale = m.group(2)
         if scale == 'M':
-            return start.replace(minutes=(position - 1) * digits)
+            return timedelta(minutes=digits)
     raise NotImplementedError('Could not recognise resolution %s' % resolution)
 
 
+def datetime_from_position(start, position, resolution):
+    """Finds time granularity of data."""
+
+    return start + (position - 1) * resolution_to_timedelta(resolution)
+
+
+def _local_name(element):
+    """Returns the tag of an element without its namespace."""
+    return element.tag.rpartition('}')[2]
+
+
+def _read_period(period):
+    """Returns a list of (datetime, value) tuples for all points of a Period."""
+    start = step = None
+    positions_and_values = []
+    for child in period:
+        name = _local_name(child)
+        if name == 'timeInterval':
+            for interval_child in child:
+                if _local_name(interval_child) == 'start':
+                    start = arrow.get(interval_child.text)
+        elif name == 'resolution':
+            step = resolution_to_timedelta(child.text)
+        elif name == 'Point':
+            position = value = None
+            for point_child in child:
+                point_name = _local_name(point_child)
+                if point_name == 'position':
+                    position = int(point_child.text)
+                elif point_name in ('quantity', 'price.amount'):
+                    value = float(point_child.text)
+            positions_and_values.append((position, value))
+    return [(start + (position - 1) * step, value)
+            for position, value in positions_and_values]
+
+
+def _read_timeseries(timeseries):
+    """Reads a TimeSeries element into a dict, see `iter_timeseries`."""
+    series = {
+        'in_domain': False,
+        'out_domain': False,
+        'psr_type': None,
+        'unit_key': None,
+        'unit_name': None,
+        'currency': None,
+        'points': [],
+    }
+    for child in timeseries:
+        name = _local_name(child)
+        if name == 'inBiddingZone_Domain.mRID':
+            series['in_domain'] = True
+        elif name == 'outBiddingZone_Domain.mRID':
+            series['out_domain'] = True
+        elif name == 'currency_Unit.name':
+            series['currency'] = child.text
+        elif name == 'MktPSRType':
+            for psr_child in child:
+                psr_name = _local_name(psr_child)
+                if psr_name == 'psrType':
+                    series['psr_type'] = psr_child.text
+                elif psr_name == 'PowerSystemResources':
+                    for resource_child in psr_child:
+                        resource_name = _local_name(resource_child)
+                        if resource_name == 'mRID':
+                            series['unit_key'] = resource_child.text
+                        elif resource_name == 'name':
+                            series['unit_name'] = resource_child.text
+        elif name == 'Period':
+            series['points'].extend(_read_period(child))
+    return series
+
+
+def iter_timeseries(xml_text):
+    """
+    Streams the TimeSeries of an ENTSOE XML document.
+
+    The document is parsed incrementally (whatever its namespace) and every
+    TimeSeries element is discarded once read, so that memory use does not
+    grow with the size of the document.
+    Yields one dict per TimeSeries, with keys
+      in_domain, out_domain: whether the series has an
+        inBiddingZone_Domain.mRID / outBiddingZone_Domain.mRID
+      psr_type, unit_key, unit_name, currency: strings, or None if absent
+      points: list of (datetime, value), where value is the quantity (or
+        price.amount) of the point. Datetimes are computed from the start and
+        resolution of each Period.
+    """
+    if isinstance(xml_text, str):
+        xml_text = xml_text.encode('utf-8')
+    events = etree.iterparse(BytesIO(xml_text), events=('end',),
+                             tag='{*}TimeSeries', remove_comments=True)
+    for _, timeseries in events:
+        series = _read_timeseries(timeseries)
+        timeseries.clear()
+        # Also drop the references kept by the root to previous series
+        while timeseries.getprevious() is not None:
+            del timeseries.getparent()[0]
+        yield series
+
+
 def parse_scalar(xml_text, only_inBiddingZone_Domain=False, only_outBiddingZone_Domain=False):
     """Returns a tuple containing two lists."""
 
     if not xml_text:
         return None
-    soup = BeautifulSoup(xml_text, 'html.parser')
     # Get all points
     values = []
     datetimes = []
-    for timeseries in soup.find_all('timeseries'):
-        resolution = timeseries.find_all('resolution')[0].contents[0]
-        datetime_start = arrow.get(timeseries.find_all('start')[0].contents[0])
+    for series in iter_timeseries(xml_text):
         if only_inBiddingZone_Domain:
-            if not len(timeseries.find_all('inBiddingZone_Domain.mRID'.lower())):
+            if not series['in_domain']:
                 continue
         elif only_outBiddingZone_Domain:
-            if not len(timeseries.find_all('outBiddingZone_Domain.mRID'.lower())):
+            if not series['out_domain']:
                 continue
-        for entry in timeseries.find_all('point'):
-            position = int(entry.find_all('position')[0].contents[0])
-            value = float(entry.find_all('quantity')[0].contents[0])
-            datetime = datetime_from_position(datetime_start, position, resolution)
+        for datetime, value in series['points']:
             values.append(value)
             datetimes.append(datetime)
     return values, datetimes
 
 
+class TimeSeriesAccumulator(object):
+    """
+    Sums values per datetime and key (e.g. PSR type).
+
+    Rows are looked up through a dict indexed by datetime, so accumulating a
+    document is linear in its number of points. Rows are kept in order of
+    first appearance.
+    Exchanges are accumulated with the default key (None), as signed sums.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self.datetimes = []
+        self.rows = []
+
+    def __len__(self):
+        return len(self.datetimes)
+
+    def add(self, datetime, value, key=None):
+        i = self._index.get(datetime)
+        if i is None:
+            i = self._index[datetime] = len(self.datetimes)
+            self.datetimes.append(datetime)
+            self.rows.append({})
+        row = self.rows[i]
+        row[key] = row.get(key, 0) + value
+
+    def keys(self):
+        """Returns all keys, in order of first appearance."""
+        keys = {}
+        for row in self.rows:
+            for key in row:
+                keys.setdefault(key, None)
+        return list(keys)
+
+    def values(self, key=None):
+        """Returns the list of values of `key` (None if missing at a datetime)."""
+        return [row.get(key) for row in self.rows]
+
+    def to_array(self, keys=None):
+        """
+        Returns a (len(self) x len(keys)) float ndarray, with NaN for missing
+        values. Keys default to `self.keys()`.
+        """
+        keys = self.keys() if keys is None else keys
+        array = np.full((len(self.rows), len(keys)), np.nan)
+        columns = {key: j for j, key in enumerate(keys)}
+        for i, row in enumerate(self.rows):
+            for key, value in row.items():
+                j = columns.get(key)
+                if j is not None:
+                    array[i, j] = value
+        return array
+
+    def to_frame(self, keys=None):
+        """Returns a DataFrame indexed by datetime, with one column per key."""
+        keys = self.keys() if keys is None else keys
+        return pd.DataFrame(
+            self.to_array(keys), columns=keys,
+            index=pd.DatetimeIndex([dt.datetime for dt in self.datetimes],
+                                   name='datetime'))
+
+
+def accumulate_production(xml_text, accumulator=None):
+    """
+    Sums production per datetime and PSR type into a TimeSeriesAccumulator.
+    Consumption (e.g. of pumped storage) is counted negatively.
+    """
+
+    if not xml_text:
+        return None
+    if accumulator is None:
+        accumulator = TimeSeriesAccumulator()
+    for series in iter_timeseries(xml_text):
+        sign = 1 if series['in_domain'] else -1
+        psr_type = series['psr_type']
+        for datetime, quantity in series['points']:
+            accumulator.add(datetime, sign * quantity, psr_type)
+    return accumulator
+
+
 def parse_production(xml_text):
     """Returns a tuple containing two lists."""
 
-    if not xml_text:
+    accumulator = accumulate_production(xml_text)
+    if accumulator is None:
         return None
-    soup = BeautifulSoup(xml_text, 'html.parser')
-    # Get all points
-    productions = []
-    datetimes = []
-    for timeseries in soup.find_all('timeseries'):
-        resolution = timeseries.find_all('resolution')[0].contents[0]
-        datetime_start = arrow.get(timeseries.find_all('start')[0].contents[0])
-        is_production = len(timeseries.find_all('inBiddingZone_Domain.mRID'.lower())) > 0
-        psr_type = timeseries.find_all('mktpsrtype')[0].find_all('psrtype')[0].contents[0]
-        for entry in timeseries.find_all('point'):
-            quantity = float(entry.find_all('quantity')[0].contents[0])
-            position = int(entry.find_all('position')[0].contents[0])
-            datetime = datetime_from_position(datetime_start, position, resolution)
-            try:
-                i = datetimes.index(datetime)
-                if is_production:
-                    productions[i][psr_type] += quantity
-                else:
-                    productions[i][psr_type] -= quantity
-            except ValueError:  # Not in list
-                datetimes.append(datetime)
-                productions.append(defaultdict(lambda: 0))
-                productions[-1][psr_type] = quantity if is_production else -1 * quantity
-    return productions, datetimes
+    return accumulator.rows, accumulator.datetimes
 
 
 def parse_production_per_units(xml_text):
-    """Returns a dict indexed by the (datetime, unit_key) key"""
+    """
+    Returns a list with the production of each unit at each datetime.
+    The zone of each unit is looked up in ENTSOE_UNITS_TO_ZONE and stored as
+    `zoneKey` (None for unknown units).
+    """
     values = {}
 
     if not xml_text:
         return None
-    soup = BeautifulSoup(xml_text, 'html.parser')
     # Get all points
-    for timeseries in soup.find_all('timeseries'):
-        resolution = timeseries.find_all('resolution')[0].contents[0]
-        datetime_start = arrow.get(timeseries.find_all('start')[0].contents[0])
-        is_production = len(timeseries.find_all('inBiddingZone_Domain.mRID'.lower())) > 0
-        psr_type = timeseries.find_all('mktpsrtype')[0].find_all('psrtype')[0].contents[0]
-        unit_key = timeseries.find_all('mktpsrtype')[0].find_all(
-            'powersystemresources')[0].find_all('mrid')[0].contents[0]
-        unit_name = timeseries.find_all('mktpsrtype')[0].find_all(
-            'powersystemresources')[0].find_all('name')[0].contents[0]
-        if not is_production: continue
-        for entry in timeseries.find_all('point'):
-            quantity = float(entry.find_all('quantity')[0].contents[0])
-            position = int(entry.find_all('position')[0].contents[0])
-            datetime = datetime_from_position(datetime_start, position, resolution)
+    for series in iter_timeseries(xml_text):
+        if not series['in_domain']:
+            continue
+        unit_key = series['unit_key']
+        unit = {
+            'productionType': ENTSOE_PARAMETER_BY_GROUP[series['psr_type']],
+            'unitKey': unit_key,
+            'unitName': series['unit_name'],
+            'zoneKey': ENTSOE_UNITS_TO_ZONE.get(series['unit_name']),
+        }
+        for datetime, quantity in series['points']:
             key = (unit_key, datetime)
             if key in values:
-                if is_production:
-                    values[key]['production'] += quantity
-                else:
-                    values[key]['production'] -= quantity
+                values[key]['production'] += quantity
             else:
-                values[key] = {
-                    'datetime': datetime,
-                    'production': quantity,
-                    'productionType': ENTSOE_PARAMETER_BY_GROUP[psr_type],
-                    'unitKey': unit_key,
-                    'unitName': unit_name
-                }
-    return values.values()
+                values[key] = dict(unit, datetime=datetime, production=quantity)
+    return list(values.values())
+
+
+def accumulate_exchange(xml_text, is_import, accumulator=None):
+    """
+    Sums the net flow per datetime into a TimeSeriesAccumulator.
+    Exports (`is_import=False`) are counted negatively.
+    """
+
+    if not xml_text:
+        return None
+    if accumulator is None:
+        accumulator = TimeSeriesAccumulator()
+    sign = 1 if is_import else -1
+    for series in iter_timeseries(xml_text):
+        for datetime, quantity in series['points']:
+            accumulator.add(datetime, sign * quantity)
+    return accumulator
 
 
 def parse_exchange(xml_text, is_import, quantities=None, datetimes=None):
@@ -669,27 +973,11 @@ def parse_exchange(xml_text, is_import, quantities=None, datetimes=None):
 
     if not xml_text:
         return None
-    quantities = quantities or []
-    datetimes = datetimes or []
-    soup = BeautifulSoup(xml_text, 'html.parser')
-    # Get all points
-    for timeseries in soup.find_all('timeseries'):
-        resolution = timeseries.find_all('resolution')[0].contents[0]
-        datetime_start = arrow.get(timeseries.find_all('start')[0].contents[0])
-        for entry in timeseries.find_all('point'):
-            quantity = float(entry.find_all('quantity')[0].contents[0])
-            if not is_import:
-                quantity *= -1
-            position = int(entry.find_all('position')[0].contents[0])
-            datetime = datetime_from_position(datetime_start, position, resolution)
-            # Find out whether or not we should update the net production
-            try:
-                i = datetimes.index(datetime)
-                quantities[i] += quantity
-            except ValueError:  # Not in list
-                quantities.append(quantity)
-                datetimes.append(datetime)
-    return quantities, datetimes
+    accumulator = TimeSeriesAccumulator()
+    for datetime, quantity in zip(datetimes or [], quantities or []):
+        accumulator.add(datetime, quantity)
+    accumulate_exchange(xml_text, is_import, accumulator)
+    return accumulator.values(), accumulator.datetimes
 
 
 def parse_price(xml_text):
@@ -697,19 +985,14 @@ def parse_price(xml_text):
 
     if not xml_text:
         return None
-    soup = BeautifulSoup(xml_text, 'html.parser')
     # Get all points
     prices = []
     currencies = []
     datetimes = []
-    for timeseries in soup.find_all('timeseries'):
-        currency = timeseries.find_all('currency_unit.name')[0].contents[0]
-        resolution = timeseries.find_all('resolution')[0].contents[0]
-        datetime_start = arrow.get(timeseries.find_all('start')[0].contents[0])
-        for entry in timeseries.find_all('point'):
-            position = int(entry.find_all('position')[0].contents[0])
-            datetime = datetime_from_position(datetime_start, position, resolution)
-            prices.append(float(entry.find_all('price.amount')[0].contents[0]))
+    for series in iter_timeseries(xml_text):
+        currency = series['currency']
+        for datetime, price in series['points']:
+            prices.append(price)
             datetimes.append(datetime)
             currencies.append(currency)
     return prices, currencies, datetimes
@@ -727,20 +1010,81 @@ def validate_production(datapoint, logger):
     False if invalid and True otherwise.
     """
 
-    zone_key = datapoint['zoneKey']
+    rules = production_validation_rules(datapoint['zoneKey'])
+    if rules is None:
+        return True
+    keep, _ = validate_batch([datapoint], rules, logger)
+    if keep[0]:
+        return datapoint
+
+
+def production_validation_rules(zone_key):
+    """
+    Returns the ValidationRules used by `validate_production` for
+    `zone_key`, or None if its datapoints are not checked.
+    """
 
     validation_criteria = VALIDATIONS.get(zone_key, {})
 
     if validation_criteria:
-        return validate(datapoint, logger=logger, **validation_criteria)
+        return compile_rules(**validation_criteria)
 
     if zone_key.startswith('DK-'):
-        return validate(datapoint, logger=logger, required=['coal', 'solar', 'wind'])
+        return compile_rules(required=['coal', 'solar', 'wind'])
 
     if zone_key.startswith('NO-'):
-        return validate(datapoint, logger=logger, required=['hydro'])
+        return compile_rules(required=['hydro'])
+
+    return None
+
+
+class LastSeenTracker(object):
+    """
+    Remembers the latest datetime delivered per key, e.g. per
+    (zone_key, document type).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_seen = {}
 
-    return True
+    def get(self, key):
+        return self._last_seen.get(key)
+
+    def update(self, key, datetime):
+        with self._lock:
+            last_seen = self._last_seen.get(key)
+            if last_seen is None or datetime > last_seen:
+                self._last_seen[key] = datetime
+
+    def reset(self):
+        with self._lock:
+            self._last_seen = {}
+
+
+LAST_SEEN = LastSeenTracker()
+# Part of the already delivered data queried again in incremental mode,
+# to pick up revisions of the last datapoints
+INCREMENTAL_OVERLAP = timedelta(hours=2)
+
+
+def incremental_period(key, span, overlap=None, tracker=LAST_SEEN):
+    """
+    Returns the (start, end) period to query in order to only get the data
+    missing since the last delivered datapoint of `key`, plus `overlap`
+    (INCREMENTAL_OVERLAP by default).
+    The period never extends beyond `span` (in hours) around now.
+    Returns None when nothing was delivered yet, meaning the whole `span`
+    must be queried.
+    """
+    last_seen = tracker.get(key)
+    if last_seen is None:
+        return None
+    if overlap is None:
+        overlap = INCREMENTAL_OVERLAP
+    now = arrow.utcnow()
+    start = max(arrow.get(last_seen) - overlap, now.shift(hours=span[0]))
+    return start, now.shift(hours=span[1])
 
 
 def get_wind(values):
@@ -749,58 +1093,91 @@ def get_wind(values):
 
 
 def fetch_consumption(zone_key, session=None, target_datetime=None,
-                      logger=logging.getLogger(__name__)):
-    """Gets consumption for a specified zone, returns a dictionary."""
+                      logger=logging.getLogger(__name__), incremental=False,
+                      overlap=None):
+    """
+    Gets consumption for a specified zone, returns a dictionary.
+    In incremental mode, only the data missing since the previous call, plus
+    `overlap` (see `incremental_period`), is queried.
+    """
     if not session:
         session = requests.session()
     domain = ENTSOE_DOMAIN_MAPPINGS[zone_key]
+    incremental = incremental and target_datetime is None
+    period = None
+    if incremental:
+        period = incremental_period((zone_key, 'A65'), span=(-48, 24),
+                                    overlap=overlap)
     # Grab consumption
-    parsed = parse_scalar(
-        query_consumption(domain, session, target_datetime=target_datetime),
+    parsed = ENTSOE_CACHE.parsed(
+        parse_scalar,
+        query_consumption(domain, session, target_datetime=target_datetime,
+                          period=period),
         only_outBiddingZone_Domain=True)
-    if parsed:
-        quantities, datetimes = parsed
+    if parsed and parsed[0]:
+        data = _consumption_datapoints(zone_key, parsed)
+        if incremental:
+            LAST_SEEN.update((zone_key, 'A65'),
+                             max(d['datetime'] for d in data))
 
         # if a target_datetime was requested, we return everything
         if target_datetime:
-            return [{
-                'zoneKey': zone_key,
-                'datetime': dt.datetime,
-                'consumption': quantity,
-                'source': 'entsoe.eu'
-            } for dt, quantity in zip(datetimes, quantities)]
+            return data
 
         # else we keep the last stored value
-        dt, quantity = datetimes[-1].datetime, quantities[-1]
-        data = {
-            'zoneKey': zone_key,
-            'datetime': dt,
-            'consumption': quantity,
-            'source': 'entsoe.eu'
-        }
+        return data[-1]
 
-        return data
+
+def _consumption_datapoints(zone_key, parsed):
+    """Returns consumption datapoints from the output of `parse_scalar`."""
+    quantities, datetimes = parsed
+    return [{
+        'zoneKey': zone_key,
+        'datetime': dt.datetime,
+        'consumption': quantity,
+        'source': 'entsoe.eu'
+    } for dt, quantity in zip(datetimes, quantities)]
 
 
 def fetch_production(zone_key, session=None, target_datetime=None,
-                     logger=logging.getLogger(__name__)):
+                     logger=logging.getLogger(__name__), incremental=False,
+                     overlap=None):
     """
     Gets values and corresponding datetimes for all production types in the
     specified zone. Removes any values that are in the future or don't have
     a datetime associated with them.
+    In incremental mode, only the data missing since the previous call, plus
+    `overlap` (see `incremental_period`), is queried.
     Returns a list of dictionaries that have been validated.
     """
     if not session:
         session = requests.session()
     domain = ENTSOE_DOMAIN_MAPPINGS[zone_key]
+    incremental = incremental and target_datetime is None
+    period = None
+    if incremental:
+        period = incremental_period((zone_key, 'A75'), span=(-48, 0),
+                                    overlap=overlap)
     # Grab production
-    parsed = parse_production(
+    parsed = ENTSOE_CACHE.parsed(
+        parse_production,
         query_production(domain, session,
-                         target_datetime=target_datetime))
+                         target_datetime=target_datetime, period=period))
 
     if not parsed:
         return None
 
+    data = _production_datapoints(zone_key, parsed, logger)
+    if incremental and data:
+        LAST_SEEN.update((zone_key, 'A75'), max(d['datetime'] for d in data))
+    return data
+
+
+def _production_datapoints(zone_key, parsed, logger):
+    """
+    Returns validated production datapoints from the output of
+    `parse_production`.
+    """
     productions, production_dates = parsed
 
     data = []
@@ -833,16 +1210,20 @@ def fetch_production(zone_key, session=None, target_datetime=None,
             'source': 'entsoe.eu'
         })
 
-        for d in data:
-            for k, v in d['production'].items():
-                if v is None: continue
-                if v < 0 and v > -50:
-                    # Set small negative values to 0
-                    logger.warning('Setting small value of %s (%s) to 0.' % (k, v),
-                                   extra={'key': zone_key})
-                    d['production'][k] = 0
-
-    return list(filter(lambda x: validate_production(x, logger), data))
+    for d in data:
+        for k, v in d['production'].items():
+            if v is None: continue
+            if v < 0 and v > -50:
+                # Set small negative values to 0
+                logger.warning('Setting small value of %s (%s) to 0.' % (k, v),
+                               extra={'key': zone_key})
+                d['production'][k] = 0
+
+    # All datapoints are checked at once against the rules of the zone
+    rules = production_validation_rules(zone_key)
+    if rules is None:
+        return data
+    return filter_valid(data, rules, logger)
 
 
 ZONE_KEY_AGGREGATES = {
@@ -856,34 +1237,58 @@ def merge_production_outputs(parser_outputs, merge_zone_key, merge_source=None):
     of corresponding datetimes to create a production list.
     This will drop rows where the datetime is missing in at least a
     parser_output.
+    For a given mode, the sum is None if the mode is None (or missing) in
+    every parser_output. Else, None values count as zero.
     """
     if merge_source is None:
         merge_source = parser_outputs[0][0]['source']
-    prod_and_storage_dfs = [
-        pd.DataFrame(output).set_index('datetime')[['production', 'storage']]
-        for output in parser_outputs
-    ]
-    to_return = prod_and_storage_dfs[0]
-    for prod_and_storage in prod_and_storage_dfs[1:]:
-        # `inner` join drops rows where one of the production is missing
-        to_return = to_return.join(
-            prod_and_storage, how='inner', rsuffix='_other')
-        to_return['production'] = to_return.apply(
-            lambda row: sum_production_dicts(row.production,
-                                             row.production_other),
-            axis=1)
-        to_return['storage'] = to_return.apply(
-            lambda row: sum_production_dicts(row.storage, row.storage_other),
-            axis=1)
-        to_return = to_return[['production', 'storage']]
 
-    return [{
-        'datetime': dt.to_datetime(),
-        'production': row.production,
-        'storage': row.storage,
-        'source': merge_source,
-        'zoneKey': merge_zone_key,
-    } for dt, row in to_return.iterrows()]
+    # Datetimes present in every output, in the order of the first one
+    common = set(d['datetime'] for d in parser_outputs[0])
+    for output in parser_outputs[1:]:
+        common.intersection_update(d['datetime'] for d in output)
+    datetimes = []
+    for d in parser_outputs[0]:
+        if d['datetime'] in common:
+            datetimes.append(d['datetime'])
+            common.discard(d['datetime'])
+    rows = {dt: i for i, dt in enumerate(datetimes)}
+
+    # One numeric column per (production or storage, mode), NaN meaning None
+    columns = {}
+    for output in parser_outputs:
+        for d in output:
+            for key in ['production', 'storage']:
+                for mode in d.get(key) or {}:
+                    columns.setdefault((key, mode), len(columns))
+    values = np.full((len(parser_outputs), len(datetimes), len(columns)),
+                     np.nan)
+    for k, output in enumerate(parser_outputs):
+        for d in output:
+            i = rows.get(d['datetime'])
+            if i is None:
+                continue
+            for key in ['production', 'storage']:
+                for mode, value in (d.get(key) or {}).items():
+                    if value is not None:
+                        values[k, i, columns[(key, mode)]] = value
+
+    totals = np.nansum(values, axis=0)
+    totals[np.isnan(values).all(axis=0)] = np.nan
+
+    data = []
+    for dt, row in zip(datetimes, totals.tolist()):
+        datapoint = {
+            'datetime': dt,
+            'production': {},
+            'storage': {},
+            'source': merge_source,
+            'zoneKey': merge_zone_key,
+        }
+        for (key, mode), j in columns.items():
+            datapoint[key][mode] = None if math.isnan(row[j]) else row[j]
+        data.append(datapoint)
+    return data
 
 
 def fetch_production_aggregate(zone_key, session=None, target_datetime=None,
@@ -891,10 +1296,18 @@ def fetch_production_aggregate(zone_key, session=None, target_datetime=None,
     if zone_key not in ZONE_KEY_AGGREGATES:
         raise ValueError('Unknown aggregate key %s' % zone_key)
 
-    return merge_production_outputs(
-        [fetch_production(k, session, target_datetime, logger)
-         for k in ZONE_KEY_AGGREGATES[zone_key]],
-        zone_key)
+    zone_keys = ZONE_KEY_AGGREGATES[zone_key]
+    if not session:
+        session = requests.session()
+    # Member zones are fetched concurrently
+    with ThreadPoolExecutor(max_workers=len(zone_keys)) as executor:
+        parser_outputs = list(executor.map(
+            lambda k: fetch_production(k, session, target_datetime, logger),
+            zone_keys))
+    if not all(parser_outputs):
+        return None
+
+    return merge_production_outputs(parser_outputs, zone_key)
 
 
 def fetch_production_per_units(zone_key, session=None, target_datetime=None,
@@ -906,25 +1319,28 @@ def fetch_production_per_units(zone_key, session=None, target_datetime=None,
     if not session:
         session = requests.session()
     domain = ENTSOE_EIC_MAPPING[zone_key]
-    data = []
-    # Iterate over all psr types
-    for k in ENTSOE_PARAMETER_DESC.keys():
+
+    def fetch_psr_type(psr_type):
         try:
-            values = parse_production_per_units(
-                query_production_per_units(k, domain, session, target_datetime)) or []
-            for v in values:
-                if not v:
-                    continue
+            return parse_production_per_units(query_production_per_units(
+                psr_type, domain, session, target_datetime)) or []
+        except QueryError:
+            return []
+
+    # Query all psr types concurrently, sharing the session
+    with ThreadPoolExecutor(max_workers=PER_UNITS_MAX_WORKERS) as executor:
+        values_per_psr_type = list(executor.map(fetch_psr_type,
+                                                ENTSOE_PARAMETER_DESC.keys()))
+
+    data = []
+    for values in values_per_psr_type:
+        for v in values:
+            if v['zoneKey'] is None:
+                logger.warning('Unknown unit %s with id %s' % (v['unitName'], v['unitKey']))
+            elif v['zoneKey'] == zone_key:
                 v['datetime'] = v['datetime'].datetime
                 v['source'] = 'entsoe.eu'
-                if not v['unitName'] in ENTSOE_UNITS_TO_ZONE:
-                    logger.warning('Unknown unit %s with id %s' % (v['unitName'], v['unitKey']))
-                else:
-                    v['zoneKey'] = ENTSOE_UNITS_TO_ZONE[v['unitName']]
-                    if v['zoneKey'] == zone_key:
-                        data.append(v)
-        except QueryError:
-            pass
+                data.append(v)
 
     return data
 
@@ -938,6 +1354,13 @@ def fetch_exchange(zone_key1, zone_key2, session=None, target_datetime=None,
     """
     if not session:
         session = requests.session()
+    return _exchange_datapoints(zone_key1, zone_key2, session,
+                                target_datetime=target_datetime)
+
+
+def _exchange_datapoints(zone_key1, zone_key2, session, target_datetime=None,
+                         period=None, cache=ENTSOE_CACHE):
+    """Queries both flow directions and returns exchange datapoints."""
     sorted_zone_keys = sorted([zone_key1, zone_key2])
     key = '->'.join(sorted_zone_keys)
     if key in ENTSOE_EXCHANGE_DOMAIN_OVERRIDE:
@@ -949,18 +1372,21 @@ def fetch_exchange(zone_key1, zone_key2, session=None, target_datetime=None,
     exchange_hashmap = {}
     # Grab exchange
     # Import
-    parsed = parse_exchange(
-        query_exchange(domain1, domain2, session, target_datetime=target_datetime),
+    accumulator = accumulate_exchange(
+        query_exchange(domain1, domain2, session,
+                       target_datetime=target_datetime, period=period,
+                       cache=cache),
         is_import=True)
-    if parsed:
+    if accumulator is not None:
         # Export
-        parsed = parse_exchange(
-            xml_text=query_exchange(domain2, domain1, session, target_datetime=target_datetime),
-            is_import=False, quantities=parsed[0], datetimes=parsed[1])
-        if parsed:
-            quantities, datetimes = parsed
-            for i in range(len(quantities)):
-                exchange_hashmap[datetimes[i]] = quantities[i]
+        accumulator = accumulate_exchange(
+            query_exchange(domain2, domain1, session,
+                           target_datetime=target_datetime, period=period,
+                           cache=cache),
+            is_import=False, accumulator=accumulator)
+        if accumulator is not None:
+            exchange_hashmap = dict(zip(accumulator.datetimes,
+                                        accumulator.values()))
 
     # Remove all dates in the future
     exchange_dates = sorted(set(exchange_hashmap.keys()), reverse=True)
@@ -999,19 +1425,18 @@ def fetch_exchange_forecast(zone_key1, zone_key2, session=None, target_datetime=
     exchange_hashmap = {}
     # Grab exchange
     # Import
-    parsed = parse_exchange(
+    accumulator = accumulate_exchange(
         query_exchange_forecast(domain1, domain2, session, target_datetime=target_datetime),
         is_import=True)
-    if parsed:
+    if accumulator is not None:
         # Export
-        parsed = parse_exchange(
-            xml_text=query_exchange_forecast(domain2, domain1, session,
-                                             target_datetime=target_datetime),
-            is_import=False, quantities=parsed[0], datetimes=parsed[1])
-        if parsed:
-            quantities, datetimes = parsed
-            for i in range(len(quantities)):
-                exchange_hashmap[datetimes[i]] = quantities[i]
+        accumulator = accumulate_exchange(
+            query_exchange_forecast(domain2, domain1, session,
+                                    target_datetime=target_datetime),
+            is_import=False, accumulator=accumulator)
+        if accumulator is not None:
+            exchange_hashmap = dict(zip(accumulator.datetimes,
+                                        accumulator.values()))
 
     # Remove all dates in the future
     sorted_zone_keys = sorted([zone_key1, zone_key2])
@@ -1044,7 +1469,8 @@ def fetch_price(zone_key, session=None, target_datetime=None,
     else:
         domain = ENTSOE_DOMAIN_MAPPINGS[zone_key]
     # Grab consumption
-    parsed = parse_price(query_price(domain, session, target_datetime=target_datetime))
+    parsed = ENTSOE_CACHE.parsed(
+        parse_price, query_price(domain, session, target_datetime=target_datetime))
     if parsed:
         data = []
         prices, currencies, datetimes = parsed
@@ -1070,7 +1496,7 @@ def fetch_generation_forecast(zone_key, session=None, target_datetime=None,
         session = requests.session()
     domain = ENTSOE_DOMAIN_MAPPINGS[zone_key]
     # Grab consumption
-    parsed = parse_scalar(query_generation_forecast(
+    parsed = ENTSOE_CACHE.parsed(parse_scalar, query_generation_forecast(
         domain, session, target_datetime=target_datetime), only_inBiddingZone_Domain=True)
     if parsed:
         data = []
@@ -1096,7 +1522,7 @@ def fetch_consumption_forecast(zone_key, session=None, target_datetime=None,
         session = requests.session()
     domain = ENTSOE_DOMAIN_MAPPINGS[zone_key]
     # Grab consumption
-    parsed = parse_scalar(query_consumption_forecast(
+    parsed = ENTSOE_CACHE.parsed(parse_scalar, query_consumption_forecast(
         domain, session, target_datetime=target_datetime), only_outBiddingZone_Domain=True)
     if parsed:
         data = []
@@ -1124,7 +1550,8 @@ def fetch_wind_solar_forecasts(zone_key, session=None, target_datetime=None,
         session = requests.session()
     domain = ENTSOE_DOMAIN_MAPPINGS[zone_key]
     # Grab production
-    parsed = parse_production(
+    parsed = ENTSOE_CACHE.parsed(
+        parse_production,
         query_wind_solar_production_forecast(domain, session,
                                              target_datetime=target_datetime))
 
@@ -1150,3 +1577,197 @@ def fetch_wind_solar_forecasts(zone_key, session=None, target_datetime=None,
         })
 
     return data
+
+
+# Largest period ENTSOE accepts in a single query, per document type
+ENTSOE_MAX_QUERY_PERIOD = {
+    'A11': timedelta(days=365),  # Exchanges
+    'A65': timedelta(days=365),  # Consumption
+    'A75': timedelta(days=365),  # Production
+}
+# Number of queries run concurrently when fetching a range
+RANGE_MAX_WORKERS = 4
+
+
+def split_period(start, end, max_period):
+    """
+    Splits [start, end) in consecutive (start, end) periods of at most
+    `max_period` (a timedelta). Returns a list of tuples of arrow objects.
+    """
+    start, end = arrow.get(start).to('UTC'), arrow.get(end).to('UTC')
+    # ENTSOE periods have an hourly granularity: the hours of start and end
+    # are covered whole
+    start = start.floor('hour')
+    if end != end.floor('hour'):
+        end = end.floor('hour').shift(hours=1)
+    periods = []
+    while start < end:
+        period_end = min(start + max_period, end)
+        periods.append((start, period_end))
+        start = period_end
+    return periods
+
+
+def _load_checkpoint(checkpoint, identity, logger):
+    """
+    Returns the windows saved in `checkpoint`, if it was saved by a fetch of
+    the same `identity`.
+    """
+    if not checkpoint or not os.path.exists(checkpoint):
+        return {}
+    with open(checkpoint) as f:
+        saved = json.load(f)
+    if saved.get('identity') != identity:
+        logger.warning('Ignoring checkpoint %s, saved by another fetch: %s',
+                       checkpoint, saved.get('identity'))
+        return {}
+    windows = saved['windows']
+    for datapoints in windows.values():
+        for datapoint in datapoints:
+            datapoint['datetime'] = arrow.get(datapoint['datetime']).datetime
+    return windows
+
+
+def _save_checkpoint(checkpoint, identity, windows):
+    serializable = {
+        window: [dict(datapoint, datetime=datapoint['datetime'].isoformat())
+                 for datapoint in datapoints]
+        for window, datapoints in windows.items()
+    }
+    # Write atomically so that an interruption can't corrupt the checkpoint
+    with open(checkpoint + '.tmp', 'w') as f:
+        json.dump({'identity': identity, 'windows': serializable}, f)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+def fetch_range(fetch_period, start, end, max_period, max_workers=RANGE_MAX_WORKERS,
+                checkpoint=None, description=None,
+                logger=logging.getLogger(__name__)):
+    """
+    Fetches all datapoints between `start` and `end`.
+
+    The range is split in periods of at most `max_period`, which are fetched
+    concurrently by calling `fetch_period((period_start, period_end))`,
+    itself returning a list of datapoints. Like all queries, the queries
+    it sends are spaced by ENTSOE_RATE_LIMITER (see `query_ENTSOE`).
+    Results are merged, deduplicated by datetime and sorted.
+
+    If `checkpoint` is the path of a file, the datapoints of every fetched
+    period are saved there, and periods already present in the file are not
+    fetched again. This allows resuming an interrupted backfill.
+    The checkpoint also records `description` (a JSON serializable
+    description of the fetched data, e.g. its zone and document type), the
+    range and `max_period`: a checkpoint saved by a different fetch is
+    ignored.
+    """
+    identity = {
+        'description': description,
+        'start': arrow.get(start).to('UTC').isoformat(),
+        'end': arrow.get(end).to('UTC').isoformat(),
+        'max_period': max_period.total_seconds(),
+    }
+    # Round-tripped through JSON to compare with saved identities
+    identity = json.loads(json.dumps(identity))
+    done = _load_checkpoint(checkpoint, identity, logger)
+    periods = [period for period in split_period(start, end, max_period)
+               if period[0].isoformat() not in done]
+    if done:
+        logger.info('Resuming from checkpoint, %d periods left to fetch',
+                    len(periods))
+
+    def fetch(period):
+        return fetch_period(period) or []
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, period): period for period in periods}
+        for future in as_completed(futures):
+            period = futures[future]
+            try:
+                done[period[0].isoformat()] = future.result()
+            except Exception as e:
+                logger.warning('Could not fetch %s -> %s: %s',
+                               period[0], period[1], e)
+                errors.append(e)
+                continue
+            if checkpoint:
+                _save_checkpoint(checkpoint, identity, done)
+    if errors:
+        # Successful periods are kept in the checkpoint
+        raise errors[0]
+
+    datapoints = {}
+    for window in sorted(done):
+        for datapoint in done[window]:
+            datapoints.setdefault(datapoint['datetime'], datapoint)
+    start, end = arrow.get(start).datetime, arrow.get(end).datetime
+    return [datapoints[dt] for dt in sorted(datapoints) if start <= dt < end]
+
+
+def fetch_production_range(zone_key, start, end, session=None,
+                           max_workers=RANGE_MAX_WORKERS, checkpoint=None,
+                           logger=logging.getLogger(__name__)):
+    """
+    Gets validated production datapoints for a zone between `start` and
+    `end`, using the largest queries ENTSOE allows. See `fetch_range`.
+    """
+    if not session:
+        session = requests.session()
+    domain = ENTSOE_DOMAIN_MAPPINGS[zone_key]
+
+    def fetch_period(period):
+        # Range windows are large and fetched once: they are not cached
+        parsed = parse_production(query_production(domain, session, period=period,
+                                                   cache=None))
+        if parsed:
+            return _production_datapoints(zone_key, parsed, logger)
+
+    return fetch_range(fetch_period, start, end, ENTSOE_MAX_QUERY_PERIOD['A75'],
+                       max_workers=max_workers, checkpoint=checkpoint,
+                       description={'zone': zone_key, 'documentType': 'A75'},
+                       logger=logger)
+
+
+def fetch_consumption_range(zone_key, start, end, session=None,
+                            max_workers=RANGE_MAX_WORKERS, checkpoint=None,
+                            logger=logging.getLogger(__name__)):
+    """
+    Gets consumption datapoints for a zone between `start` and `end`, using
+    the largest queries ENTSOE allows. See `fetch_range`.
+    """
+    if not session:
+        session = requests.session()
+    domain = ENTSOE_DOMAIN_MAPPINGS[zone_key]
+
+    def fetch_period(period):
+        parsed = parse_scalar(query_consumption(domain, session, period=period,
+                                                cache=None),
+                              only_outBiddingZone_Domain=True)
+        if parsed:
+            return _consumption_datapoints(zone_key, parsed)
+
+    return fetch_range(fetch_period, start, end, ENTSOE_MAX_QUERY_PERIOD['A65'],
+                       max_workers=max_workers, checkpoint=checkpoint,
+                       description={'zone': zone_key, 'documentType': 'A65'},
+                       logger=logger)
+
+
+def fetch_exchange_range(zone_key1, zone_key2, start, end, session=None,
+                         max_workers=RANGE_MAX_WORKERS, checkpoint=None,
+                         logger=logging.getLogger(__name__)):
+    """
+    Gets exchange datapoints between two zones between `start` and `end`,
+    using the largest queries ENTSOE allows. See `fetch_range`.
+    """
+    if not session:
+        session = requests.session()
+
+    def fetch_period(period):
+        return _exchange_datapoints(zone_key1, zone_key2, session, period=period,
+                                    cache=None)
+
+    return fetch_range(fetch_period, start, end, ENTSOE_MAX_QUERY_PERIOD['A11'],
+                       max_workers=max_workers, checkpoint=checkpoint,
+                       description={'zone': '->'.join(sorted([zone_key1, zone_key2])),
+                                    'documentType': 'A11'},
+                       logger=logger)
@@ -0,0 +1,142 @@
+"""
+Installed capacity of every zone, as declared in config/zones.json.
+
+The capacities are loaded once into a (zone x mode) matrix, so that
+production datapoints of any parser can be checked against the installed
+capacity of their zone in a vectorized way.
+"""
+
+import json
+from logging import getLogger
+import os
+
+import numpy as np
+
+ZONES_CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '../../config/zones.json')
+
+# Capacity modes of the storage keys of datapoints
+STORAGE_CAPACITY_MODES = {
+    'battery': 'battery storage',
+    'hydro': 'hydro storage',
+}
+
+# Capacities of zones.json are not always up to date: values are only
+# considered anomalous above capacity * (1 + DEFAULT_MARGIN)
+DEFAULT_MARGIN = 0.2
+
+
+class CapacityIndex(object):
+    """
+    Matrix of installed capacity (MW) per zone and mode.
+    A capacity is NaN when it is not declared in the config.
+    """
+
+    def __init__(self, zone_keys, modes, capacity):
+        self.zone_keys = zone_keys
+        self.modes = modes
+        self.capacity = capacity
+        self._rows = {zone_key: i for i, zone_key in enumerate(zone_keys)}
+        self._columns = {mode: j for j, mode in enumerate(modes)}
+        # Unknown zones and modes are looked up in an extra row and column
+        # of NaN
+        self._padded = np.full((len(zone_keys) + 1, len(modes) + 1), np.nan)
+        self._padded[:-1, :-1] = capacity
+
+    def __contains__(self, zone_key):
+        return zone_key in self._rows
+
+    @classmethod
+    def from_zones_config(cls, zones_config):
+        zone_keys = sorted(k for k, v in zones_config.items()
+                           if v.get('capacity'))
+        modes = sorted({mode for k in zone_keys
+                        for mode in zones_config[k]['capacity']})
+        columns = {mode: j for j, mode in enumerate(modes)}
+        capacity = np.full((len(zone_keys), len(modes)), np.nan)
+        for i, zone_key in enumerate(zone_keys):
+            for mode, value in zones_config[zone_key]['capacity'].items():
+                if value is not None:
+                    capacity[i, columns[mode]] = value
+        return cls(zone_keys, modes, capacity)
+
+    @classmethod
+    def load(cls, path=ZONES_CONFIG_PATH):
+        """
+        Loads the index of the zones config at `path`. A missing or invalid
+        file raises: it would silently disable every capacity check.
+        """
+        with open(path) as f:
+            return cls.from_zones_config(json.load(f))
+
+    def get(self, zone_key, mode):
+        """Returns the capacity of `mode` in `zone_key`, or None if unknown"""
+        value = self.lookup([zone_key], [mode])[0, 0]
+        return None if np.isnan(value) else float(value)
+
+    def lookup(self, zone_keys, modes):
+        """
+        Returns the (len(zone_keys) x len(modes)) array of capacities, NaN
+        where unknown.
+        """
+        rows = np.array([self._rows.get(k, -1) for k in zone_keys], dtype=int)
+        columns = np.array([self._columns.get(m, -1) for m in modes],
+                           dtype=int)
+        return self._padded[rows[:, np.newaxis], columns]
+
+    def exceeded(self, zone_keys, modes, values, margin=DEFAULT_MARGIN):
+        """
+        Returns a boolean array, of the shape of `values`, True where a value
+        exceeds the capacity (times 1 + `margin`) of its mode in its zone.
+        values: (len(zone_keys) x len(modes)) array, NaN values and unknown
+          capacities are never exceeded.
+        """
+        capacity = self.lookup(zone_keys, modes)
+        with np.errstate(invalid='ignore'):
+            return np.asarray(values, dtype=float) > capacity * (1 + margin)
+
+
+CAPACITY_INDEX = CapacityIndex.load()
+
+
+def flag_anomalies(datapoints, index=CAPACITY_INDEX, margin=DEFAULT_MARGIN,
+                   logger=None):
+    """
+    Flags production and storage values exceeding installed capacity.
+    Storage values are checked in absolute value. Modes with an unknown or
+    zero capacity are not checked.
+    Returns a list of (datapoint index, zone key, key, mode, value, capacity),
+    key being 'production' or 'storage'. Datapoints are not modified.
+    """
+    if logger is None:
+        logger = getLogger(__name__)
+    anomalies = []
+    zone_keys = [datapoint['zoneKey'] for datapoint in datapoints]
+    for key in ['production', 'storage']:
+        modes = {}
+        for datapoint in datapoints:
+            for mode in datapoint.get(key) or {}:
+                modes.setdefault(mode, len(modes))
+        values = np.full((len(datapoints), len(modes)), np.nan)
+        for i, datapoint in enumerate(datapoints):
+            for mode, value in (datapoint.get(key) or {}).items():
+                if value is not None:
+                    values[i, modes[mode]] = value
+        modes = list(modes)
+        if key == 'storage':
+            values = np.abs(values)
+            capacity_modes = [STORAGE_CAPACITY_MODES.get(m, m) for m in modes]
+        else:
+            capacity_modes = modes
+        capacity = index.lookup(zone_keys, capacity_modes)
+        with np.errstate(invalid='ignore'):
+            exceeded = (index.exceeded(zone_keys, capacity_modes, values,
+                                       margin) & (capacity > 0))
+        for i, j in zip(*np.nonzero(exceeded)):
+            logger.warning('%s %s %s of %.2fMW exceeds installed capacity of '
+                           '%.2fMW', zone_keys[i], modes[j], key,
+                           values[i, j], capacity[i, j],
+                           extra={'key': zone_keys[i]})
+            anomalies.append((int(i), zone_keys[i], key, modes[j],
+                              float(values[i, j]), float(capacity[i, j])))
+    return anomalies
@@ -1,37 +1,66 @@
 # This library contains validation functions applied to all parsers by the feeder
 # This is a higher level validation than validation.py
+from collections import namedtuple
 import datetime
 import warnings
 
 import arrow
+from arrow.parser import ParserError
 
 
 class ValidationError(ValueError):
     pass
 
 
-def validate_reasonable_time(item, k):
-    data_time = arrow.get(item['datetime'])
+# Zones that are allowed to report no coal, gas, oil and unknown production
+FOSSIL_NOT_REQUIRED_ZONES = frozenset(
+    {'CH', 'NO', 'AUS-TAS', 'DK-BHM', 'US-NEISO'})
+
+# A datapoint rejected by `validate_batch`: `index` is its position in the
+# validated items and `error` the ValidationError it raised
+Failure = namedtuple('Failure', ['index', 'key', 'error'])
+
+
+def utcnow():
+    """Returns the current time as a timezone aware datetime"""
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _to_datetime(value):
+    """Returns `value` as an aware datetime, naive datetimes being UTC"""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=datetime.timezone.utc)
+        return value
+    try:
+        return arrow.get(value).datetime
+    except (ParserError, TypeError, ValueError):
+        raise ValidationError('datetime %s is not valid' % (value,))
+
+
+def validate_reasonable_time(item, k, now=None):
+    data_time = _to_datetime(item['datetime'])
     if data_time.year < 2000:
         raise ValidationError("Data from %s can't be before year 2000, it was "
                               "%s" % (k, data_time))
 
-    arrow_now = arrow.utcnow()
-    if data_time > arrow_now:
+    if now is None:
+        now = utcnow()
+    if data_time > now:
         raise ValidationError(
             "Data from %s can't be in the future, data was %s, now is "
-            "%s" % (k, data_time, arrow_now))
+            "%s" % (k, data_time, now))
 
 
-def validate_consumption(obj, zone_key):
+def validate_consumption(obj, zone_key, now=None):
     # Data quality check
     if obj['consumption'] is not None and obj['consumption'] < 0:
         raise ValidationError('%s: consumption has negative value '
                               '%s' % (zone_key, obj['consumption']))
-    validate_reasonable_time(obj, zone_key)
+    validate_reasonable_time(obj, zone_key, now)
 
 
-def validate_exchange(item, k):
+def validate_exchange(item, k, now=None):
     if item.get('sortedZoneKeys', None) != k:
         raise ValidationError("Sorted country codes %s and %s don't "
                               "match" % (item.get('sortedZoneKeys', None), k))
@@ -40,10 +69,10 @@ def validate_exchange(item, k):
     if type(item['datetime']) != datetime.datetime:
         raise ValidationError('datetime %s is not valid for %s' %
                               (item['datetime'], k))
-    validate_reasonable_time(item, k)
+    validate_reasonable_time(item, k, now)
 
 
-def validate_production(obj, zone_key):
+def validate_production(obj, zone_key, now=None):
     if 'datetime' not in obj:
         raise ValidationError(
             'datetime was not returned for %s' % zone_key)
@@ -59,11 +88,10 @@ def validate_production(obj, zone_key):
         raise ValidationError("Zone keys %s and %s don't match in %s" %
                               (obj.get('zoneKey', None), zone_key, obj))
 
-    if ((obj.get('production', {}).get('unknown', None) is None and
-         obj.get('production', {}).get('coal', None) is None and
-         obj.get('production', {}).get('oil', None) is None and
-         obj.get('production', {}).get('gas', None) is None and zone_key
-         not in ['CH', 'NO', 'AUS-TAS', 'DK-BHM', 'US-NEISO'])):
+    production = obj.get('production', {})
+    if (zone_key not in FOSSIL_NOT_REQUIRED_ZONES and
+            all(production.get(mode, None) is None
+                for mode in ['unknown', 'coal', 'oil', 'gas'])):
         raise ValidationError(
             "Coal, gas or oil or unknown production value is required for"
             " %s" % zone_key)
@@ -81,4 +109,36 @@ def validate_production(obj, zone_key):
         if v < 0:
             raise ValidationError('%s: key %s has negative value %s' %
                                   (zone_key, k, v))
-    validate_reasonable_time(obj, zone_key)
+    validate_reasonable_time(obj, zone_key, now)
+
+
+VALIDATORS = {
+    'consumption': validate_consumption,
+    'exchange': validate_exchange,
+    'production': validate_production,
+}
+
+
+def validate_batch(data_type, items, now=None):
+    """
+    Validates many datapoints of the same type at once.
+
+    data_type: 'consumption', 'exchange' or 'production'
+    items: list of (key, datapoint), key being the zone key (or sorted zone
+      keys for exchanges) the datapoint was fetched for
+    now: reference time for all datapoints, defaults to the current time
+
+    Returns the list of Failures, empty if all datapoints are valid.
+    """
+    validator = VALIDATORS[data_type]
+    if now is None:
+        now = utcnow()
+    else:
+        now = _to_datetime(now)
+    failures = []
+    for index, (key, item) in enumerate(items):
+        try:
+            validator(item, key, now)
+        except ValidationError as e:
+            failures.append(Failure(index, key, e))
+    return failures
@@ -2,12 +2,12 @@
 
 """Centralised validation function for all parsers."""
 
+from collections import namedtuple
 from logging import getLogger
 import math, logging
 
 import numpy as np
-import pandas as pd
-from .utils import nan_to_zero
+from .capacity import CAPACITY_INDEX
 
 
 def has_value_for_key(datapoint, key, logger):
@@ -33,65 +33,353 @@ def check_expected_range(datapoint, value, expected_range, logger, key=None):
     return True
 
 
-def validate_production_diffs(
-        datapoints: list, max_diff: dict, logger: logging.Logger):
+def check_capacity(datapoint, margin, logger):
+    """checks that no generation value exceeds the installed capacity of its
+    type (times 1 + margin) in the zone of the datapoint"""
+    zone_key = datapoint['zoneKey']
+    for key, value in datapoint['production'].items():
+        if value is None or math.isnan(value):
+            continue
+        capacity = CAPACITY_INDEX.get(zone_key, key)
+        if capacity is not None and value > capacity * (1 + margin):
+            logger.warning("{} reported {:.2f}MW of {}, more than its "
+                           "installed capacity of {:.2f}MW".format(
+                               zone_key, value, key, capacity),
+                           extra={'key': zone_key})
+            return
+    return True
+
+
+def _production_total(production):
+    """Sum of the production values that are neither None nor NaN"""
+    return sum(v for v in production.values()
+               if v is not None and not math.isnan(v))
+
+
+def validate_production_diffs(datapoints: list, max_diff: dict,
+                              logger: logging.Logger,
+                              return_rejected_indices=False):
     """
 
     Parameters
     ----------
     datapoints: a list of datapoints having a 'production' field
-    max_diff: dict representing the max allowed diff (in MW) per energy type
+    max_diff: dict representing the max allowed diff (in MW) per energy type.
+      The 'total' key applies to the sum of all production values.
     logger
+    return_rejected_indices: when True, also return the indices (in
+      `datapoints`) of the datapoints removed for a too big diff
+
+    Diffs are computed between consecutive datapoints (by datetime), the
+    first one being always OK. A None datapoint splits the series: no diff
+    is computed between its neighbours in `datapoints` when they are also
+    consecutive by datetime. A diff involving a None or NaN value is always
+    allowed (missing values can be disallowed using `validate`).
 
     Returns
     -------
-    the same list of datapoints, with the ones having a too big diff removed
+    the same list of datapoints, sorted by datetime, with None datapoints and
+    the ones having a too big diff removed
+    (and the list of rejected indices if `return_rejected_indices`)
     """
 
     if len(datapoints) < 2:
-        return datapoints
-
-    # ignore points that are None
-    # TODO(olc): do diffs on each chunks of consecutive non-None points
-    # intead of simply remove None
-    datapoints = [x for x in datapoints if x]
-
-    # sort datapoins by datetime
-    datapoints = sorted(datapoints, key=lambda x: x['datetime'])
-
-    ok_diff = pd.Series(np.ones_like(datapoints, dtype=bool))
-    for energy, max_diff in max_diff.items():
-        if 'energy' == 'total':
-            series = pd.Series(
-                [np.nansum([v for v in datapoint['production'].values()])
-                 for datapoint in datapoints])
+        return (datapoints, []) if return_rejected_indices else datapoints
+
+    # Build a (time x energy) array in a single pass
+    energies = list(max_diff)
+    positions, split_before, rows = [], [], []
+    split = False
+    for position, datapoint in enumerate(datapoints):
+        if not datapoint:
+            split = bool(positions)
+            continue
+        production = datapoint['production']
+        positions.append(position)
+        # a None datapoint lies between this one and the previous one
+        split_before.append(split)
+        split = False
+        rows.append([_production_total(production) if energy == 'total'
+                     else production.get(energy) for energy in energies])
+    if not positions:
+        return ([], []) if return_rejected_indices else []
+
+    # sort datapoints by datetime
+    order = sorted(range(len(positions)),
+                   key=lambda i: datapoints[positions[i]]['datetime'])
+    order = np.array(order, dtype=int)
+    positions = np.array(positions)[order]
+    values = np.array(rows, dtype=float).reshape(len(rows), len(energies))[order]
+    limits = np.array([max_diff[energy] for energy in energies], dtype=float)
+
+    too_big = np.zeros(values.shape, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        # nan diffs compare as False, hence are allowed
+        too_big[1:] = np.abs(np.diff(values, axis=0)) >= limits
+    # diffs across a None datapoint don't count: the consecutive datapoints
+    # (by datetime) were also neighbours in the input, on each side of a None
+    previous, current = order[:-1], order[1:]
+    across_none = ((np.abs(current - previous) == 1) &
+                   np.array(split_before, dtype=bool)[np.maximum(previous,
+                                                                 current)])
+    too_big[1:] &= ~across_none[:, np.newaxis]
+
+    for j in np.flatnonzero(too_big.any(axis=0)):
+        if not logger.isEnabledFor(logging.WARNING):
+            break
+        wrong_ixs = np.flatnonzero(too_big[:, j])
+        wrong_ixs_and_previous = sorted(set(wrong_ixs) | set(wrong_ixs - 1))
+        logger.warning(
+            'some datapoints have a too high production value difference '
+            'for %s: %s', energies[j],
+            [(datapoints[positions[i]]['datetime'], values[i, j])
+             for i in wrong_ixs_and_previous])
+
+    ok_diff = ~too_big.any(axis=1)
+    validated = [datapoints[p] for p in positions[ok_diff]]
+    if return_rejected_indices:
+        return validated, sorted(positions[~ok_diff].tolist())
+    return validated
+
+
+class ValidationRules(object):
+    """
+    Compiled set of constraints checked by `validate_batch`.
+    See `validate` for the meaning of each constraint.
+    """
+
+    def __init__(self, remove_negative=False, required=None, floor=False,
+                 expected_range=None, capacity_margin=None):
+        self.remove_negative = remove_negative
+        self.capacity_margin = capacity_margin
+        self.required = list(required or [])
+        self.floor = floor
+        self.expected_range = expected_range
+        if isinstance(expected_range, dict):
+            self.expected_ranges = [(key, min(range_), max(range_), range_)
+                                    for key, range_ in expected_range.items()]
+        else:
+            self.expected_ranges = []
+
+
+def compile_rules(remove_negative=False, required=None, floor=False,
+                  expected_range=None, capacity_margin=None, **kwargs):
+    """
+    Returns the ValidationRules for the keyword arguments accepted by
+    `validate`, to be reused across calls to `validate_batch`.
+    """
+    if kwargs:
+        raise TypeError('Unexpected **kwargs: %r' % kwargs)
+    return ValidationRules(remove_negative=remove_negative, required=required,
+                           floor=floor, expected_range=expected_range,
+                           capacity_margin=capacity_margin)
+
+
+class ProductionFrame(object):
+    """
+    Columnar view of production datapoints.
+
+    production: (n x len(modes)) float array of the generation values, NaN
+      where a value is None (or missing)
+    production_none: boolean array, True where a generation value is None
+      (or missing), as opposed to a NaN value
+    storage_total: sum of the non-None storage values of each datapoint
+    zone_keys: zone key of each datapoint
+    """
+
+    def __init__(self, modes, production, production_none, storage_total,
+                 zone_keys):
+        self.modes = modes
+        self.columns = {mode: j for j, mode in enumerate(modes)}
+        self.production = production
+        self.production_none = production_none
+        self.storage_total = storage_total
+        self.zone_keys = zone_keys
+
+    def __len__(self):
+        return len(self.zone_keys)
+
+    @classmethod
+    def from_datapoints(cls, datapoints, modes=None):
+        """
+        Builds the frame of `datapoints`. Columns default to the generation
+        types found in the datapoints.
+        """
+        if modes is None:
+            modes = {}
+            for datapoint in datapoints:
+                for mode in datapoint['production']:
+                    modes.setdefault(mode, None)
+            modes = list(modes)
         else:
-            series = pd.Series(
-                [datapoint['production'].get(energy, np.nan)
-                 for datapoint in datapoints])
-        # nan is always allowed (can be disallowed using `validate` function)
-        new_diffs = (np.abs(series.diff()) < max_diff) | series.isna()
-        if not new_diffs[1:].all():
-            wrongs_ixs = new_diffs[~new_diffs].index
-            wrongs_ixs_and_previous = sorted(
-                {ix - 1 for ix in wrongs_ixs} | set(wrongs_ixs))
-            to_display = [
-                (datapoints[i]['datetime'], datapoints[i]['production'][energy])
-                for i in wrongs_ixs_and_previous if i > 0]
-            logger.warning(
-                'some datapoints have a too high production value difference '
-                'for {}: {}'.format(energy, to_display))
-        ok_diff &= new_diffs
-    # first datapoint is always OK
-    ok_diff.iloc[0] = True
-
-    return [datapoints[i] for i in ok_diff[ok_diff].index]
+            modes = list(modes)
+        columns = {mode: j for j, mode in enumerate(modes)}
+        production = np.full((len(datapoints), len(modes)), np.nan)
+        production_none = np.ones((len(datapoints), len(modes)), dtype=bool)
+        storage_total = np.zeros(len(datapoints))
+        for i, datapoint in enumerate(datapoints):
+            for mode, value in datapoint['production'].items():
+                j = columns.get(mode)
+                if j is not None and value is not None:
+                    production[i, j] = value
+                    production_none[i, j] = False
+            storage_total[i] = sum(v for v in (datapoint.get('storage') or {})
+                                   .values() if v is not None)
+        return cls(modes, production, production_none, storage_total,
+                   [datapoint['zoneKey'] for datapoint in datapoints])
+
+    def column(self, mode):
+        """Returns the values of `mode` (all NaN if it is not a column)."""
+        j = self.columns.get(mode)
+        if j is None:
+            return np.full(len(self), np.nan)
+        return self.production[:, j]
+
+    def total(self):
+        """
+        Returns generation minus storage for each datapoint. None values are
+        ignored, NaN values make the total NaN.
+        When adding power to the system, storage key is negative.
+        """
+        generation = np.where(self.production_none, 0, self.production)
+        return generation.sum(axis=1) - self.storage_total
+
+
+# A datapoint rejected by `validate_batch`
+# rule: 'required', 'floor' or 'expected_range'
+# key: generation type the rule failed for (None for totals)
+# value: the offending value (None when missing)
+Rejection = namedtuple('Rejection', ['index', 'zone_key', 'rule', 'key', 'value'])
+
+
+def _remove_negative(frame, datapoints, logger):
+    """Changes small negative generation values to None, in place."""
+    with np.errstate(invalid='ignore'):
+        negative = (frame.production > -5.0) & (frame.production < 0.0)
+    for i, j in zip(*np.nonzero(negative)):
+        mode = frame.modes[j]
+        logger.warning('%s returned %.2f, setting to None',
+                       mode, frame.production[i, j],
+                       extra={'key': frame.zone_keys[i]})
+        if datapoints is not None:
+            datapoints[i]['production'][mode] = None
+    frame.production[negative] = np.nan
+    frame.production_none[negative] = True
+
+
+def validate_batch(data, rules, logger=None):
+    """
+    Validates many production datapoints against the same rules.
+
+    Arguments
+    ---------
+    data: a list of production datapoints (see `validate`) or a
+      ProductionFrame
+    rules: ValidationRules, see `compile_rules`
+    logger
+
+    Returns
+    -------
+    A tuple (keep, rejections): `keep` is a boolean array, True for valid
+    datapoints, and `rejections` lists a Rejection for each invalid datapoint,
+    describing the first constraint it failed.
+    With `rules.remove_negative`, the datapoints (or the frame) are modified
+    in place.
+    """
+    if logger is None:
+        logger = getLogger(__name__)
+
+    datapoints = None
+    if isinstance(data, ProductionFrame):
+        frame = data
+    else:
+        datapoints = data
+        frame = ProductionFrame.from_datapoints(datapoints)
+
+    keep = np.ones(len(frame), dtype=bool)
+    rejections = []
+
+    def reject(failed, rule, key, values, message, *args):
+        failed = failed & keep
+        for i in np.flatnonzero(failed):
+            value = values[i]
+            value = None if math.isnan(value) else float(value)
+            rejections.append(
+                Rejection(int(i), frame.zone_keys[i], rule, key, value))
+            logger.warning(message, *(arg(i) if callable(arg) else arg
+                                      for arg in args),
+                           extra={'key': frame.zone_keys[i]})
+        keep[failed] = False
+
+    def zone_key(i):
+        return frame.zone_keys[i]
+
+    if rules.remove_negative:
+        _remove_negative(frame, datapoints, logger)
+
+    for mode in rules.required:
+        values = frame.column(mode)
+        reject(np.isnan(values), 'required', mode, values,
+               'Required generation type %s is missing from %s', mode, zone_key)
+
+    total = None
+    if rules.floor:
+        total = frame.total()
+        with np.errstate(invalid='ignore'):
+            failed = total < rules.floor
+        reject(failed, 'floor', None, total,
+               '%s reported total of %sMW does not meet %sMW floor value',
+               zone_key, lambda i: total[i], rules.floor)
+
+    if rules.expected_ranges:
+        for mode, low, high, range_ in rules.expected_ranges:
+            values = frame.column(mode)
+            reject(np.isnan(values), 'required', mode, values,
+                   'Required generation type %s is missing from %s', mode,
+                   zone_key)
+            with np.errstate(invalid='ignore'):
+                failed = ~((low <= values) & (values <= high))
+            reject(failed, 'expected_range', mode, values,
+                   '%s reported total of %.2fMW falls outside range of %s '
+                   'for key `%s`', zone_key, lambda i: values[i], range_, mode)
+    elif rules.expected_range:
+        if total is None:
+            total = frame.total()
+        low, high = min(rules.expected_range), max(rules.expected_range)
+        with np.errstate(invalid='ignore'):
+            failed = ~((low <= total) & (total <= high))
+        reject(failed, 'expected_range', None, total,
+               '%s reported total of %.2fMW falls outside range of %s',
+               zone_key, lambda i: total[i], rules.expected_range)
+
+    if rules.capacity_margin is not None:
+        exceeded = CAPACITY_INDEX.exceeded(frame.zone_keys, frame.modes,
+                                           frame.production,
+                                           rules.capacity_margin)
+        capacity = CAPACITY_INDEX.lookup(frame.zone_keys, frame.modes)
+        for j in np.flatnonzero(exceeded.any(axis=0)):
+            mode = frame.modes[j]
+            reject(exceeded[:, j], 'capacity', mode, frame.production[:, j],
+                   '%s reported %.2fMW of %s, more than its installed '
+                   'capacity of %.2fMW', zone_key,
+                   lambda i: frame.production[i, j], mode,
+                   lambda i: capacity[i, j])
+
+    return keep, rejections
+
+
+def filter_valid(datapoints, rules, logger=None):
+    """Returns the datapoints passing `validate_batch`."""
+    keep, _ = validate_batch(datapoints, rules, logger)
+    return [datapoint for datapoint, ok in zip(datapoints, keep) if ok]
 
 
 def validate(datapoint, logger, **kwargs):
     """
     Validates a production datapoint based on given constraints.
     If the datapoint is found to be invalid then None is returned.
+    To validate many datapoints against the same constraints, use
+    `validate_batch`.
 
     Arguments
     ---------
@@ -121,6 +409,12 @@ def validate(datapoint, logger, **kwargs):
         All keys will be required.
         If the total is outside this range the datapoint will be invalidated.
         Defaults to None.
+      capacity_margin: float
+        Checks each generation type against the installed capacity of the
+        zone declared in config/zones.json, allowing values up to
+        capacity * (1 + capacity_margin).
+        If any is above, the datapoint will be invalidated.
+        Defaults to None (no check).
 
     Examples
     --------
@@ -160,6 +454,7 @@ def validate(datapoint, logger, **kwargs):
     required = kwargs.pop('required', [])
     floor = kwargs.pop('floor', False)
     expected_range = kwargs.pop('expected_range', None)
+    capacity_margin = kwargs.pop('capacity_margin', None)
     if kwargs:
         raise TypeError('Unexpected **kwargs: %r' % kwargs)
 
@@ -204,6 +499,10 @@ def validate(datapoint, logger, **kwargs):
                                         logger):
                 return
 
+    if capacity_margin is not None:
+        if not check_capacity(datapoint, capacity_margin, logger):
+            return
+
     return datapoint
 
 
@@ -1,12 +1,200 @@
-from requests import Session
+from contextlib import contextmanager
+import copy
+import threading
+import time
+
+from requests import Request, Session
 from bs4 import BeautifulSoup
 
 from .exceptions import ParserException
 
 
+class CoalescingSession(Session):
+    """
+    requests Session that deduplicates identical GET and POST requests.
+
+    Many zones and exchanges are fetched from the same upstream document.
+    Sharing one CoalescingSession between parsers during a collection cycle
+    makes sure such a document is only downloaded once:
+    - a request identical to one in flight waits for it and receives the same
+      response,
+    - a request identical to one completed less than `ttl` seconds ago is
+      answered from memory.
+    Every caller receives its own shallow copy of the shared response, body
+    already read.
+    Requests are identical when their method, prepared url (including query
+    parameters), body and headers, session headers, cookies and credentials
+    included, are identical, as well as their timeout, verify, cert, proxies
+    and allow_redirects options.
+    Streamed requests, uploads, requests with hooks and other methods are
+    never coalesced.
+
+    Sessions returned by `fork` share the requests of this one, but have
+    their own cookies and headers: giving one to every parser keeps the
+    cookies set by an upstream for one parser from being sent by others.
+    """
+
+    COALESCED_METHODS = ('GET', 'POST')
+    # Requests passing any of these options are never coalesced
+    UNCOALESCED_OPTIONS = ('stream', 'files', 'hooks')
+
+    def __init__(self, ttl=60, cache=None):
+        super(CoalescingSession, self).__init__()
+        self.ttl = ttl
+        # Lock and requests, shared with the forked sessions
+        self._lock, self._entries = cache or (threading.Lock(), {})
+
+    def fork(self):
+        """
+        Returns a session coalescing its requests with this one, with its own
+        cookies and headers. Connection pools are shared as well.
+        """
+        session = CoalescingSession(self.ttl, (self._lock, self._entries))
+        session.adapters = self.adapters
+        return session
+
+    def _request_key(self, method, url, params, data, json, headers, options):
+        if any(options.get(option) for option in self.UNCOALESCED_OPTIONS):
+            return None
+        # Merges the session headers, cookies and credentials, as sent
+        prepared = self.prepare_request(Request(
+            method, url, params=params, data=data, json=json, headers=headers,
+            auth=options.get('auth'), cookies=options.get('cookies')))
+        body = prepared.body
+        if body is not None and not isinstance(body, (bytes, str)):
+            # Generators or files can't be compared
+            return None
+        transport = tuple(sorted(
+            (option, _hashable(value)) for option, value in options.items()
+            if option not in ('auth', 'cookies')))
+        try:
+            hash(transport)
+        except TypeError:
+            return None
+        return (method, prepared.url, body,
+                tuple(sorted(prepared.headers.items())), transport)
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                json=None, **kwargs):
+        method = method.upper()
+        key = None
+        if method in self.COALESCED_METHODS:
+            key = self._request_key(method, url, params, data, json, headers,
+                                    kwargs)
+        if key is None:
+            return super(CoalescingSession, self).request(
+                method, url, params=params, data=data, headers=headers,
+                json=json, **kwargs)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expired():
+                entry = None
+            is_owner = entry is None
+            if is_owner:
+                entry = self._entries[key] = _CoalescedRequest(self.ttl)
+
+        if not is_owner:
+            response = entry.wait()
+            # As if this session had received the response itself
+            for r in response.history + [response]:
+                self.cookies.update(r.cookies)
+            # Callers may change their response (e.g. its encoding)
+            return copy.copy(response)
+
+        try:
+            response = super(CoalescingSession, self).request(
+                method, url, params=params, data=data, headers=headers,
+                json=json, **kwargs)
+            # Read the body now so that it can be shared between callers
+            response.content
+        except Exception as e:
+            with self._lock:
+                self._entries.pop(key, None)
+            entry.set_error(e)
+            raise
+        entry.set_response(response)
+        return copy.copy(response)
+
+    def clear(self):
+        """Forgets all completed requests"""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.done.is_set():
+                    del self._entries[key]
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+class _CoalescedRequest(object):
+    """A request shared by all identical callers"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.done = threading.Event()
+        self.completed_at = None
+        self.response = None
+        self.error = None
+
+    def expired(self):
+        return (self.done.is_set() and
+                time.time() - self.completed_at > self.ttl)
+
+    def set_response(self, response):
+        self.response = response
+        self.completed_at = time.time()
+        self.done.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.completed_at = time.time()
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+# Session shared by all helpers below during a collection cycle
+_cycle_session = None
+
+
+@contextmanager
+def collection_cycle(ttl=60):
+    """
+    Context manager opening a collection cycle.
+
+    Yields a CoalescingSession, which is also used by the helpers of this
+    module whenever they are called without a session. Passing it (or
+    sessions forked from it) to the parsers run during the cycle deduplicates
+    their requests.
+    """
+    global _cycle_session
+    previous = _cycle_session
+    session = _cycle_session = CoalescingSession(ttl=ttl)
+    try:
+        yield session
+    finally:
+        _cycle_session = previous
+        session.close()
+
+
+def get_session(session=None):
+    """Returns `session`, the session of the current cycle or a new one"""
+    return session or _cycle_session or Session()
+
+
 def get_response(zone_key, url, session=None):
     """Get response"""
-    ses = session or Session()
+    ses = get_session(session)
     response = ses.get(url)
     if response.status_code != 200:
         raise ParserException(zone_key, 'Response code: {0}'.format(response.status_code))
@@ -15,7 +203,7 @@ def get_response(zone_key, url, session=None):
 
 def get_response_with_params(zone_key, url, session=None, params=None):
     """Get response"""
-    ses = session or Session()
+    ses = get_session(session)
     response = ses.get(url, params= params)
     if response.status_code != 200:
         raise ParserException(zone_key, 'Response code: {0}'.format(response.status_code))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""Tests for parsers/lib/capacity.py"""
+
+import logging
+import unittest
+
+import numpy as np
+
+from parsers.lib import capacity
+
+
+class CapacityIndexTestCase(unittest.TestCase):
+    """Tests for CapacityIndex."""
+    test_logger = logging.getLogger()
+    test_logger.setLevel(logging.ERROR)
+
+    def setUp(self):
+        self.index = capacity.CapacityIndex.from_zones_config({
+            'AA': {'capacity': {'coal': 1000, 'gas': 0, 'oil': 0,
+                                'hydro storage': 100}},
+            'BB': {'capacity': {'coal': 0, 'gas': 0, 'oil': 0, 'wind': 50}},
+            'CC': {'timezone': 'Europe/Paris'},
+        })
+
+    def test_lookup(self):
+        self.assertEqual(self.index.modes,
+                         ['coal', 'gas', 'hydro storage', 'oil', 'wind'])
+        self.assertEqual(self.index.get('AA', 'coal'), 1000.0)
+        self.assertIsNone(self.index.get('AA', 'wind'))
+        self.assertIsNone(self.index.get('CC', 'coal'))
+        np.testing.assert_array_equal(
+            self.index.lookup(['BB', 'CC'], ['wind', 'solar']),
+            [[50, np.nan], [np.nan, np.nan]])
+
+    def test_exceeded(self):
+        exceeded = self.index.exceeded(
+            ['AA', 'BB', 'CC'], ['coal', 'wind'],
+            [[1100, 10], [0, 70], [5000, np.nan]], margin=0.2)
+        self.assertEqual(exceeded.tolist(),
+                         [[False, False], [False, True], [False, False]])
+
+    def test_flag_anomalies(self):
+        datapoints = [
+            {'zoneKey': 'AA', 'production': {'coal': 1300.0, 'gas': None},
+             'storage': {'hydro': -150.0}},
+            {'zoneKey': 'BB', 'production': {'coal': 0.0, 'wind': 40.0}},
+            # Zero capacities are not checked
+            {'zoneKey': 'BB', 'production': {'gas': 10.0}},
+        ]
+        anomalies = capacity.flag_anomalies(datapoints, index=self.index,
+                                            margin=0.2, logger=self.test_logger)
+        self.assertEqual(anomalies, [
+            (0, 'AA', 'production', 'coal', 1300.0, 1000.0),
+            (0, 'AA', 'storage', 'hydro', 150.0, 100.0),
+        ])
+
+    def test_load_does_not_hide_errors(self):
+        with self.assertRaises(IOError):
+            capacity.CapacityIndex.load('/nonexistent/zones.json')
+
+    def test_zones_config(self):
+        self.assertIn('FR', capacity.CAPACITY_INDEX)
+        self.assertGreater(capacity.CAPACITY_INDEX.get('FR', 'nuclear'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""Tests for parsers/lib/validation.py"""
+
+import copy
+from datetime import datetime
+import logging
+import unittest
+
+import numpy as np
+
+from parsers.lib import validation
+
+
+def make_datapoint(zone_key='FR', storage=None, **production):
+    return {
+        'zoneKey': zone_key,
+        'datetime': '2017-01-01T00:00:00Z',
+        'production': production,
+        'storage': storage or {},
+        'source': 'mysource.com'
+    }
+
+
+class ValidateBatchTestCase(unittest.TestCase):
+    """Tests for validate_batch."""
+    test_logger = logging.getLogger()
+    test_logger.setLevel(logging.ERROR)
+
+    def setUp(self):
+        self.datapoints = [
+            make_datapoint(gas=500.0, coal=100.0, storage={'hydro': -100.0}),
+            make_datapoint(gas=None, coal=100.0),
+            make_datapoint(gas=50.0, coal=10.0),
+            make_datapoint(gas=float('nan'), coal=100.0),
+            make_datapoint(gas=1500.0, coal=900.0),
+            make_datapoint(gas=600.0, coal=-2.0),
+        ]
+        self.rules = dict(required=['gas'], floor=100,
+                          expected_range=(100, 2000), remove_negative=True)
+
+    def test_keep_mask_and_rejections(self):
+        keep, rejections = validation.validate_batch(
+            self.datapoints, validation.compile_rules(**self.rules),
+            self.test_logger)
+        self.assertEqual(keep.tolist(), [True, False, False, False, False, True])
+        self.assertEqual([(r.index, r.rule, r.key) for r in rejections],
+                         [(1, 'required', 'gas'), (3, 'required', 'gas'),
+                          (2, 'floor', None), (4, 'expected_range', None)])
+        self.assertEqual(rejections[2].value, 60.0)
+        # small negative values are removed from the datapoints
+        self.assertIsNone(self.datapoints[5]['production']['coal'])
+
+    def test_same_result_as_validate(self):
+        datapoints = copy.deepcopy(self.datapoints)
+        keep, _ = validation.validate_batch(
+            self.datapoints, validation.compile_rules(**self.rules),
+            self.test_logger)
+        for datapoint, ok in zip(datapoints, keep):
+            validated = validation.validate(datapoint, self.test_logger,
+                                            **self.rules)
+            self.assertEqual(validated is not None, ok)
+
+    def test_expected_range_per_key(self):
+        rules = validation.compile_rules(
+            expected_range={'coal': (50, 500), 'gas': (0, 1000)})
+        keep, rejections = validation.validate_batch(
+            self.datapoints, rules, self.test_logger)
+        self.assertEqual(keep.tolist(), [True, False, False, False, False, False])
+        self.assertEqual([(r.index, r.rule, r.key) for r in rejections],
+                         [(2, 'expected_range', 'coal'),
+                          (4, 'expected_range', 'coal'),
+                          (5, 'expected_range', 'coal'),
+                          (1, 'required', 'gas'),
+                          (3, 'required', 'gas')])
+
+    def test_frame(self):
+        frame = validation.ProductionFrame.from_datapoints(self.datapoints)
+        self.assertEqual(frame.modes, ['gas', 'coal'])
+        # None is ignored in totals but NaN is not
+        np.testing.assert_array_equal(
+            frame.total(), [700.0, 100.0, 60.0, np.nan, 2400.0, 598.0])
+        keep, _ = validation.validate_batch(
+            frame, validation.compile_rules(floor=100), self.test_logger)
+        self.assertEqual(keep.tolist(), [True, True, False, True, True, True])
+
+    def test_capacity(self):
+        datapoints = [make_datapoint(nuclear=50000.0),
+                      make_datapoint(nuclear=500000.0),
+                      make_datapoint(zone_key='XX', nuclear=500000.0)]
+        keep, rejections = validation.validate_batch(
+            datapoints, validation.compile_rules(capacity_margin=0.2),
+            self.test_logger)
+        # capacities of config/zones.json, unknown zones are not checked
+        self.assertEqual(keep.tolist(), [True, False, True])
+        self.assertEqual([(r.index, r.rule, r.key) for r in rejections],
+                         [(1, 'capacity', 'nuclear')])
+        self.assertEqual(
+            [validation.validate(d, self.test_logger, capacity_margin=0.2)
+             is not None for d in datapoints], [True, False, True])
+
+    def test_unexpected_kwargs(self):
+        with self.assertRaises(TypeError):
+            validation.compile_rules(required=['gas'], flor=100)
+        with self.assertRaises(TypeError):
+            validation.validate(self.datapoints[0], self.test_logger, flor=100)
+
+
+class ValidateProductionDiffsTestCase(unittest.TestCase):
+    """Tests for validate_production_diffs."""
+    test_logger = logging.getLogger()
+    test_logger.setLevel(logging.ERROR)
+
+    def make_datapoints(self, coal_values):
+        datapoints = []
+        for hour, coal in enumerate(coal_values):
+            datapoint = make_datapoint(coal=coal, gas=100.0)
+            datapoint['datetime'] = datetime(2018, 1, 1, hour)
+            datapoints.append(datapoint)
+        return datapoints
+
+    def test_too_big_diffs_are_removed(self):
+        datapoints = self.make_datapoints([100.0, 120.0, 400.0, 130.0])
+        validated, rejected = validation.validate_production_diffs(
+            list(reversed(datapoints)), {'coal': 150}, self.test_logger,
+            return_rejected_indices=True)
+        # sorted by datetime
+        self.assertEqual(validated, [datapoints[0], datapoints[1]])
+        # indices in the (reversed) input list
+        self.assertEqual(rejected, [0, 1])
+
+    def test_runs_are_split_on_none(self):
+        datapoints = self.make_datapoints([100.0, 120.0, 400.0, 420.0])
+        datapoints.insert(2, None)
+        validated = validation.validate_production_diffs(
+            datapoints, {'coal': 150}, self.test_logger)
+        self.assertEqual(len(validated), 4)
+        # same split in reversed order
+        validated = validation.validate_production_diffs(
+            list(reversed(datapoints)), {'coal': 150}, self.test_logger)
+        self.assertEqual(len(validated), 4)
+
+    def test_shuffled_input(self):
+        d0, d1, d2, d3 = self.make_datapoints([100.0, 120.0, 400.0, 130.0])
+        # the None is not between datapoints consecutive by datetime
+        validated, rejected = validation.validate_production_diffs(
+            [d2, None, d0, d3, d1], {'coal': 150}, self.test_logger,
+            return_rejected_indices=True)
+        self.assertEqual(validated, [d0, d1])
+        # indices in the input list
+        self.assertEqual(rejected, [0, 3])
+
+    def test_nan_values_are_allowed(self):
+        datapoints = self.make_datapoints([100.0, None, 120.0, float('nan'), 600.0])
+        validated, rejected = validation.validate_production_diffs(
+            datapoints, {'coal': 150}, self.test_logger,
+            return_rejected_indices=True)
+        self.assertEqual(len(validated), 5)
+        self.assertEqual(rejected, [])
+
+    def test_total(self):
+        datapoints = self.make_datapoints([100.0, 120.0, 130.0])
+        datapoints[2]['production']['gas'] = 500.0
+        validated, rejected = validation.validate_production_diffs(
+            datapoints, {'total': 300, 'coal': 150}, self.test_logger,
+            return_rejected_indices=True)
+        self.assertEqual(rejected, [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,8 @@
+import threading
 import unittest
+from unittest import mock
+
+import requests_mock
 
 from parsers.lib.exceptions import ParserException
 from parsers.lib import web
@@ -43,5 +47,117 @@ class TestResponses(unittest.TestCase):
             self.fail("assert_zone_key() raised Exception unexpectedly!")
 
 
+class TestCoalescingSession(unittest.TestCase):
+
+    def setUp(self):
+        self.session = web.CoalescingSession()
+        self.adapter = requests_mock.Adapter()
+        self.adapter.register_uri('GET', 'http://upstream.test/data', text='data')
+        self.adapter.register_uri('POST', 'http://upstream.test/data', text='posted')
+        self.session.mount('http://', self.adapter)
+
+    def test_identical_requests_are_fetched_once(self):
+        first = self.session.get('http://upstream.test/data', params={'a': 1})
+        second = self.session.get('http://upstream.test/data', params={'a': 1})
+        self.assertEqual(self.adapter.call_count, 1)
+        self.assertEqual(first.text, 'data')
+        self.assertEqual(second.text, 'data')
+
+    def test_callers_get_their_own_response(self):
+        first = self.session.get('http://upstream.test/data')
+        first.encoding = 'utf-16'
+        second = self.session.get('http://upstream.test/data')
+        self.assertEqual(self.adapter.call_count, 1)
+        self.assertIsNot(first, second)
+        self.assertNotEqual(second.encoding, 'utf-16')
+        self.assertEqual(second.text, 'data')
+
+    def test_different_requests_are_not_coalesced(self):
+        self.session.get('http://upstream.test/data', params={'a': 1})
+        self.session.get('http://upstream.test/data', params={'a': 2})
+        self.session.post('http://upstream.test/data', data={'a': 1})
+        self.session.post('http://upstream.test/data', data={'a': 2})
+        self.session.post('http://upstream.test/data', data={'a': 2})
+        self.assertEqual(self.adapter.call_count, 4)
+
+    def test_expired_requests_are_fetched_again(self):
+        self.session.ttl = -1
+        self.session.get('http://upstream.test/data')
+        self.session.get('http://upstream.test/data')
+        self.assertEqual(self.adapter.call_count, 2)
+
+    def test_in_flight_requests_are_shared(self):
+        # Also while the ttl does not keep completed requests
+        for ttl in [60, 0]:
+            self.session.ttl = ttl
+            self.session.clear()
+            self.assert_in_flight_requests_are_shared()
+
+    def assert_in_flight_requests_are_shared(self):
+        calls = self.adapter.call_count
+        entered, release = threading.Event(), threading.Event()
+        waiting = threading.Semaphore(0)
+        original_wait = web._CoalescedRequest.wait
+
+        def slow_response(request, context):
+            entered.set()
+            release.wait(5)
+            return 'slow'
+
+        def counting_wait(entry):
+            waiting.release()
+            return original_wait(entry)
+
+        self.adapter.register_uri('GET', 'http://upstream.test/slow', text=slow_response)
+        responses = []
+        threads = [
+            threading.Thread(target=lambda: responses.append(
+                self.session.get('http://upstream.test/slow').text))
+            for _ in range(4)]
+        with mock.patch.object(web._CoalescedRequest, 'wait', counting_wait):
+            for thread in threads:
+                thread.start()
+            # Releases the first request once the 3 others wait for it
+            self.assertTrue(entered.wait(5))
+            for _ in range(3):
+                self.assertTrue(waiting.acquire(timeout=5))
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(responses, ['slow'] * 4)
+        self.assertEqual(self.adapter.call_count, calls + 1)
+
+    def test_requests_with_other_options_are_not_coalesced(self):
+        self.session.get('http://upstream.test/data')
+        self.session.get('http://upstream.test/data', timeout=10)
+        self.session.get('http://upstream.test/data', auth=('user', 'secret'))
+        self.session.get('http://upstream.test/data', cookies={'id': '1'})
+        self.session.get('http://upstream.test/data', verify=False)
+        self.assertEqual(self.adapter.call_count, 5)
+
+    def test_forked_sessions_have_their_own_cookies(self):
+        self.adapter.register_uri('GET', 'http://upstream.test/login', text='ok',
+                                  cookies={'id': '1'})
+        first, second, third = [self.session.fork() for _ in range(3)]
+        first.get('http://upstream.test/login')
+        # A shared response sets its cookies in the session receiving it
+        second.get('http://upstream.test/login')
+        self.assertEqual(self.adapter.call_count, 1)
+        self.assertEqual(second.cookies.get('id'), '1')
+        self.assertNotIn('id', third.cookies)
+        # Requests carrying the cookie are not shared with other sessions
+        first.get('http://upstream.test/data')
+        third.get('http://upstream.test/data')
+        second.get('http://upstream.test/data')
+        self.assertEqual(self.adapter.call_count, 3)
+
+    def test_helpers_use_cycle_session(self):
+        with web.collection_cycle() as session:
+            session.mount('http://', self.adapter)
+            web.get_response_text('XX', 'http://upstream.test/data')
+            web.get_response_text('XX', 'http://upstream.test/data')
+        self.assertEqual(self.adapter.call_count, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,397 @@
+#!/usr/bin/python
+
+"""Tests for the XML parsing of the ENTSOE parser."""
+from datetime import timedelta
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import arrow
+import requests
+import requests_mock
+
+from parsers import ENTSOE
+
+
+def read_mock(filename):
+    path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
+    with open(path) as f:
+        return f.read()
+
+
+class ParseTestCase(unittest.TestCase):
+    """Tests for ENTSOE's parse functions."""
+
+    def test_parse_production(self):
+        productions, datetimes = ENTSOE.parse_production(
+            read_mock('ENTSOE_production_BE.xml'))
+        self.assertEqual(datetimes[:3], [arrow.get('2018-12-01T23:00Z'),
+                                         arrow.get('2018-12-02T00:00Z'),
+                                         arrow.get('2018-12-02T01:00Z')])
+        self.assertEqual(dict(productions[0]),
+                         {'B04': 1000.0, 'B14': 5000.0, 'B10': 300.0, 'B19': 80.0})
+        # consumption of the pumped storage is substracted
+        self.assertEqual(productions[2]['B10'], -400.0)
+        # 15 minutes resolution points are kept separately
+        self.assertEqual(datetimes[3:], [arrow.get('2018-12-01T23:15Z'),
+                                         arrow.get('2018-12-01T23:30Z'),
+                                         arrow.get('2018-12-01T23:45Z')])
+        self.assertEqual(dict(productions[3]), {'B19': 90.0})
+
+    def test_parse_scalar(self):
+        values, datetimes = ENTSOE.parse_scalar(
+            read_mock('ENTSOE_production_BE.xml'),
+            only_outBiddingZone_Domain=True)
+        self.assertEqual(values, [0.0, 250.0, 400.0])
+        self.assertEqual(datetimes[-1], arrow.get('2018-12-02T01:00Z'))
+
+    def test_parse_exchange(self):
+        xml_text = read_mock('ENTSOE_exchange_NL_BE.xml')
+        quantities, datetimes = ENTSOE.parse_exchange(xml_text, is_import=True)
+        self.assertEqual(quantities, [700.0, 650.0, 0.0])
+        quantities, datetimes = ENTSOE.parse_exchange(
+            xml_text, is_import=False, quantities=quantities,
+            datetimes=datetimes)
+        self.assertEqual(quantities, [0.0, 0.0, 0.0])
+        self.assertEqual(len(datetimes), 3)
+
+    def test_parse_price(self):
+        prices, currencies, datetimes = ENTSOE.parse_price(
+            read_mock('ENTSOE_price_BE.xml'))
+        self.assertEqual(prices, [50.1, 48.7, 45.0, 44.5, 47.0])
+        self.assertEqual(set(currencies), {'EUR'})
+        # each Period has its own start
+        self.assertEqual(datetimes[3], arrow.get('2018-12-02T02:00Z'))
+
+    def test_accumulate_production_to_frame(self):
+        accumulator = ENTSOE.accumulate_production(
+            read_mock('ENTSOE_production_BE.xml'))
+        frame = accumulator.to_frame(['B04', 'B10', 'B19'])
+        self.assertEqual(frame.shape, (6, 3))
+        self.assertEqual(frame['B10'].tolist()[:3], [300.0, -250.0, -400.0])
+        # missing values are NaN
+        self.assertTrue(frame['B04'].isna().tolist()[3:])
+
+    def test_accumulate_exchange(self):
+        xml_text = read_mock('ENTSOE_exchange_NL_BE.xml')
+        accumulator = ENTSOE.accumulate_exchange(xml_text, is_import=True)
+        ENTSOE.accumulate_exchange(xml_text, is_import=False,
+                                   accumulator=accumulator)
+        self.assertEqual(accumulator.values(), [0.0, 0.0, 0.0])
+        self.assertEqual(accumulator.to_array().shape, (3, 1))
+
+    def test_parse_production_per_units(self):
+        values = ENTSOE.parse_production_per_units(
+            read_mock('ENTSOE_production_per_units_FI.xml'))
+        self.assertEqual(len(values), 4)
+        self.assertEqual(values[0]['productionType'], 'nuclear')
+        self.assertEqual(values[0]['zoneKey'], 'FI')
+        self.assertEqual(values[1]['production'], 881.0)
+
+    def test_parse_empty(self):
+        self.assertIsNone(ENTSOE.parse_production(None))
+        self.assertIsNone(ENTSOE.parse_price(''))
+
+
+class MergeProductionOutputsTestCase(unittest.TestCase):
+    """Tests for ENTSOE's merge of production aggregates."""
+
+    def datapoint(self, hour, production, storage=None):
+        return {'datetime': arrow.get('2018-12-02').shift(hours=hour).datetime,
+                'production': production, 'storage': storage or {},
+                'source': 'entsoe.eu', 'zoneKey': 'IT-RO'}
+
+    def test_merge_production_outputs(self):
+        output1 = [self.datapoint(0, {'gas': 10.0, 'wind': None, 'solar': None},
+                                  {'hydro': -5.0}),
+                   self.datapoint(1, {'gas': 20.0, 'wind': 1.0, 'solar': None})]
+        output2 = [self.datapoint(1, {'gas': 2.0, 'wind': None, 'solar': None},
+                                  {'hydro': None}),
+                   self.datapoint(2, {'gas': 3.0})]
+        data = ENTSOE.merge_production_outputs([output1, output2], 'IT-SO')
+        # only datetimes present in every output are kept
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['datetime'], output1[1]['datetime'])
+        self.assertEqual(data[0]['zoneKey'], 'IT-SO')
+        self.assertEqual(data[0]['source'], 'entsoe.eu')
+        # None + None = None, None + x = x
+        self.assertEqual(data[0]['production'],
+                         {'gas': 22.0, 'wind': 1.0, 'solar': None})
+        self.assertEqual(data[0]['storage'], {'hydro': None})
+
+
+class FetchRangeTestCase(unittest.TestCase):
+    """Tests for ENTSOE's range fetching."""
+
+    def setUp(self):
+        ENTSOE.ENTSOE_CACHE.clear()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fetch_hourly(self, period):
+        """Returns one datapoint per hour, including the end of the period"""
+        start, end = period
+        return [{'datetime': dt.datetime, 'value': 1}
+                for dt in arrow.Arrow.range('hour', start, end)]
+
+    def test_split_period(self):
+        periods = ENTSOE.split_period('2018-01-01T00:30Z', '2018-01-03T12:00Z',
+                                      timedelta(days=1))
+        self.assertEqual(periods, [
+            (arrow.get('2018-01-01T00:00Z'), arrow.get('2018-01-02T00:00Z')),
+            (arrow.get('2018-01-02T00:00Z'), arrow.get('2018-01-03T00:00Z')),
+            (arrow.get('2018-01-03T00:00Z'), arrow.get('2018-01-03T12:00Z')),
+        ])
+        # A partial last hour is queried whole
+        periods = ENTSOE.split_period('2018-01-01T00:00Z', '2018-01-01T12:30Z',
+                                      timedelta(days=1))
+        self.assertEqual(periods, [
+            (arrow.get('2018-01-01T00:00Z'), arrow.get('2018-01-01T13:00Z'))])
+
+    def test_fetch_range_merges_periods(self):
+        data = ENTSOE.fetch_range(self.fetch_hourly, '2018-01-01', '2018-01-04',
+                                  timedelta(days=1))
+        datetimes = [d['datetime'] for d in data]
+        # sorted, deduplicated and within range
+        self.assertEqual(len(datetimes), 3 * 24)
+        self.assertEqual(datetimes, sorted(set(datetimes)))
+        self.assertEqual(datetimes[-1], arrow.get('2018-01-03T23:00Z').datetime)
+
+    def test_fetch_range_resumes_from_checkpoint(self):
+        checkpoint = os.path.join(self.tmp_dir, 'checkpoint.json')
+        fetched = []
+
+        def failing_fetch(period):
+            if period[0] == arrow.get('2018-01-02'):
+                raise ValueError('Service unavailable')
+            return self.fetch_hourly(period)
+
+        def recording_fetch(period):
+            fetched.append(period[0])
+            return self.fetch_hourly(period)
+
+        with self.assertRaises(ValueError):
+            ENTSOE.fetch_range(failing_fetch, '2018-01-01', '2018-01-04',
+                               timedelta(days=1), checkpoint=checkpoint)
+        data = ENTSOE.fetch_range(recording_fetch, '2018-01-01', '2018-01-04',
+                                  timedelta(days=1), checkpoint=checkpoint)
+        # Only the failed period is fetched again
+        self.assertEqual(fetched, [arrow.get('2018-01-02')])
+        self.assertEqual(len(data), 3 * 24)
+
+    def test_fetch_range_ignores_checkpoint_of_other_fetch(self):
+        checkpoint = os.path.join(self.tmp_dir, 'checkpoint.json')
+        ENTSOE.fetch_range(self.fetch_hourly, '2018-01-01', '2018-01-04',
+                           timedelta(days=1), checkpoint=checkpoint,
+                           description={'zone': 'BE', 'documentType': 'A75'})
+        fetched = []
+
+        def recording_fetch(period):
+            fetched.append(period[0])
+            return self.fetch_hourly(period)
+
+        # Other zone, other range, other period length
+        for description, end, max_period in [
+                ({'zone': 'FR', 'documentType': 'A75'}, '2018-01-04', timedelta(days=1)),
+                ({'zone': 'BE', 'documentType': 'A75'}, '2018-01-03', timedelta(days=1)),
+                ({'zone': 'BE', 'documentType': 'A75'}, '2018-01-04', timedelta(days=3))]:
+            del fetched[:]
+            ENTSOE.fetch_range(recording_fetch, '2018-01-01', end, max_period,
+                               checkpoint=checkpoint,
+                               description=description)
+            self.assertEqual(fetched[0], arrow.get('2018-01-01'))
+
+    @mock.patch.dict(os.environ, {'ENTSOE_TOKEN': 'token'})
+    def test_fetch_production_range(self):
+        session = requests.Session()
+        adapter = requests_mock.Adapter()
+        adapter.register_uri('GET', ENTSOE.ENTSOE_ENDPOINT,
+                             text=read_mock('ENTSOE_production_BE.xml'))
+        session.mount('https://', adapter)
+        data = ENTSOE.fetch_production_range(
+            'BE', '2018-12-01T23:00Z', '2018-12-02T23:00Z', session=session)
+        self.assertEqual(adapter.call_count, 1)
+        self.assertEqual(adapter.last_request.qs['periodstart'], ['201812012300'])
+        # Range windows are not kept in the shared cache
+        self.assertEqual(ENTSOE.ENTSOE_CACHE._responses, {})
+        # the 15 minutes points miss gas and nuclear and are invalid
+        self.assertEqual(len(data), 3)
+        self.assertEqual(data[0]['production']['gas'], 1000.0)
+        self.assertEqual(data[0]['storage']['hydro'], -300.0)
+
+
+class FetchProductionPerUnitsTestCase(unittest.TestCase):
+    """Tests for ENTSOE's fetch_production_per_units."""
+
+    def setUp(self):
+        ENTSOE.ENTSOE_CACHE.clear()
+
+    @mock.patch.dict(os.environ, {'ENTSOE_TOKEN': 'token'})
+    def test_fetch_production_per_units(self):
+        session = requests.Session()
+        adapter = requests_mock.Adapter()
+        adapter.register_uri('GET', ENTSOE.ENTSOE_ENDPOINT, text='')
+        adapter.register_uri('GET', ENTSOE.ENTSOE_ENDPOINT + '?psrType=B14',
+                             text=read_mock('ENTSOE_production_per_units_FI.xml'))
+        session.mount('https://', adapter)
+        data = ENTSOE.fetch_production_per_units('FI', session=session)
+        # one query per psr type
+        self.assertEqual(adapter.call_count, len(ENTSOE.ENTSOE_PARAMETER_DESC))
+        self.assertEqual(len(data), 4)
+        self.assertEqual({d['unitName'] for d in data},
+                         {'Olkiluoto 1 B1', 'Loviisa 1 G11'})
+        self.assertEqual(data[0]['datetime'], arrow.get('2018-12-01T23:00Z').datetime)
+
+
+class DocumentCacheTestCase(unittest.TestCase):
+    """Tests for the cache shared by ENTSOE queries."""
+
+    def setUp(self):
+        token = mock.patch.dict(os.environ, {'ENTSOE_TOKEN': 'token'})
+        token.start()
+        self.addCleanup(token.stop)
+        ENTSOE.ENTSOE_CACHE.clear()
+        self.adapter = requests_mock.Adapter()
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+
+    def tearDown(self):
+        ENTSOE.ENTSOE_CACHE.clear()
+
+    def test_same_document_is_queried_once(self):
+        self.adapter.register_uri('GET', ENTSOE.ENTSOE_ENDPOINT,
+                                  text=read_mock('ENTSOE_production_BE.xml'))
+        first = ENTSOE.fetch_production('BE', session=self.session)
+        # A composite parser would use another session
+        other_session = requests.Session()
+        other_session.mount('https://', self.adapter)
+        second = ENTSOE.fetch_production('BE', session=other_session)
+        self.assertEqual(self.adapter.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertIsNot(first[0]['production'], second[0]['production'])
+
+        ENTSOE.fetch_consumption('BE', session=self.session)
+        self.assertEqual(self.adapter.call_count, 2)
+
+    def test_failed_queries_are_not_cached(self):
+        self.adapter.register_uri('GET', ENTSOE.ENTSOE_ENDPOINT, [
+            {'status_code': 503, 'text': 'Service unavailable'},
+            {'text': read_mock('ENTSOE_production_BE.xml')},
+        ])
+        with self.assertRaises(ENTSOE.QueryError):
+            ENTSOE.fetch_production('BE', session=self.session)
+        self.assertTrue(ENTSOE.fetch_production('BE', session=self.session))
+        self.assertEqual(self.adapter.call_count, 2)
+
+    def test_identical_queries_never_run_concurrently(self):
+        cache = ENTSOE.DocumentCache(ttl=0)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'document'
+        started, release = threading.Event(), threading.Event()
+        running = {'current': 0, 'max': 0}
+
+        def slow_fetch():
+            running['current'] += 1
+            running['max'] = max(running['max'], running['current'])
+            started.set()
+            release.wait(5)
+            running['current'] -= 1
+            return response
+
+        cache.get_or_fetch({'documentType': 'A75'}, lambda: response)
+        threads = [threading.Thread(target=cache.get_or_fetch,
+                                    args=({'documentType': 'A75'}, slow_fetch))]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        # Expires the first response while its query runs again
+        cache.get_or_fetch({'documentType': 'A65'}, lambda: response)
+        threads.append(threading.Thread(target=cache.get_or_fetch,
+                                        args=({'documentType': 'A75'}, slow_fetch)))
+        threads[1].start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(running['max'], 1)
+        # Locks are removed once unused
+        self.assertEqual(cache._key_locks, {})
+
+    def test_upstream_queries_are_rate_limited(self):
+        self.adapter.register_uri('GET', ENTSOE.ENTSOE_ENDPOINT,
+                                  text=read_mock('ENTSOE_production_BE.xml'))
+        with mock.patch.object(ENTSOE, 'ENTSOE_RATE_LIMITER') as rate_limiter:
+            ENTSOE.fetch_production('BE', session=self.session)
+            # Answered from the cache
+            ENTSOE.fetch_production('BE', session=self.session)
+            self.assertEqual(rate_limiter.wait.call_count, 1)
+            # One query per flow direction
+            self.adapter.register_uri('GET', ENTSOE.ENTSOE_ENDPOINT,
+                                      text=read_mock('ENTSOE_exchange_NL_BE.xml'))
+            ENTSOE.fetch_exchange('NL', 'BE', session=self.session)
+            self.assertEqual(rate_limiter.wait.call_count, 3)
+
+    def test_make_key_ignores_token(self):
+        params = {'documentType': 'A75', 'in_Domain': '10YBE----------2'}
+        key = ENTSOE.DocumentCache.make_key(params)
+        params['securityToken'] = 'secret'
+        self.assertEqual(ENTSOE.DocumentCache.make_key(params), key)
+
+
+class IncrementalTestCase(unittest.TestCase):
+    """Tests for ENTSOE's incremental queries."""
+
+    def test_incremental_period(self):
+        tracker = ENTSOE.LastSeenTracker()
+        key = ('BE', 'A75')
+        self.assertIsNone(ENTSOE.incremental_period(key, (-48, 0), tracker=tracker))
+
+        last_seen = arrow.utcnow().shift(hours=-3)
+        tracker.update(key, last_seen.datetime)
+        tracker.update(key, last_seen.shift(hours=-1).datetime)
+        start, end = ENTSOE.incremental_period(
+            key, (-48, 0), overlap=timedelta(hours=1), tracker=tracker)
+        self.assertEqual(start, last_seen.shift(hours=-1))
+
+        # the period never exceeds the span
+        tracker.reset()
+        tracker.update(key, last_seen.shift(days=-10).datetime)
+        start, end = ENTSOE.incremental_period(key, (-48, 0), tracker=tracker)
+        self.assertLessEqual(end - start, timedelta(hours=48))
+
+    @mock.patch.dict(os.environ, {'ENTSOE_TOKEN': 'token'})
+    def test_fetch_production_remembers_last_datetime(self):
+        ENTSOE.LAST_SEEN.reset()
+        ENTSOE.ENTSOE_CACHE.clear()
+        session = requests.Session()
+        adapter = requests_mock.Adapter()
+        adapter.register_uri('GET', ENTSOE.ENTSOE_ENDPOINT,
+                             text=read_mock('ENTSOE_production_BE.xml'))
+        session.mount('https://', adapter)
+        now = arrow.get('2018-12-02T12:00Z')
+        try:
+            with mock.patch.object(arrow, 'utcnow', return_value=now):
+                ENTSOE.fetch_production('BE', session=session, incremental=True)
+                self.assertEqual(adapter.last_request.qs['periodstart'], ['201811301200'])
+                self.assertEqual(ENTSOE.LAST_SEEN.get(('BE', 'A75')),
+                                 arrow.get('2018-12-02T01:00Z').datetime)
+
+                # Only the data since the last datapoint, minus the overlap
+                ENTSOE.fetch_production('BE', session=session, incremental=True)
+                self.assertEqual(adapter.call_count, 2)
+                self.assertEqual(adapter.last_request.qs['periodstart'], ['201812012300'])
+                self.assertEqual(adapter.last_request.qs['periodend'], ['201812021200'])
+
+                ENTSOE.fetch_production('BE', session=session, incremental=True,
+                                        overlap=timedelta(hours=5))
+                self.assertEqual(adapter.last_request.qs['periodstart'], ['201812012000'])
+        finally:
+            ENTSOE.LAST_SEEN.reset()
+            ENTSOE.ENTSOE_CACHE.clear()
+
+if __name__ == '__main__':
+    unittest.main()
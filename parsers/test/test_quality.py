@@ -1,8 +1,10 @@
 #!/usr/bin/python
 
 """Tests for quality.py."""
+import datetime
 import unittest
-from parsers.lib.quality import validate_consumption, validate_exchange, validate_production
+from parsers.lib.quality import FOSSIL_NOT_REQUIRED_ZONES, ValidationError, \
+    validate_batch, validate_consumption, validate_exchange, validate_production
 from parsers.test.mocks.quality_check import *
 
 
@@ -70,6 +72,10 @@ class ProductionTestCase(unittest.TestCase):
     def test_missing_types_allowed(self):
         self.assertFalse(validate_production(p7, 'CH'), msg = "CH, NO, AUS-TAS, US-NEISO don't require Coal/Oil/Unknown!")
 
+    def test_fossil_not_required_zones(self):
+        self.assertEqual(FOSSIL_NOT_REQUIRED_ZONES, {
+            'AUS-TAS', 'CH', 'DK-BHM', 'NO', 'US-NEISO'})
+
     def test_negative_production(self):
         with self.assertRaises(Exception, msg = 'Negative generation should be rejected!'):
             validate_production(p8, 'FR')
@@ -78,5 +84,26 @@ class ProductionTestCase(unittest.TestCase):
         self.assertFalse(validate_production(p9, 'FR'), msg = 'This datapoint is good!')
 
 
+class BatchTestCase(unittest.TestCase):
+    """Tests for validate_batch."""
+
+    def test_all_failures_are_reported(self):
+        failures = validate_batch('production', [
+            ('FR', p9), ('FR', p5), ('CH', p7), ('FR', p6), ('FR', p8)])
+        self.assertEqual([f.index for f in failures], [1, 3, 4])
+        self.assertTrue(all(isinstance(f.error, ValidationError)
+                            for f in failures))
+
+    def test_now_reference(self):
+        # datapoints up to 5 minutes in the future are fine 10 minutes later
+        later = datetime.datetime.utcnow() + datetime.timedelta(minutes=10)
+        self.assertEqual(validate_batch('exchange', [('DK->NO', e4)], now=later), [])
+        self.assertEqual(len(validate_batch('exchange', [('DK->NO', e4)])), 1)
+
+    def test_consumption(self):
+        failures = validate_batch('consumption', [('FR', c1), ('FR', c2), ('FR', c3)])
+        self.assertEqual([(f.index, f.key) for f in failures], [(1, 'FR')])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,494 @@
+"""
+Flow-tracing computation of the carbon intensity of consumption.
+
+See `CO2eq Model Explanation.ipynb`: the carbon intensity x_i of the power
+consumed in zone i satisfies
+
+  x_i * (production_i + import_i) - sum_j import_ij * x_j
+      = sum_m I_im * production_im
+
+where import_ij is the power imported by zone i from zone j and I_im the
+emission factor of production mode m in zone i. Writing this balance for
+every zone gives a sparse linear system, coupled by the exchanges.
+
+Special cases:
+- storage discharge (negative storage values) is counted as production,
+  with the '<storage> discharge' emission factor. Charging is a
+  consumption, which cancels out of the balance like exports.
+- zones without production data are not solved. Power imported from them
+  has the intensity of their fallback mix (`fallbackZoneMixes` of
+  config/co2eq_parameters.json), or is ignored when they have none.
+
+Zones and exchanges are laid out in arrays following ZONE_KEYS and
+EXCHANGE_KEYS of utils/config.py. Many timesteps (e.g. when reprocessing
+history) are laid out in (time x zone) and (time x exchange) stacks and
+solved in batch, as block-diagonal systems.
+"""
+
+import threading
+import warnings
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import MatrixRankWarning, spsolve
+
+from utils.config import (CO2EQ_PARAMETERS, EMISSION_FACTOR_MODE_INDEX,
+                          EMISSION_FACTOR_MODES, EXCHANGE_INDEX,
+                          EXCHANGE_KEYS, ZONE_COMPONENTS, ZONE_INDEX,
+                          ZONE_KEYS, emission_factors)
+from utils.graph import EXCHANGE_GRAPH
+
+# Zone indices of both ends of every exchange, in EXCHANGE_KEYS order.
+# A positive netFlow goes from the first zone to the second one.
+EXCHANGE_ZONES = EXCHANGE_GRAPH.edge_zones
+
+# Intensity of the fallback mix of every zone, NaN if it has none
+FALLBACK_INTENSITIES = np.array([
+    CO2EQ_PARAMETERS['fallbackZoneMixes'].get(zone_key, {}).get(
+        'carbonIntensity', np.nan)
+    for zone_key in ZONE_KEYS], dtype=float)
+
+# Emission factors (gCO2eq/kWh) in a (zone x mode) matrix, columns following
+# EMISSION_FACTOR_MODES. Rows follow ZONE_KEYS, then the other zones having
+# overrides, then a last row of defaults used for any other zone. Missing
+# factors are NaN.
+EMISSION_FACTOR_ZONE_KEYS = ZONE_KEYS + sorted(
+    set(CO2EQ_PARAMETERS['emissionFactors']['zoneOverrides']) -
+    set(ZONE_KEYS))
+EMISSION_FACTOR_ZONE_INDEX = {
+    k: i for i, k in enumerate(EMISSION_FACTOR_ZONE_KEYS)}
+EMISSION_FACTORS = np.array(
+    [[np.nan if factors[mode] is None else factors[mode]
+      for mode in EMISSION_FACTOR_MODES]
+     for factors in map(emission_factors, EMISSION_FACTOR_ZONE_KEYS + [None])],
+    dtype=float)
+EMISSION_FACTORS.flags.writeable = False
+
+
+def emission_factor_row(zone_key):
+    """Returns the row of `zone_key` in EMISSION_FACTORS"""
+    return EMISSION_FACTOR_ZONE_INDEX.get(zone_key, len(EMISSION_FACTORS) - 1)
+
+
+# Emission factors of ZONE_KEYS (the first rows of EMISSION_FACTORS). Modes
+# absent from config/co2eq_parameters.json use the factor of unknown
+# production.
+ZONE_FACTORS = EMISSION_FACTORS[:len(ZONE_KEYS)]
+_MODE_COLUMNS = EMISSION_FACTOR_MODE_INDEX
+_UNKNOWN = EMISSION_FACTOR_MODE_INDEX['unknown']
+
+
+def production_vectors(production_datapoints):
+    """
+    Returns (power, emissions, has_data) arrays over ZONE_KEYS:
+    power: production and storage discharge (MW)
+    emissions: power times its emission factor (MW x gCO2eq/kWh)
+    has_data: True for zones having a datapoint
+    """
+    power, emissions, has_data = _production_arrays(
+        production_datapoints, 1, lambda datapoint: 0)
+    return power[0], emissions[0], has_data[0]
+
+
+def production_stack(production_datapoints, datetimes):
+    """
+    Returns the (len(datetimes) x len(ZONE_KEYS)) power, emissions and
+    has_data arrays (see `production_vectors`) of datapoints of many
+    datetimes. Datapoints of other datetimes are ignored.
+    """
+    rows = {dt: t for t, dt in enumerate(datetimes)}
+    return _production_arrays(production_datapoints, len(datetimes),
+                              lambda datapoint: rows.get(datapoint['datetime']))
+
+
+def _production_arrays(production_datapoints, length, row_of):
+    # Production is laid out in a sparse ((time, zone) x (zone, mode))
+    # matrix, so that the emissions of all zones are a single product with
+    # the emission factors of every zone and mode
+    rows, columns, values = [], [], []
+    has_data = np.zeros((length, len(ZONE_KEYS)), dtype=bool)
+    for datapoint in production_datapoints:
+        i = ZONE_INDEX.get(datapoint['zoneKey'])
+        t = row_of(datapoint)
+        if i is None or t is None:
+            continue
+        offset = i * len(EMISSION_FACTOR_MODES)
+        for mode, value in (datapoint.get('production') or {}).items():
+            if value:
+                rows.append(t * len(ZONE_KEYS) + i)
+                columns.append(offset + _MODE_COLUMNS.get(mode, _UNKNOWN))
+                values.append(value)
+        for mode, value in (datapoint.get('storage') or {}).items():
+            if value and value < 0:
+                rows.append(t * len(ZONE_KEYS) + i)
+                columns.append(offset + _MODE_COLUMNS.get(
+                    '%s discharge' % mode, _UNKNOWN))
+                values.append(-value)
+        has_data[t, i] = True
+    production = sparse.csr_matrix(
+        (values, (rows, columns)),
+        shape=(length * len(ZONE_KEYS), ZONE_FACTORS.size))
+    power = np.bincount(rows, values, minlength=length * len(ZONE_KEYS))
+    emissions = production.dot(ZONE_FACTORS.ravel())
+    return (power.reshape(length, -1), emissions.reshape(length, -1),
+            has_data)
+
+
+def exchange_vector(exchange_datapoints):
+    """Returns the net flows over EXCHANGE_KEYS, NaN where missing"""
+    return _exchange_array(exchange_datapoints, 1, lambda datapoint: 0)[0]
+
+
+def exchange_stack(exchange_datapoints, datetimes):
+    """
+    Returns the (len(datetimes) x len(EXCHANGE_KEYS)) array of net flows of
+    datapoints of many datetimes, NaN where missing.
+    """
+    rows = {dt: t for t, dt in enumerate(datetimes)}
+    return _exchange_array(exchange_datapoints, len(datetimes),
+                           lambda datapoint: rows.get(datapoint['datetime']))
+
+
+def _exchange_array(exchange_datapoints, length, row_of):
+    flows = np.full((length, len(EXCHANGE_KEYS)), np.nan)
+    for datapoint in exchange_datapoints:
+        j = EXCHANGE_INDEX.get(datapoint['sortedZoneKeys'])
+        t = row_of(datapoint)
+        if j is not None and t is not None and \
+                datapoint.get('netFlow') is not None:
+            flows[t, j] = datapoint['netFlow']
+    return flows
+
+
+# Number of timesteps solved as one block-diagonal system by
+# solve_intensities_batch
+BATCH_SIZE = 100
+
+# Zone masks of the independent grids (connected components of the exchange
+# graph) solved separately. Zones without exchanges are solved together.
+GRID_MASKS = np.array(
+    [np.isin(ZONE_KEYS, component)
+     for component in ZONE_COMPONENTS if len(component) > 1] +
+    [np.isin(ZONE_KEYS, [component[0] for component in ZONE_COMPONENTS
+                         if len(component) == 1])])
+
+
+def _imports(flows):
+    """
+    Returns (timestep, exporter, importer, amount) arrays of the non-zero
+    flows of a (T x len(EXCHANGE_KEYS)) flow array.
+    """
+    timestep, exchange = np.nonzero(~np.isnan(flows) & (flows != 0))
+    flows = flows[timestep, exchange]
+    zones = EXCHANGE_ZONES[exchange]
+    forward = flows > 0
+    exporter = np.where(forward, zones[:, 0], zones[:, 1])
+    importer = np.where(forward, zones[:, 1], zones[:, 0])
+    return timestep, exporter, importer, np.abs(flows)
+
+
+def solve_intensities(power, emissions, has_data, flows,
+                      fallback=FALLBACK_INTENSITIES):
+    """
+    Solves the flow-tracing system of one timestep.
+    Returns the consumption intensities over ZONE_KEYS (gCO2eq/kWh), NaN for
+    zones that can't be solved.
+    """
+    return solve_intensities_batch(
+        power[np.newaxis], emissions[np.newaxis], has_data[np.newaxis],
+        flows[np.newaxis], fallback)[0]
+
+
+def solve_intensities_batch(power, emissions, has_data, flows,
+                            fallback=FALLBACK_INTENSITIES,
+                            batch_size=BATCH_SIZE, executor=None):
+    """
+    Solves the flow-tracing systems of many timesteps.
+
+    power, emissions, has_data: (T x len(ZONE_KEYS)) arrays, see
+      `production_vectors`
+    flows: (T x len(EXCHANGE_KEYS)) array, see `exchange_vector`
+
+    Timesteps are solved `batch_size` at a time, as a single block-diagonal
+    sparse system per grid. Grids are solved in parallel on `executor`
+    (e.g. a concurrent.futures.ThreadPoolExecutor) if given.
+    Returns a (T x len(ZONE_KEYS)) array of consumption intensities
+    (gCO2eq/kWh), NaN for zones that can't be solved.
+    """
+    intensities = np.full(power.shape, np.nan)
+    for start in range(0, len(power), batch_size):
+        block = slice(start, start + batch_size)
+        intensities[block] = _solve_block(power[block], emissions[block],
+                                          has_data[block], flows[block],
+                                          fallback, executor)
+    return intensities
+
+
+def _solve_block(power, emissions, has_data, flows, fallback,
+                 executor=None):
+    # Unknowns are numbered timestep * n + zone index
+    t, n = power.shape
+    timestep, exporter, importer, amount = _imports(flows)
+    exporter = timestep * n + exporter
+    importer = timestep * n + importer
+    fallback = np.tile(fallback, t)
+    power, emissions, has_data = (power.ravel(), emissions.ravel(),
+                                  has_data.ravel())
+    solved = _solvable(power, has_data, exporter, importer,
+                       ~np.isnan(fallback))
+
+    intensities = np.full(t * n, np.nan)
+    if executor is None:
+        intensities[solved] = _solve_system(solved, power, emissions,
+                                            exporter, importer, amount,
+                                            fallback)
+        return intensities.reshape(t, n)
+
+    # Grids don't exchange power: each one is an independent system
+    def solve_grid(zones):
+        unknown = solved & np.tile(zones, t)
+        return unknown, _solve_system(unknown, power, emissions, exporter,
+                                      importer, amount, fallback)
+
+    for unknown, values in executor.map(solve_grid, GRID_MASKS):
+        intensities[unknown] = values
+    return intensities.reshape(t, n)
+
+
+def _solvable(power, has_data, exporter, importer, has_fallback):
+    """
+    Returns the mask of zones with data whose consumed power can be traced
+    back to some production, or to a fallback mix.
+    """
+    solved = has_data & (power > 0)
+    while True:
+        feeds = solved[exporter] | has_fallback[exporter]
+        fed = np.bincount(importer[feeds], minlength=len(power)) > 0
+        new_solved = solved | (has_data & fed)
+        if (new_solved == solved).all():
+            return solved
+        solved = new_solved
+
+
+def _solve_system(unknown, power, emissions, exporter, importer, amount,
+                  known):
+    """
+    Solves the balance equations of the `unknown` zones.
+    Power imported from other zones has their `known` intensity, and is
+    ignored where it is NaN.
+    Returns the intensities of the unknown zones, all NaN if the system is
+    singular.
+    """
+    size = len(power)
+    # Imports into other zones don't matter
+    into_unknown = unknown[importer]
+    exporter, importer, amount = (exporter[into_unknown],
+                                  importer[into_unknown], amount[into_unknown])
+    coupled = unknown[exporter]
+    from_known = ~coupled & ~np.isnan(known[exporter])
+    counted = coupled | from_known
+
+    rows = np.cumsum(unknown) - 1  # zone -> row in the system
+    n_rows = int(unknown.sum())
+    if not n_rows:
+        return np.zeros(0)
+    diagonal = (power + np.bincount(importer[counted], amount[counted],
+                                    minlength=size))[unknown]
+    rhs = (emissions + np.bincount(
+        importer[from_known],
+        amount[from_known] * known[exporter[from_known]],
+        minlength=size))[unknown]
+    matrix = sparse.csc_matrix(
+        (np.concatenate([diagonal, -amount[coupled]]),
+         (np.concatenate([np.arange(n_rows), rows[importer[coupled]]]),
+          np.concatenate([np.arange(n_rows), rows[exporter[coupled]]]))),
+        shape=(n_rows, n_rows))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', MatrixRankWarning)
+        try:
+            return np.atleast_1d(spsolve(matrix, rhs))
+        except MatrixRankWarning:
+            return np.full(n_rows, np.nan)
+
+
+def exchange_intensities(intensities, flows, fallback=FALLBACK_INTENSITIES):
+    """
+    Returns the intensity of the power flowing through each exchange of
+    EXCHANGE_KEYS: the intensity of its exporting zone, or its fallback mix.
+    Works on a single timestep or on (T x ...) stacks.
+    """
+    exporter = np.where(flows < 0, EXCHANGE_ZONES[:, 1], EXCHANGE_ZONES[:, 0])
+    leading = tuple(np.indices(exporter.shape)[:-1])
+    result = intensities[leading + (exporter,)]
+    missing = np.isnan(result)
+    result[missing] = fallback[exporter[missing]]
+    result[np.isnan(flows)] = np.nan
+    return result
+
+
+def _to_dict(keys, values):
+    return {k: float(v) for k, v in zip(keys, values) if not np.isnan(v)}
+
+
+def compute_intensities(production_datapoints, exchange_datapoints):
+    """
+    Computes carbon intensities from the production and exchange datapoints
+    of one point in time.
+
+    Returns a dict with keys
+      'zones': dict of zone key -> consumption intensity (gCO2eq/kWh)
+      'exchanges': dict of sorted zone keys -> intensity of the exchanged
+        power
+    Zones and exchanges that can't be computed are left out.
+    """
+    power, emissions, has_data = production_vectors(production_datapoints)
+    flows = exchange_vector(exchange_datapoints)
+    intensities = solve_intensities(power, emissions, has_data, flows)
+    return {
+        'zones': _to_dict(ZONE_KEYS, intensities),
+        'exchanges': _to_dict(EXCHANGE_KEYS,
+                              exchange_intensities(intensities, flows)),
+    }
+
+
+def compute_intensity_history(production_datapoints, exchange_datapoints,
+                              executor=None):
+    """
+    Computes carbon intensities at every datetime of the production
+    datapoints, all timesteps being solved in batch (grids in parallel on
+    `executor`, see `solve_intensities_batch`).
+
+    Returns a dict with keys
+      'datetimes': sorted list of datetimes
+      'zones': (len(datetimes) x len(ZONE_KEYS)) array of consumption
+        intensities, NaN where they can't be computed
+      'exchanges': (len(datetimes) x len(EXCHANGE_KEYS)) array of the
+        intensities of the exchanged power
+    """
+    datetimes = sorted({d['datetime'] for d in production_datapoints})
+    power, emissions, has_data = production_stack(production_datapoints,
+                                                  datetimes)
+    flows = exchange_stack(exchange_datapoints, datetimes)
+    intensities = solve_intensities_batch(power, emissions, has_data, flows,
+                                          executor=executor)
+    return {
+        'datetimes': datetimes,
+        'zones': intensities,
+        'exchanges': exchange_intensities(intensities, flows),
+    }
+
+
+# Changes of intensity (gCO2eq/kWh) reported by IncrementalSolver
+CHANGE_THRESHOLD = 1.0
+
+
+class IncrementalSolver(object):
+    """
+    Keeps the latest production, exchanges and intensities of all zones, and
+    re-solves only the zones affected by new datapoints.
+
+    A change in the production of a zone, or in an exchange, only affects
+    the zones whose balance equation changed and the zones downstream of
+    them, i.e. importing (directly or not) from them. Only these zones are
+    solved again, the intensities of the others being kept as they are.
+    """
+
+    def __init__(self, threshold=CHANGE_THRESHOLD,
+                 fallback=FALLBACK_INTENSITIES):
+        self.threshold = threshold
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        n = len(ZONE_KEYS)
+        self.power = np.zeros(n)
+        self.emissions = np.zeros(n)
+        self.has_data = np.zeros(n, dtype=bool)
+        self.flows = np.full(len(EXCHANGE_KEYS), np.nan)
+        self.solved = np.zeros(n, dtype=bool)
+        self.intensities = np.full(n, np.nan)
+
+    def update(self, production_datapoints=(), exchange_datapoints=()):
+        """
+        Applies new production and exchange datapoints (replacing the
+        previous ones of the same zones and exchanges) and re-solves the
+        affected zones.
+        Returns a dict of zone key -> (previous intensity, new intensity) for
+        the zones whose intensity changed by more than `threshold`
+        (appearing or disappearing intensities being None).
+        """
+        with self._lock:
+            seeds = np.zeros(len(ZONE_KEYS), dtype=bool)
+            for datapoint in production_datapoints:
+                i = ZONE_INDEX.get(datapoint['zoneKey'])
+                if i is None:
+                    continue
+                power, emissions, _ = production_vectors([datapoint])
+                self.power[i] = power[i]
+                self.emissions[i] = emissions[i]
+                self.has_data[i] = True
+                seeds[i] = True
+            for datapoint in exchange_datapoints:
+                j = EXCHANGE_INDEX.get(datapoint['sortedZoneKeys'])
+                if j is None:
+                    continue
+                net_flow = datapoint.get('netFlow')
+                self.flows[j] = np.nan if net_flow is None else net_flow
+                seeds[EXCHANGE_ZONES[j]] = True
+            return self._resolve(seeds)
+
+    def remove_production(self, zone_key):
+        """Forgets the production of `zone_key`, see `update`"""
+        with self._lock:
+            i = ZONE_INDEX[zone_key]
+            self.power[i] = self.emissions[i] = 0
+            self.has_data[i] = False
+            seeds = np.zeros(len(ZONE_KEYS), dtype=bool)
+            seeds[i] = True
+            return self._resolve(seeds)
+
+    def _resolve(self, seeds):
+        _, exporter, importer, amount = _imports(self.flows[np.newaxis])
+        solved = _solvable(self.power, self.has_data, exporter, importer,
+                           ~np.isnan(self.fallback))
+        # Zones that became (un)solvable changed as well
+        seeds = seeds | (solved != self.solved)
+        affected = seeds
+        while True:
+            reached = np.bincount(importer[affected[exporter]],
+                                  minlength=len(ZONE_KEYS)) > 0
+            new_affected = affected | reached
+            if (new_affected == affected).all():
+                break
+            affected = new_affected
+
+        previous = self.intensities
+        intensities = previous.copy()
+        intensities[affected] = np.nan
+        unknown = affected & solved
+        known = np.where(solved & ~affected, previous, self.fallback)
+        intensities[unknown] = _solve_system(unknown, self.power,
+                                             self.emissions, exporter,
+                                             importer, amount, known)
+        self.solved = solved
+        self.intensities = intensities
+
+        changed = {}
+        for i in np.flatnonzero(affected):
+            before, after = previous[i], intensities[i]
+            if np.isnan(before) and np.isnan(after):
+                continue
+            if np.isnan(before) or np.isnan(after) or \
+                    abs(after - before) > self.threshold:
+                changed[ZONE_KEYS[i]] = (
+                    None if np.isnan(before) else float(before),
+                    None if np.isnan(after) else float(after))
+        return changed
+
+    def zone_intensities(self):
+        """Returns a dict of zone key -> consumption intensity"""
+        return _to_dict(ZONE_KEYS, self.intensities)
+
+    def exchange_intensities(self):
+        """Returns a dict of sorted zone keys -> intensity of exchanged power"""
+        return _to_dict(EXCHANGE_KEYS, exchange_intensities(
+            self.intensities, self.flows, self.fallback))
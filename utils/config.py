@@ -1,5 +1,13 @@
+"""
+Zones, exchanges and CO2eq parameters of config/, and the indexes derived
+from them.
+"""
+
+from functools import lru_cache
 import json
 import os
+from types import MappingProxyType
+
 
 def relative_path(script_reference_path, rel_path):
     # __file__ should be passed as script_reference_path
@@ -9,43 +17,119 @@ def relative_path(script_reference_path, rel_path):
     return os.path.join(script_dir, rel_path)
 
 
-# Prepare zone bounding boxes
-ZONE_BOUNDING_BOXES = {}
-
-# Read parser import list from config jsons
-ZONES_CONFIG = json.load(open(relative_path(
-    __file__, '../config/zones.json')))
-
-# Read all zones
-for zone_id, zone_config in ZONES_CONFIG.items():
-    if 'bounding_box' in zone_config:
-        ZONE_BOUNDING_BOXES[zone_id] = zone_config['bounding_box']
-
-# Read parser import list from config jsons
-ZONES_CONFIG = json.load(open(relative_path(
-    __file__, '../config/zones.json')))
-EXCHANGES_CONFIG = json.load(open(relative_path(
-    __file__, '../config/exchanges.json')))
-ZONE_NEIGHBOURS = {}
-for k, v in EXCHANGES_CONFIG.items():
-    zone_names = k.split('->')
-    pairs = [
-        (zone_names[0], zone_names[1]),
-        (zone_names[1], zone_names[0])
-    ]
-    for zone_name_1, zone_name_2 in pairs:
-        if zone_name_1 not in ZONE_NEIGHBOURS:
-            ZONE_NEIGHBOURS[zone_name_1] = set()
-        ZONE_NEIGHBOURS[zone_name_1].add(zone_name_2)
-# we want neighbors to always be in the same order
-for zone, neighbors in ZONE_NEIGHBOURS.items():
-    ZONE_NEIGHBOURS[zone] = sorted(neighbors)
-
-CO2EQ_PARAMETERS = json.load(open(relative_path(
-    __file__, '../config/co2eq_parameters.json')))
+CONFIG_DIR = relative_path(__file__, '../config')
+
+
+def connected_components(zone_keys, neighbours):
+    """
+    Returns the connected components of the exchange graph, as sorted lists
+    of zone keys, largest first. Zones without exchanges are components of
+    their own.
+    """
+    components, seen = [], set()
+    for zone_key in zone_keys:
+        if zone_key in seen:
+            continue
+        seen.add(zone_key)
+        component, to_visit = [], [zone_key]
+        while to_visit:
+            current = to_visit.pop()
+            component.append(current)
+            for neighbour in neighbours.get(current, []):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    to_visit.append(neighbour)
+        components.append(sorted(component))
+    return sorted(components, key=lambda c: (-len(c), c[0]))
+
+
+def compile_config(config_dir=CONFIG_DIR):
+    """Parses the JSON files of `config_dir` and derives their indexes"""
+    config = {}
+    for name, filename in [('ZONES_CONFIG', 'zones.json'),
+                           ('EXCHANGES_CONFIG', 'exchanges.json'),
+                           ('CO2EQ_PARAMETERS', 'co2eq_parameters.json')]:
+        with open(os.path.join(config_dir, filename)) as f:
+            config[name] = json.load(f)
+    zones_config = config['ZONES_CONFIG']
+    exchanges_config = config['EXCHANGES_CONFIG']
+
+    # Zone bounding boxes
+    config['ZONE_BOUNDING_BOXES'] = {
+        zone_id: zone_config['bounding_box']
+        for zone_id, zone_config in zones_config.items()
+        if 'bounding_box' in zone_config}
+
+    zone_neighbours = {}
+    for k in exchanges_config:
+        zone_names = k.split('->')
+        pairs = [
+            (zone_names[0], zone_names[1]),
+            (zone_names[1], zone_names[0])
+        ]
+        for zone_name_1, zone_name_2 in pairs:
+            zone_neighbours.setdefault(zone_name_1, set()).add(zone_name_2)
+    # we want neighbors to always be in the same order
+    config['ZONE_NEIGHBOURS'] = {
+        zone: sorted(neighbors) for zone, neighbors in zone_neighbours.items()}
 
+    # Stable ordering of all zones (configured or part of an exchange) and
+    # exchanges, used to lay out per zone and per exchange arrays
+    zone_keys = sorted(set(zones_config) | set(zone_neighbours))
+    config['ZONE_KEYS'] = zone_keys
+    config['ZONE_INDEX'] = {k: i for i, k in enumerate(zone_keys)}
+    config['EXCHANGE_KEYS'] = sorted(exchanges_config)
+    config['EXCHANGE_INDEX'] = {
+        k: i for i, k in enumerate(config['EXCHANGE_KEYS'])}
+
+    # Independent grids (e.g. Europe, North America, Japan) exchange no
+    # power: they can be collected and solved separately
+    components = connected_components(zone_keys, config['ZONE_NEIGHBOURS'])
+    config['ZONE_COMPONENTS'] = components
+    config['ZONE_COMPONENT_INDEX'] = {
+        zone_key: c for c, component in enumerate(components)
+        for zone_key in component}
+
+    # Production modes having an emission factor, in a stable order
+    factors = config['CO2EQ_PARAMETERS']['emissionFactors']
+    modes = sorted(set(factors['defaults']) |
+                   {mode for v in factors['zoneOverrides'].values()
+                    for mode in v})
+    config['EMISSION_FACTOR_MODES'] = modes
+    config['EMISSION_FACTOR_MODE_INDEX'] = {
+        mode: j for j, mode in enumerate(modes)}
+    return config
+
+
+_config = compile_config()
+
+ZONES_CONFIG = _config['ZONES_CONFIG']
+EXCHANGES_CONFIG = _config['EXCHANGES_CONFIG']
+CO2EQ_PARAMETERS = _config['CO2EQ_PARAMETERS']
+ZONE_BOUNDING_BOXES = _config['ZONE_BOUNDING_BOXES']
+ZONE_NEIGHBOURS = _config['ZONE_NEIGHBOURS']
+ZONE_KEYS = _config['ZONE_KEYS']
+ZONE_INDEX = _config['ZONE_INDEX']
+EXCHANGE_KEYS = _config['EXCHANGE_KEYS']
+EXCHANGE_INDEX = _config['EXCHANGE_INDEX']
+ZONE_COMPONENTS = _config['ZONE_COMPONENTS']
+ZONE_COMPONENT_INDEX = _config['ZONE_COMPONENT_INDEX']
+EMISSION_FACTOR_MODES = _config['EMISSION_FACTOR_MODES']
+EMISSION_FACTOR_MODE_INDEX = _config['EMISSION_FACTOR_MODE_INDEX']
+
+
+@lru_cache(maxsize=None)
 def emission_factors(zone_key):
-    override = CO2EQ_PARAMETERS['emissionFactors']['zoneOverrides'].get(zone_key, {})
-    defaults = CO2EQ_PARAMETERS['emissionFactors']['defaults']
-    merged = {**defaults, **override}
-    return dict([(k, (v or {}).get('value')) for (k, v) in merged.items()])
+    """
+    Returns a read-only mapping of mode -> emission factor (gCO2eq/kWh) of
+    `zone_key` (None where missing), built once per zone. The (zone x mode)
+    matrix of factors used by computations is EMISSION_FACTORS of
+    utils/carbon.py.
+    """
+    factors = CO2EQ_PARAMETERS['emissionFactors']
+    merged = dict(factors['defaults'],
+                  **factors['zoneOverrides'].get(zone_key, {}))
+    return MappingProxyType({
+        mode: (merged.get(mode) or {}).get('value')
+        for mode in EMISSION_FACTOR_MODES})
+
@@ -0,0 +1,271 @@
+"""
+Concurrent runner collecting the latest data of a fleet of zone and exchange
+parsers.
+
+Every parser is run in its own worker thread, with at most `max_workers`
+parsers running at the same time. A parser that does not return within
+`timeout` seconds is abandoned: it is reported as timed out and the next
+parsers in line are started, so that one hanging source cannot stall the
+whole collection. Threads cannot be killed though: an abandoned parser keeps
+its slot until it returns, so that there are never more than `max_workers`
+threads. When all slots are held by abandoned parsers for another `timeout`
+seconds, the parsers still waiting are reported as not run.
+
+All parsers of a collection share one coalescing session (see
+parsers/lib/web.py), so an upstream document used by several zones or
+exchanges is only fetched once per collection.
+
+Independent grids (connected components of the exchange graph) are
+completed separately: once all parsers of a grid are done, its datapoints
+are checked at once by the quality checks of parsers/lib/quality.py, against
+the time at which the grid was completed, and handed over without waiting
+for the parsers of other grids. Handing over runs in a small pool of
+threads of its own, so that slow consumers do not delay the parsers. Production values exceeding the installed
+capacity of their zone (see parsers/lib/capacity.py) are logged.
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import queue
+import threading
+import time
+import traceback
+
+from parsers.lib import capacity, quality, web
+from utils.config import ZONE_COMPONENT_INDEX
+from utils.graph import EXCHANGE_GRAPH
+from utils.parsers import PARSER_KEY_TO_DICT
+
+DEFAULT_MAX_WORKERS = 16
+# Seconds a single parser is allowed to run before it is abandoned
+DEFAULT_TIMEOUT = 60
+# Threads running `on_component` callbacks of a collection
+CALLBACK_WORKERS = 2
+
+
+def exchange_keys_for_zones(zone_keys):
+    """Returns the sorted exchange keys having at least one end in `zone_keys`"""
+    zones = [EXCHANGE_GRAPH.zone_index[k] for k in zone_keys
+             if k in EXCHANGE_GRAPH.zone_index]
+    return [EXCHANGE_GRAPH.exchange_keys[j]
+            for j in EXCHANGE_GRAPH.exchanges_of(zones)]
+
+
+def make_jobs(zone_keys, exchange_keys):
+    """
+    Returns a tuple `(jobs, missing)` where `jobs` is a list of
+    (parser_key, key) to run and `missing` lists the (parser_key, key) pairs
+    for which no parser is configured.
+    """
+    jobs, missing = [], []
+    for parser_key, keys in [('production', zone_keys),
+                             ('exchange', exchange_keys)]:
+        for k in keys:
+            if k in PARSER_KEY_TO_DICT[parser_key]:
+                jobs.append((parser_key, k))
+            else:
+                missing.append((parser_key, k))
+    return jobs, missing
+
+
+def run_job(parser_key, key, session=None):
+    """Runs a single parser and returns its most recent datapoint (or None)"""
+    # Parser modules are imported here, in the worker thread
+    parser = PARSER_KEY_TO_DICT[parser_key][key]
+    if parser_key == 'exchange':
+        result = parser(*sorted(key.split('->')), session=session)
+    else:
+        result = parser(key, session=session)
+    if isinstance(result, list):
+        result = result[-1] if result else None
+    return result
+
+
+def job_component(parser_key, key):
+    """
+    Returns the index in ZONE_COMPONENTS of the grid a job belongs to, or
+    None for zones unknown to the config.
+    """
+    return ZONE_COMPONENT_INDEX.get(key.split('->')[0])
+
+
+def collect(zone_keys, exchange_keys, max_workers=DEFAULT_MAX_WORKERS,
+            timeout=DEFAULT_TIMEOUT, on_component=None,
+            logger=logging.getLogger(__name__)):
+    """
+    Runs the production parsers of `zone_keys` and the exchange parsers of
+    `exchange_keys` concurrently.
+
+    Returns a dict with keys
+      'production': list of production datapoints
+      'exchange': list of exchange datapoints
+      'errors': dict of (parser_key, key) -> error description, covering
+        parsers that raised, returned nothing, timed out or returned a
+        datapoint failing the quality checks.
+
+    Grids (see ZONE_COMPONENTS of utils/config.py) are independent: as soon
+    as all parsers of a grid are done, its results (a dict of the same
+    shape) are checked and passed to `on_component(component, results)`,
+    `component` being the index of the grid in ZONE_COMPONENTS. A slow
+    parser thus only delays the results of its own grid. Calls to
+    `on_component` run concurrently in CALLBACK_WORKERS threads, and have
+    all returned when `collect` does. Errors they raise are logged.
+
+    Zones unknown to the config belong to no grid: their parsers are not
+    run.
+    """
+    jobs, missing = make_jobs(zone_keys, exchange_keys)
+    for parser_key, k in missing:
+        logger.info('No %s parser found for %s', parser_key, k)
+    for parser_key, k in jobs:
+        if job_component(parser_key, k) is None:
+            logger.warning('Skipping %s %s: zone not found in the config',
+                           parser_key, k)
+    jobs = [job for job in jobs if job_component(*job) is not None]
+
+    results = {'production': [], 'exchange': [], 'errors': {}}
+
+    def callback(component, component_results):
+        try:
+            on_component(component, component_results)
+        except Exception:
+            logger.error('Error handing over grid %s:\n%s', component,
+                         traceback.format_exc())
+
+    with ThreadPoolExecutor(max_workers=CALLBACK_WORKERS) as executor:
+
+        def component_done(component, collected):
+            component_results = _check(collected, logger)
+            for parser_key in ['production', 'exchange']:
+                results[parser_key].extend(component_results[parser_key])
+            results['errors'].update(component_results['errors'])
+            if on_component is not None:
+                executor.submit(callback, component, component_results)
+
+        with web.collection_cycle() as session:
+            _run_jobs(jobs, session, component_done, max_workers, timeout,
+                      logger)
+    return results
+
+
+def _check(collected, logger):
+    """
+    Runs the quality checks on collected (key, datapoint) lists, against the
+    current time. Returns a dict of valid datapoints and errors, in the
+    format returned by `collect`.
+    """
+    results = {'errors': dict(collected['errors'])}
+    now = quality.utcnow()
+    for parser_key in ['production', 'exchange']:
+        items = collected[parser_key]
+        failures = quality.validate_batch(parser_key, items, now=now)
+        for failure in failures:
+            logger.error('Invalid %s %s: %s', parser_key, failure.key,
+                         failure.error)
+            results['errors'][(parser_key, failure.key)] = \
+                'invalid datapoint: {}'.format(failure.error)
+        failed = {failure.index for failure in failures}
+        results[parser_key] = [datapoint
+                               for i, (_, datapoint) in enumerate(items)
+                               if i not in failed]
+    capacity.flag_anomalies(results['production'], logger=logger)
+    return results
+
+
+def _run_jobs(jobs, session, component_done, max_workers, timeout, logger):
+    """
+    Runs `jobs`. Once all jobs of a grid have ended, calls
+    `component_done(component, collected)`, `collected` being a dict of
+      'production', 'exchange': list of collected (key, datapoint)
+      'errors': dict of (parser_key, key) -> error description
+    """
+    pending = collections.Counter(job_component(*job) for job in jobs)
+    collected = {component: {'production': [], 'exchange': [], 'errors': {}}
+                 for component in pending}
+    done = queue.Queue()
+    # Number of started threads that have not returned, abandoned or not
+    live = [0]
+    live_lock = threading.Lock()
+
+    def work(job):
+        try:
+            # Every parser has its own cookies (see CoalescingSession.fork)
+            outcome = (job, run_job(*job, session=session.fork()), None)
+        except Exception:
+            outcome = (job, None, traceback.format_exc())
+        with live_lock:
+            live[0] -= 1
+        done.put(outcome)
+
+    def ended(job):
+        component = job_component(*job)
+        pending[component] -= 1
+        if not pending[component]:
+            component_done(component, collected.pop(component))
+
+    to_start = list(reversed(jobs))
+    running = {}  # job -> start time
+    stalled_since = None
+    while to_start or running:
+        with live_lock:
+            while to_start and live[0] < max_workers:
+                job = to_start.pop()
+                running[job] = time.time()
+                live[0] += 1
+                # Daemon threads: an abandoned parser must not prevent exit
+                threading.Thread(target=work, args=(job,),
+                                 daemon=True).start()
+
+        if running:
+            stalled_since = None
+            next_deadline = min(running.values()) + timeout
+        else:
+            # All slots are held by abandoned parsers
+            if stalled_since is None:
+                stalled_since = time.time()
+                logger.warning('All %s workers are held by timed out '
+                               'parsers, %s parsers waiting',
+                               max_workers, len(to_start))
+            next_deadline = stalled_since + timeout
+        try:
+            job, datapoint, error = done.get(
+                timeout=max(0, next_deadline - time.time()))
+        except queue.Empty:
+            if not running:
+                for job in reversed(to_start):
+                    parser_key, k = job
+                    logger.error('No worker available for %s %s',
+                                 parser_key, k)
+                    collected[job_component(*job)]['errors'][job] = \
+                        'not run: all workers held by timed out parsers'
+                    ended(job)
+                to_start = []
+        else:
+            # Results of parsers that already timed out are dropped
+            if running.pop(job, None) is not None:
+                parser_key, k = job
+                component = collected[job_component(*job)]
+                if error:
+                    logger.error('Error collecting %s %s:\n%s',
+                                 parser_key, k, error)
+                    component['errors'][job] = error
+                elif not datapoint:
+                    logger.warning('Warning: no %s data returned by %s',
+                                   parser_key, k)
+                    component['errors'][job] = 'no data returned'
+                else:
+                    logger.info('Collected %s %s', parser_key, k)
+                    component[parser_key].append((k, datapoint))
+                ended(job)
+
+        now = time.time()
+        for job, started_at in list(running.items()):
+            if now - started_at > timeout:
+                parser_key, k = job
+                logger.error('Timeout collecting %s %s after %ss',
+                             parser_key, k, timeout)
+                collected[job_component(*job)]['errors'][job] = \
+                    'timed out after {}s'.format(timeout)
+                del running[job]
+                ended(job)
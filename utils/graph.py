@@ -0,0 +1,139 @@
+"""
+Array-backed graph of zones (nodes) and exchanges (edges).
+
+Zones are numbered as in ZONE_KEYS and exchanges as in EXCHANGE_KEYS of
+utils/config.py. Exchange k links edge_zones[k] = (a, b), a and b being the
+zones of its sorted zone keys "a->b": a positive netFlow goes from a to b.
+
+The adjacency of every zone is stored in CSR form: the neighbours of zone i
+are indices[indptr[i]:indptr[i + 1]], linked by the exchanges
+edges[indptr[i]:indptr[i + 1]], and signs is +1 where a positive netFlow of
+the exchange is imported by zone i, -1 where it is exported.
+
+Aggregates over exchanges (net imports, imports, exports, flow balance) are
+computed for a whole vector of flows (or a (time x exchange) stack) at once.
+"""
+
+import numpy as np
+from scipy import sparse
+
+from utils.config import EXCHANGE_KEYS, ZONE_KEYS, connected_components
+
+
+def _frozen(array):
+    array.flags.writeable = False
+    return array
+
+
+class ExchangeGraph(object):
+    """Immutable exchange graph, see module docstring"""
+
+    def __init__(self, zone_keys, exchange_keys):
+        self.zone_keys = list(zone_keys)
+        self.exchange_keys = list(exchange_keys)
+        self.zone_index = {k: i for i, k in enumerate(self.zone_keys)}
+        self.exchange_index = {k: j for j, k in enumerate(self.exchange_keys)}
+        self.edge_zones = _frozen(np.array(
+            [[self.zone_index[z] for z in k.split('->')]
+             for k in self.exchange_keys], dtype=int).reshape(-1, 2))
+
+        # Every exchange is listed twice, from each of its ends
+        n, m = len(self.zone_keys), len(self.exchange_keys)
+        rows = np.concatenate([self.edge_zones[:, 0], self.edge_zones[:, 1]])
+        order = np.argsort(rows, kind='mergesort')
+        self.indptr = _frozen(np.searchsorted(rows[order], np.arange(n + 1)))
+        self.indices = _frozen(np.concatenate(
+            [self.edge_zones[:, 1], self.edge_zones[:, 0]])[order])
+        self.edges = _frozen(np.tile(np.arange(m), 2)[order])
+        self.signs = _frozen(np.repeat([-1, 1], m)[order])
+
+        # (zone x exchange) matrices of the first and second zone of every
+        # exchange, and the incidence matrix: net imports = incidence . flows
+        self._first = sparse.csr_matrix(
+            (np.ones(m), (self.edge_zones[:, 0], np.arange(m))), shape=(n, m))
+        self._second = sparse.csr_matrix(
+            (np.ones(m), (self.edge_zones[:, 1], np.arange(m))), shape=(n, m))
+        self.incidence = self._second - self._first
+
+    @property
+    def n_zones(self):
+        return len(self.zone_keys)
+
+    @property
+    def n_exchanges(self):
+        return len(self.exchange_keys)
+
+    def neighbours(self, zone):
+        """Returns the indices of the neighbours of zone index `zone`"""
+        return self.indices[self.indptr[zone]:self.indptr[zone + 1]]
+
+    def edge(self, exchange_key):
+        """
+        Returns the (exchange index, first zone index, second zone index) of
+        `exchange_key`, a positive netFlow going from the first zone to the
+        second one.
+        """
+        j = self.exchange_index[exchange_key]
+        return (j,) + tuple(int(i) for i in self.edge_zones[j])
+
+    def exchanges_of(self, zones):
+        """Returns the sorted indices of exchanges touching any of `zones`"""
+        zones = np.asarray(zones, dtype=int)
+        mask = np.zeros(self.n_zones, dtype=bool)
+        mask[zones] = True
+        return np.flatnonzero(mask[self.edge_zones].any(axis=1))
+
+    def degree(self):
+        """Returns the number of exchanges of every zone"""
+        return np.diff(self.indptr)
+
+    def _product(self, matrix, flows):
+        # (... x exchange) -> (... x zone), missing (NaN) flows count as 0
+        flows = np.nan_to_num(np.asarray(flows, dtype=float))
+        result = matrix.dot(flows.reshape(-1, self.n_exchanges).T).T
+        return result.reshape(flows.shape[:-1] + (self.n_zones,))
+
+    def net_imports(self, flows):
+        """
+        Returns the net imports of every zone (imports - exports) from net
+        flows over exchanges, on a vector or (time x exchange) stack.
+        """
+        return self._product(self.incidence, flows)
+
+    def imports(self, flows):
+        """Returns the total imports of every zone"""
+        flows = np.asarray(flows, dtype=float)
+        return (self._product(self._second, np.fmax(flows, 0)) +
+                self._product(self._first, np.fmax(-flows, 0)))
+
+    def exports(self, flows):
+        """Returns the total exports of every zone"""
+        flows = np.asarray(flows, dtype=float)
+        return (self._product(self._first, np.fmax(flows, 0)) +
+                self._product(self._second, np.fmax(-flows, 0)))
+
+    def flow_balance(self, production, consumption, flows):
+        """
+        Returns production + net imports - consumption of every zone, i.e. 0
+        for zones whose data is consistent.
+        """
+        return (np.asarray(production, dtype=float) +
+                self.net_imports(flows) -
+                np.asarray(consumption, dtype=float))
+
+    def components(self):
+        """
+        Returns the connected component label of every zone, labels being
+        the indices of `connected_components` of utils/config.py (the same
+        as ZONE_COMPONENT_INDEX for EXCHANGE_GRAPH).
+        """
+        neighbours = {zone_key: [self.zone_keys[j] for j in self.neighbours(i)]
+                      for i, zone_key in enumerate(self.zone_keys)}
+        labels = np.empty(self.n_zones, dtype=int)
+        for c, component in enumerate(
+                connected_components(self.zone_keys, neighbours)):
+            labels[[self.zone_index[k] for k in component]] = c
+        return labels
+
+
+EXCHANGE_GRAPH = ExchangeGraph(ZONE_KEYS, EXCHANGE_KEYS)
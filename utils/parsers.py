@@ -1,17 +1,60 @@
 import importlib
+from collections.abc import Mapping
 
 from utils.config import ZONES_CONFIG, EXCHANGES_CONFIG
 
+
+class LazyParserDict(Mapping):
+    """
+    Read-only mapping of zone/exchange key -> parser function.
+
+    Parsers are registered as "MODULE.function" strings and only imported on
+    first lookup, so that using a single parser doesn't import every parser
+    module (and their dependencies).
+    """
+
+    def __init__(self):
+        self._parser_names = {}
+        self._parsers = {}
+
+    def register(self, key, parser_name):
+        self._parser_names[key] = parser_name
+        self._parsers.pop(key, None)
+
+    def parser_name(self, key):
+        """Returns the "MODULE.function" string registered for `key`"""
+        return self._parser_names[key]
+
+    def __getitem__(self, key):
+        try:
+            return self._parsers[key]
+        except KeyError:
+            pass
+        mod_name, fun_name = self._parser_names[key].split('.')
+        mod = importlib.import_module('parsers.%s' % mod_name)
+        parser = self._parsers[key] = getattr(mod, fun_name)
+        return parser
+
+    def __iter__(self):
+        return iter(self._parser_names)
+
+    def __len__(self):
+        return len(self._parser_names)
+
+    def __contains__(self, key):
+        return key in self._parser_names
+
+
 # Prepare all parsers
-CONSUMPTION_PARSERS = {}
-PRODUCTION_PARSERS = {}
-PRODUCTION_PER_MODE_FORECAST_PARSERS = {}
-PRODUCTION_PER_UNIT_PARSERS = {}
-EXCHANGE_PARSERS = {}
-PRICE_PARSERS = {}
-CONSUMPTION_FORECAST_PARSERS = {}
-GENERATION_FORECAST_PARSERS = {}
-EXCHANGE_FORECAST_PARSERS = {}
+CONSUMPTION_PARSERS = LazyParserDict()
+PRODUCTION_PARSERS = LazyParserDict()
+PRODUCTION_PER_MODE_FORECAST_PARSERS = LazyParserDict()
+PRODUCTION_PER_UNIT_PARSERS = LazyParserDict()
+EXCHANGE_PARSERS = LazyParserDict()
+PRICE_PARSERS = LazyParserDict()
+CONSUMPTION_FORECAST_PARSERS = LazyParserDict()
+GENERATION_FORECAST_PARSERS = LazyParserDict()
+EXCHANGE_FORECAST_PARSERS = LazyParserDict()
 
 PARSER_KEY_TO_DICT = {
     'consumption': CONSUMPTION_PARSERS,
@@ -28,13 +71,24 @@ PARSER_KEY_TO_DICT = {
 # Read all zones
 for zone_id, zone_config in ZONES_CONFIG.items():
     for parser_key, v in zone_config.get('parsers', {}).items():
-        mod_name, fun_name = v.split('.')
-        mod = importlib.import_module('parsers.%s' % mod_name)
-        PARSER_KEY_TO_DICT[parser_key][zone_id] = getattr(mod, fun_name)
+        PARSER_KEY_TO_DICT[parser_key].register(zone_id, v)
 
 # Read all exchanges
 for exchange_id, exchange_config in EXCHANGES_CONFIG.items():
     for parser_key, v in exchange_config.get('parsers', {}).items():
-        mod_name, fun_name = v.split('.')
-        mod = importlib.import_module('parsers.%s' % mod_name)
-        PARSER_KEY_TO_DICT[parser_key][exchange_id] = getattr(mod, fun_name)
+        PARSER_KEY_TO_DICT[parser_key].register(exchange_id, v)
+
+
+def warm_up(parser_keys=None, keys=None):
+    """
+    Imports parsers ahead of their first use.
+
+    parser_keys: parser types to load (e.g. ['production', 'exchange']),
+      defaults to all of them.
+    keys: zone or exchange keys to load, defaults to all of them.
+    """
+    for parser_key in parser_keys or PARSER_KEY_TO_DICT.keys():
+        parsers = PARSER_KEY_TO_DICT[parser_key]
+        for k in (keys if keys is not None else list(parsers)):
+            if k in parsers:
+                parsers[k]
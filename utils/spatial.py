@@ -0,0 +1,144 @@
+"""
+Point to zone lookup over the bounding boxes of config/zones.json.
+
+Bounding boxes are [[lon min, lat min], [lon max, lat max]]. They are
+indexed once in a regular grid of `resolution` degree cells, each cell
+listing the boxes overlapping it, so that a lookup only tests the few boxes
+of the cell of each point instead of all of them. Lookups are vectorized
+over NumPy arrays of longitudes and latitudes.
+
+Boxes may overlap: a point gets all the zones whose box contains it as
+candidates, `lookup` picking the smallest box. Boxes crossing the
+antimeridian, given either with lon min > lon max or with longitudes beyond
+±180, are split in two at the antimeridian.
+"""
+
+import numpy as np
+
+from utils.config import ZONE_BOUNDING_BOXES
+
+DEFAULT_RESOLUTION = 1.0  # degrees
+
+
+def _normalize_longitudes(lons):
+    """Wraps longitudes into [-180, 180)"""
+    return np.mod(np.asarray(lons, dtype=float) + 180, 360) - 180
+
+
+def _split_at_antimeridian(box):
+    """Returns the list of boxes, within [-180, 180], covering `box`"""
+    (lon_min, lat_min), (lon_max, lat_max) = box
+    if lon_max - lon_min >= 360:
+        return [((-180, lat_min), (180, lat_max))]
+    lon_min = float(_normalize_longitudes(lon_min))
+    lon_max = float(_normalize_longitudes(lon_max))
+    if lon_max == -180 and lon_min > lon_max:
+        lon_max = 180
+    if lon_min <= lon_max:
+        return [((lon_min, lat_min), (lon_max, lat_max))]
+    return [((lon_min, lat_min), (180, lat_max)),
+            ((-180, lat_min), (lon_max, lat_max))]
+
+
+class BoundingBoxIndex(object):
+    """Grid index of the bounding boxes of zones"""
+
+    def __init__(self, bounding_boxes, resolution=DEFAULT_RESOLUTION):
+        self.zone_keys = sorted(bounding_boxes)
+        self.resolution = resolution
+        self.n_columns = int(np.ceil(360 / resolution))
+        self.n_rows = int(np.ceil(180 / resolution))
+
+        # Rectangles (boxes split at the antimeridian) and their zone
+        rect_zones, rects = [], []
+        for z, zone_key in enumerate(self.zone_keys):
+            for rect in _split_at_antimeridian(bounding_boxes[zone_key]):
+                rect_zones.append(z)
+                rects.append([rect[0][0], rect[0][1], rect[1][0], rect[1][1]])
+        self.rect_zones = np.array(rect_zones, dtype=int)
+        # Columns: lon min, lat min, lon max, lat max
+        self.rects = np.array(rects, dtype=float).reshape(-1, 4)
+        self.zone_areas = np.zeros(len(self.zone_keys))
+        np.add.at(self.zone_areas, self.rect_zones,
+                  (self.rects[:, 2] - self.rects[:, 0]) *
+                  (self.rects[:, 3] - self.rects[:, 1]))
+
+        # Cells overlapped by every rectangle, as (cell, rect) pairs sorted
+        # by cell, i.e. a compressed (cell -> rects) adjacency list
+        cells, cell_rects = [], []
+        for r, (lon_min, lat_min, lon_max, lat_max) in enumerate(self.rects):
+            columns = np.arange(self._column(lon_min),
+                                self._column(lon_max) + 1)
+            rows = np.arange(self._row(lat_min), self._row(lat_max) + 1)
+            overlapped = (rows[:, np.newaxis] * self.n_columns +
+                          columns).ravel()
+            cells.append(overlapped)
+            cell_rects.append(np.full(len(overlapped), r, dtype=int))
+        cells = np.concatenate(cells) if cells else np.zeros(0, dtype=int)
+        cell_rects = np.concatenate(cell_rects) if cell_rects \
+            else np.zeros(0, dtype=int)
+        order = np.argsort(cells, kind='mergesort')
+        self.cell_rects = cell_rects[order]
+        self.cell_start = np.searchsorted(
+            cells[order], np.arange(self.n_rows * self.n_columns + 1))
+
+    def _column(self, lons):
+        return np.clip(np.floor((np.asarray(lons) + 180) / self.resolution),
+                       0, self.n_columns - 1).astype(int)
+
+    def _row(self, lats):
+        return np.clip(np.floor((np.asarray(lats) + 90) / self.resolution),
+                       0, self.n_rows - 1).astype(int)
+
+    def candidates(self, lons, lats):
+        """
+        Returns the (point indices, zone indices) arrays of all pairs of a
+        point and a zone whose bounding box contains it, sorted by point.
+        Zone indices refer to `zone_keys`.
+        """
+        lons = _normalize_longitudes(lons).ravel()
+        lats = np.asarray(lats, dtype=float).ravel()
+        valid = ~np.isnan(lons) & (lats >= -90) & (lats <= 90)
+        points = np.flatnonzero(valid)
+        cells = (self._row(lats[points]) * self.n_columns +
+                 self._column(lons[points]))
+
+        # Gather the rectangles of the cell of every point
+        starts = self.cell_start[cells]
+        counts = self.cell_start[cells + 1] - starts
+        total = counts.sum()
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts,
+                                               counts)
+        rects = self.cell_rects[np.repeat(starts, counts) + offsets]
+        points = np.repeat(points, counts)
+
+        bounds = self.rects[rects]
+        inside = ((bounds[:, 0] <= lons[points]) &
+                  (lons[points] <= bounds[:, 2]) &
+                  (bounds[:, 1] <= lats[points]) &
+                  (lats[points] <= bounds[:, 3]))
+        return points[inside], self.rect_zones[rects[inside]]
+
+    def lookup(self, lons, lats):
+        """
+        Returns the index in `zone_keys` of the smallest bounding box
+        containing every point, -1 for points outside of all boxes.
+        """
+        lons = np.asarray(lons, dtype=float)
+        points, zones = self.candidates(lons, lats)
+        result = np.full(lons.size, -1, dtype=int)
+        if len(points):
+            # Smallest box first within the candidates of every point
+            order = np.lexsort((self.zone_areas[zones], points))
+            points, zones = points[order], zones[order]
+            first = np.concatenate([[True], points[1:] != points[:-1]])
+            result[points[first]] = zones[first]
+        return result.reshape(lons.shape)
+
+    def zones_at(self, lon, lat):
+        """Returns the sorted keys of the zones whose box contains a point"""
+        _, zones = self.candidates([lon], [lat])
+        return sorted(self.zone_keys[z] for z in zones)
+
+
+BOUNDING_BOX_INDEX = BoundingBoxIndex(ZONE_BOUNDING_BOXES)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""Tests for utils/carbon.py."""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import unittest
+
+import numpy as np
+
+from utils import carbon
+from utils.carbon import EMISSION_FACTORS, emission_factor_row
+from utils.config import (CO2EQ_PARAMETERS, EMISSION_FACTOR_MODE_INDEX,
+                          EXCHANGE_KEYS, ZONE_COMPONENT_INDEX, ZONE_KEYS,
+                          emission_factors)
+
+
+class ComputeIntensitiesTestCase(unittest.TestCase):
+    """Tests for the flow-tracing carbon intensity computation."""
+
+    def setUp(self):
+        self.de_factors = emission_factors('DE')
+        self.fr_factors = emission_factors('FR')
+
+    def test_isolated_zone(self):
+        result = carbon.compute_intensities(
+            [{'zoneKey': 'FR', 'production': {'nuclear': 900.0, 'gas': 100.0,
+                                              'coal': None}}], [])
+        expected = (900 * self.fr_factors['nuclear'] +
+                    100 * self.fr_factors['gas']) / 1000
+        self.assertAlmostEqual(result['zones']['FR'], expected)
+
+    def test_imports_and_storage(self):
+        production = [
+            {'zoneKey': 'FR', 'production': {'nuclear': 1000.0}},
+            {'zoneKey': 'DE', 'production': {'coal': 1000.0},
+             'storage': {'hydro': -100.0}},
+        ]
+        exchanges = [{'sortedZoneKeys': 'DE->FR', 'netFlow': 500.0}]
+        result = carbon.compute_intensities(production, exchanges)
+        de = (1000 * self.de_factors['coal'] +
+              100 * self.de_factors['hydro discharge']) / 1100
+        fr = (1000 * self.fr_factors['nuclear'] + 500 * de) / 1500
+        self.assertAlmostEqual(result['zones']['DE'], de)
+        self.assertAlmostEqual(result['zones']['FR'], fr)
+        self.assertAlmostEqual(result['exchanges']['DE->FR'], de)
+
+    def test_import_from_zone_without_data(self):
+        fallback = carbon.FALLBACK_INTENSITIES[ZONE_KEYS.index('BE')]
+        production = [{'zoneKey': 'FR', 'production': {'nuclear': 1000.0}}]
+        exchanges = [{'sortedZoneKeys': 'BE->FR', 'netFlow': 1000.0}]
+        result = carbon.compute_intensities(production, exchanges)
+        self.assertNotIn('BE', result['zones'])
+        self.assertAlmostEqual(result['zones']['FR'],
+                               (1000 * self.fr_factors['nuclear'] +
+                                1000 * fallback) / 2000)
+        self.assertAlmostEqual(result['exchanges']['BE->FR'], fallback)
+
+    def test_balance_holds_for_all_zones(self):
+        rng = np.random.RandomState(0)
+        power = rng.uniform(0, 1000, len(ZONE_KEYS))
+        emissions = power * rng.uniform(10, 800, len(ZONE_KEYS))
+        has_data = rng.uniform(size=len(ZONE_KEYS)) > 0.2
+        flows = rng.uniform(-300, 300, len(EXCHANGE_KEYS))
+        x = carbon.solve_intensities(power, emissions, has_data, flows)
+        solved = ~np.isnan(x)
+        self.assertTrue(solved[has_data].all())
+        # x_i * (power_i + imports_i) = emissions_i + sum_j import_ij * x_j
+        _, exporter, importer, amount = carbon._imports(flows[np.newaxis])
+        known = np.where(solved, x, carbon.FALLBACK_INTENSITIES)
+        usable = ~np.isnan(known[exporter])
+        inflow = np.bincount(importer[usable], amount[usable],
+                             minlength=len(ZONE_KEYS))
+        imported = np.bincount(importer[usable],
+                               amount[usable] * known[exporter[usable]],
+                               minlength=len(ZONE_KEYS))
+        np.testing.assert_allclose((x * (power + inflow))[solved],
+                                   (emissions + imported)[solved])
+
+
+class BatchTestCase(unittest.TestCase):
+    """Tests for the batched carbon intensity computation."""
+
+    def test_batch_matches_single_solves(self):
+        rng = np.random.RandomState(1)
+        shape = (25, len(ZONE_KEYS))
+        power = rng.uniform(0, 1000, shape)
+        power[rng.uniform(size=shape) > 0.9] = 0
+        emissions = power * rng.uniform(10, 800, shape)
+        has_data = rng.uniform(size=shape) > 0.2
+        flows = rng.uniform(-300, 300, (25, len(EXCHANGE_KEYS)))
+        flows[rng.uniform(size=flows.shape) > 0.8] = np.nan
+        batch = carbon.solve_intensities_batch(power, emissions, has_data,
+                                               flows, batch_size=10)
+        self.assertEqual(batch.shape, shape)
+        for t in range(25):
+            np.testing.assert_allclose(
+                batch[t], carbon.solve_intensities(power[t], emissions[t],
+                                                   has_data[t], flows[t]))
+        np.testing.assert_allclose(
+            carbon.exchange_intensities(batch, flows)[3],
+            carbon.exchange_intensities(batch[3], flows[3]))
+        with ThreadPoolExecutor(2) as executor:
+            np.testing.assert_allclose(
+                carbon.solve_intensities_batch(power, emissions, has_data,
+                                               flows, batch_size=10,
+                                               executor=executor), batch)
+
+    def test_grids_partition_zones(self):
+        self.assertTrue((carbon.GRID_MASKS.sum(axis=0) == 1).all())
+        for zone_a, zone_b in (k.split('->') for k in EXCHANGE_KEYS):
+            self.assertEqual(ZONE_COMPONENT_INDEX[zone_a],
+                             ZONE_COMPONENT_INDEX[zone_b])
+        self.assertNotEqual(ZONE_COMPONENT_INDEX['FR'],
+                            ZONE_COMPONENT_INDEX['JP-TK'])
+
+    def test_compute_intensity_history(self):
+        hour1, hour2 = datetime(2018, 1, 1, 0), datetime(2018, 1, 1, 1)
+        production = [
+            {'zoneKey': 'FR', 'datetime': hour1,
+             'production': {'nuclear': 1000.0}},
+            {'zoneKey': 'DE', 'datetime': hour1,
+             'production': {'coal': 1000.0}},
+            {'zoneKey': 'FR', 'datetime': hour2,
+             'production': {'nuclear': 1000.0}},
+        ]
+        exchanges = [{'sortedZoneKeys': 'DE->FR', 'datetime': hour1,
+                      'netFlow': 1000.0}]
+        history = carbon.compute_intensity_history(production, exchanges)
+        self.assertEqual(history['datetimes'], [hour1, hour2])
+        fr = ZONE_KEYS.index('FR')
+        first = carbon.compute_intensities(production[:2], exchanges)
+        self.assertAlmostEqual(history['zones'][0, fr], first['zones']['FR'])
+        self.assertAlmostEqual(history['zones'][1, fr],
+                               emission_factors('FR')['nuclear'])
+        self.assertTrue(np.isnan(history['zones'][1, ZONE_KEYS.index('DE')]))
+
+
+class IncrementalSolverTestCase(unittest.TestCase):
+    """Tests for the incremental re-solve of carbon intensities."""
+
+    def setUp(self):
+        self.production = [
+            {'zoneKey': 'FR', 'production': {'nuclear': 1000.0}},
+            {'zoneKey': 'DE', 'production': {'coal': 1000.0}},
+            {'zoneKey': 'BE', 'production': {'gas': 500.0}},
+        ]
+        self.exchanges = [
+            {'sortedZoneKeys': 'DE->FR', 'netFlow': 500.0},
+            {'sortedZoneKeys': 'BE->FR', 'netFlow': 200.0},
+        ]
+        self.solver = carbon.IncrementalSolver()
+        self.solver.update(self.production, self.exchanges)
+
+    def assertMatchesFullSolve(self, production, exchanges):
+        full = carbon.compute_intensities(production, exchanges)
+        zones = self.solver.zone_intensities()
+        self.assertEqual(set(zones), set(full['zones']))
+        for zone_key, value in full['zones'].items():
+            self.assertAlmostEqual(zones[zone_key], value)
+        for key, value in full['exchanges'].items():
+            self.assertAlmostEqual(self.solver.exchange_intensities()[key],
+                                   value)
+
+    def test_initial_solve(self):
+        self.assertMatchesFullSolve(self.production, self.exchanges)
+
+    def test_update_production(self):
+        update = {'zoneKey': 'DE', 'production': {'wind': 1000.0}}
+        changed = self.solver.update([update])
+        self.assertMatchesFullSolve([self.production[0], update,
+                                     self.production[2]], self.exchanges)
+        # BE exports to FR: it is not downstream of DE
+        self.assertEqual(set(changed), {'DE', 'FR'})
+        self.assertEqual(changed['DE'][1], emission_factors('DE')['wind'])
+
+    def test_update_exchange(self):
+        update = {'sortedZoneKeys': 'DE->FR', 'netFlow': -500.0}
+        changed = self.solver.update(exchange_datapoints=[update])
+        self.assertMatchesFullSolve(self.production,
+                                    [update, self.exchanges[1]])
+        self.assertEqual(set(changed), {'DE', 'FR'})
+
+    def test_threshold(self):
+        update = {'zoneKey': 'DE', 'production': {'coal': 1000.0,
+                                                  'wind': 0.1}}
+        self.assertEqual(self.solver.update([update]), {})
+        self.assertMatchesFullSolve([self.production[0], update,
+                                     self.production[2]], self.exchanges)
+
+    def test_appearing_and_disappearing_zones(self):
+        changed = self.solver.update(
+            [{'zoneKey': 'NL', 'production': {'gas': 100.0}}])
+        self.assertEqual(changed['NL'][0], None)
+        changed = self.solver.remove_production('NL')
+        self.assertEqual(changed['NL'][1], None)
+        self.assertMatchesFullSolve(self.production, self.exchanges)
+
+
+class EmissionFactorsTestCase(unittest.TestCase):
+    """Tests for the emission factors of utils/config.py and utils/carbon.py."""
+
+    def test_matrix_matches_parameters(self):
+        factors = CO2EQ_PARAMETERS['emissionFactors']
+        for zone_key in ['FR', 'DE', 'ES-IB', 'XX']:
+            expected = dict(factors['defaults'],
+                            **factors['zoneOverrides'].get(zone_key, {}))
+            row = EMISSION_FACTORS[emission_factor_row(zone_key)]
+            for mode, factor in expected.items():
+                self.assertEqual(
+                    row[EMISSION_FACTOR_MODE_INDEX[mode]], factor['value'])
+                self.assertEqual(emission_factors(zone_key)[mode],
+                                 factor['value'])
+
+    def test_dict_view_is_memoized_and_read_only(self):
+        self.assertIs(emission_factors('FR'), emission_factors('FR'))
+        with self.assertRaises(TypeError):
+            emission_factors('FR')['coal'] = 0
+
+    def test_production_emissions(self):
+        power, emissions, _ = carbon.production_vectors([
+            {'zoneKey': 'FR', 'production': {'nuclear': 10.0, 'new': 1.0},
+             'storage': {'hydro': -2.0, 'battery': 3.0}}])
+        fr = ZONE_KEYS.index('FR')
+        factors = emission_factors('FR')
+        self.assertEqual(power[fr], 13.0)
+        self.assertAlmostEqual(
+            emissions[fr], 10 * factors['nuclear'] + factors['unknown'] +
+            2 * factors['hydro discharge'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""Tests for utils/fleet.py."""
+import threading
+import unittest
+from unittest import mock
+
+from utils import fleet
+
+
+class CollectTestCase(unittest.TestCase):
+
+    def test_hanging_parsers_do_not_exceed_max_workers(self):
+        release = threading.Event()
+        lock = threading.Lock()
+        concurrency = {'current': 0, 'max': 0}
+
+        def hanging_job(parser_key, key, session=None):
+            with lock:
+                concurrency['current'] += 1
+                concurrency['max'] = max(concurrency['max'],
+                                         concurrency['current'])
+            try:
+                release.wait(5)
+            finally:
+                with lock:
+                    concurrency['current'] -= 1
+
+        zone_keys = ['DE', 'FR', 'GB', 'NL', 'BE']
+        try:
+            with mock.patch.object(fleet, 'run_job', hanging_job):
+                results = fleet.collect(zone_keys, [], max_workers=2,
+                                        timeout=0.2)
+            self.assertLessEqual(concurrency['max'], 2)
+            self.assertEqual(results['production'], [])
+            self.assertEqual(set(results['errors']),
+                             {('production', k) for k in zone_keys})
+        finally:
+            release.set()
+
+    def test_on_component_runs_off_the_dispatcher(self):
+        threads = []
+
+        def job(parser_key, key, session=None):
+            return None
+
+        def on_component(component, results):
+            threads.append((component, threading.current_thread()))
+
+        # NOT-A-ZONE has a parser but is missing from the config
+        parsers = {'production': {'DE': job, 'NOT-A-ZONE': job},
+                   'exchange': {}}
+        with mock.patch.object(fleet, 'run_job', job), \
+                mock.patch.object(fleet, 'PARSER_KEY_TO_DICT', parsers):
+            results = fleet.collect(['DE', 'NOT-A-ZONE'], [],
+                                    on_component=on_component)
+        # Handed over before collect returned, the unknown zone skipped
+        component = fleet.job_component('production', 'DE')
+        self.assertEqual([c for c, _ in threads], [component])
+        self.assertIsNot(threads[0][1], threading.current_thread())
+        self.assertEqual(set(results['errors']), {('production', 'DE')})
+
+if __name__ == '__main__':
+    unittest.main()
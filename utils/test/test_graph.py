@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""Tests for utils/graph.py."""
+import unittest
+
+import numpy as np
+
+from utils.config import ZONE_COMPONENT_INDEX, ZONE_NEIGHBOURS
+from utils.graph import EXCHANGE_GRAPH, ExchangeGraph
+
+
+class ExchangeGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = ExchangeGraph(['A', 'B', 'C', 'D'],
+                                   ['A->B', 'A->C', 'B->C'])
+
+    def test_adjacency(self):
+        self.assertEqual(list(self.graph.neighbours(2)), [0, 1])
+        self.assertEqual(list(self.graph.degree()), [2, 2, 2, 0])
+        self.assertEqual(self.graph.edge('A->C'), (1, 0, 2))
+        self.assertEqual(list(self.graph.exchanges_of([1])), [0, 2])
+        with self.assertRaises(ValueError):
+            self.graph.indices[0] = 1
+
+    def test_matches_zone_neighbours(self):
+        for i, zone_key in enumerate(EXCHANGE_GRAPH.zone_keys):
+            self.assertEqual(
+                sorted(EXCHANGE_GRAPH.zone_keys[j]
+                       for j in EXCHANGE_GRAPH.neighbours(i)),
+                ZONE_NEIGHBOURS.get(zone_key, []))
+
+    def test_aggregates(self):
+        # A exports 10 to B, C exports 5 to A, B->C is missing
+        flows = np.array([10, -5, np.nan])
+        np.testing.assert_array_equal(self.graph.imports(flows),
+                                      [5, 10, 0, 0])
+        np.testing.assert_array_equal(self.graph.exports(flows),
+                                      [10, 0, 5, 0])
+        np.testing.assert_array_equal(self.graph.net_imports(flows),
+                                      [-5, 10, -5, 0])
+        np.testing.assert_array_equal(
+            self.graph.flow_balance([5, 0, 5, 1], [0, 10, 0, 1], flows),
+            [0, 0, 0, 0])
+        stack = np.array([flows, -flows])
+        np.testing.assert_array_equal(self.graph.net_imports(stack),
+                                      [[-5, 10, -5, 0], [5, -10, 5, 0]])
+
+    def test_components(self):
+        self.assertEqual(list(self.graph.components()), [0, 0, 0, 1])
+        self.assertEqual(
+            list(EXCHANGE_GRAPH.components()),
+            [ZONE_COMPONENT_INDEX[k] for k in EXCHANGE_GRAPH.zone_keys])
+
+if __name__ == '__main__':
+    unittest.main()
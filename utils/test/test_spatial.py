@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""Tests for utils/spatial.py."""
+import unittest
+
+import numpy as np
+
+from utils.config import ZONE_BOUNDING_BOXES
+from utils.spatial import BOUNDING_BOX_INDEX, BoundingBoxIndex
+
+
+class BoundingBoxIndexTestCase(unittest.TestCase):
+
+    def test_matches_linear_scan(self):
+        rng = np.random.RandomState(0)
+        lons = rng.uniform(-180, 180, 5000)
+        lats = rng.uniform(-60, 75, 5000)
+        points, zones = BOUNDING_BOX_INDEX.candidates(lons, lats)
+        for i in range(len(lons)):
+            expected = sorted(
+                k for k, ((lon_min, lat_min), (lon_max, lat_max))
+                in ZONE_BOUNDING_BOXES.items()
+                if lon_min <= lons[i] <= lon_max and
+                lat_min <= lats[i] <= lat_max)
+            self.assertEqual(
+                sorted(BOUNDING_BOX_INDEX.zone_keys[z]
+                       for z in zones[points == i]), expected)
+
+    def test_overlapping_boxes(self):
+        index = BoundingBoxIndex({'BIG': [[0, 0], [10, 10]],
+                                  'SMALL': [[2, 2], [4, 4]]})
+        self.assertEqual(index.zones_at(3, 3), ['BIG', 'SMALL'])
+        result = index.lookup(np.array([3, 8, 20, np.nan]),
+                              np.array([3, 8, 20, 0]))
+        self.assertEqual([index.zone_keys[z] if z >= 0 else None
+                          for z in result], ['SMALL', 'BIG', None, None])
+
+    def test_antimeridian(self):
+        index = BoundingBoxIndex({'WRAPPED': [[170, -20], [190, -10]],
+                                  'CROSSING': [[175, -15], [-175, -12]]})
+        self.assertEqual(index.zones_at(-179, -14), ['CROSSING', 'WRAPPED'])
+        self.assertEqual(index.zones_at(179, -11), ['WRAPPED'])
+        self.assertEqual(index.zones_at(-170, -15), ['WRAPPED'])
+        # Longitudes are wrapped as well
+        self.assertEqual(index.zones_at(181, -14), ['CROSSING', 'WRAPPED'])
+        self.assertEqual(index.zones_at(0, -14), [])
+
+
+if __name__ == '__main__':
+    unittest.main()